@@ -8,11 +8,26 @@ from models.user import User, SecurityPersonnel, Admin, UserRole
 from models.visit import Visit, VisitStatus
 from models.ban import Ban
 from models.incident import Incident
+from models.face_embedding import FaceEmbedding
+from models.gallery_change import GalleryChange
+from models.identify_job import IdentifyJob
 from routes.auth_routes import auth_bp
 from routes.visitor_routes import visitor_bp
 from routes.security_routes import security_bp
 from routes.admin_routes import admin_bp
 from routes.visit_routes import visit_bp
+from commands.face_index import face_index_recall_command, face_index_scaling_command
+from commands.embeddings import backfill_embeddings_command
+from commands.gallery import snapshot_gallery_command
+from commands.inference import inference_server_command
+from commands.probe_benchmark import probe_benchmark_command
+from commands.face_benchmark import face_benchmark_command
+from commands.stream import identify_stream_command
+from commands.face_model import export_face_model_command, check_face_model_command
+from utils.biometric import model_registry, inference_batcher
+from utils.sharded_search import shard_pool
+from utils.schema import upgrade_schema
+from utils.inference_service import start_inference_service, face_model_names
 
 def create_app(config_name="development"):
     """Initialize and configure the Flask app."""
@@ -30,11 +45,44 @@ def create_app(config_name="development"):
     app.register_blueprint(admin_bp, url_prefix='/api/admin')
     app.register_blueprint(visit_bp, url_prefix='/api/visits')
 
+    # Register CLI commands
+    app.cli.add_command(face_index_recall_command)
+    app.cli.add_command(face_index_scaling_command)
+    app.cli.add_command(backfill_embeddings_command)
+    app.cli.add_command(snapshot_gallery_command)
+    app.cli.add_command(inference_server_command)
+    app.cli.add_command(probe_benchmark_command)
+    app.cli.add_command(face_benchmark_command)
+    app.cli.add_command(identify_stream_command)
+    app.cli.add_command(export_face_model_command)
+    app.cli.add_command(check_face_model_command)
+
     # Initialize database tables and create default admin
     with app.app_context():
         db.create_all()
+        for column in upgrade_schema():
+            print(f"Added column {column} to the existing database")
         create_admin_if_not_exists()
 
+    # Only records the settings; models are built on first use or at warm-up
+    model_registry.configure(
+        face_model_names(app.config), app.config['FACE_RUNTIME'], app.config['FACE_ONNX_DIR'], app.config['FACE_ONNX_THREADS']
+    )
+    shard_pool.configure(app.config['FACE_INDEX_SHARD_POOLS'], app.config['FACE_INDEX_SHARD_LOCK_DIR'])
+
+    if app.config['INFERENCE_SERVICE_ENABLED']:
+        # The models live in the inference service; web workers never load them
+        if app.config['INFERENCE_SERVICE_AUTOSTART']:
+            start_inference_service(app.config)
+    else:
+        if app.config['FACE_BATCHING_ENABLED']:
+            inference_batcher.configure(app.config['FACE_BATCH_WINDOW_MS'], app.config['FACE_BATCH_MAX_SIZE'])
+
+        # Load the face models now so the first gate request doesn't pay for it
+        if app.config['FACE_MODEL_WARMUP']:
+            stats = model_registry.warm_up()
+            print(f"Face models warmed up: {stats}")
+
     return app
 
 def create_admin_if_not_exists():
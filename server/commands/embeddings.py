@@ -0,0 +1,276 @@
+# commands/embeddings.py - Backfill face embeddings, or re-embed the gallery with a new model
+
+import os
+import json
+import time
+import multiprocessing
+import click
+from datetime import datetime
+from flask import current_app
+from flask.cli import with_appcontext
+from extensions import db
+from models.user import Visitor, EmbeddingStatus
+from models.face_embedding import FaceEmbedding
+from utils.biometric import model_registry, decode_image, represent_image
+from utils.gallery import record_gallery_change, migration_status, serving_model
+from utils.inference_service import face_model_names
+
+def _init_worker(model_names, runtime, onnx_dir, onnx_threads):
+    """
+    Build the face models once in each worker process. Spawned workers start with an
+    unconfigured registry, so the app's runtime (FACE_RUNTIME) is applied here first.
+    """
+    model_registry.configure(model_names, runtime, onnx_dir, onnx_threads)
+    model_registry.get_detector()
+    for model_name in model_names:
+        model_registry.get_recognition_model(model_name)
+
+def _embed_file(task):
+    """
+    Worker: embed one image file with each model, returning (visitor_id, {model: embedding or None}
+    or None, error or None)
+    """
+    visitor_id, full_path, model_names = task
+    try:
+        with open(full_path, 'rb') as f:
+            img = decode_image(f.read())
+        if img is None:
+            return visitor_id, None, f"Could not read image {full_path}"
+
+        embeddings = {model_name: represent_image(img, model_name) for model_name in model_names}
+        if all(embedding is None for embedding in embeddings.values()):
+            return visitor_id, None, "No face detected"
+        return visitor_id, embeddings, None
+    except Exception as e:
+        return visitor_id, None, str(e)
+
+def load_checkpoint(path, restart=False):
+    """Progress of a previous run, or a fresh checkpoint if there is none (or restart is set)"""
+    if restart or not os.path.exists(path):
+        return {'last_visitor_id': 0, 'processed': 0, 'ready': 0, 'failed': 0, 'failed_ids': []}
+    with open(path) as f:
+        checkpoint = json.load(f)
+    checkpoint.setdefault('failed_ids', [])
+    return checkpoint
+
+def save_checkpoint(path, checkpoint):
+    """Write the checkpoint atomically so an interrupted run never leaves a torn file"""
+    checkpoint['updated_at'] = datetime.utcnow().isoformat()
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'w') as f:
+        json.dump(checkpoint, f, indent=2)
+    os.replace(tmp_path, path)
+
+def _missing_model_embedding(model_name):
+    """Filter for ready visitors that have no embedding for model_name yet"""
+    has_embedding = db.session.query(FaceEmbedding.id).filter(
+        FaceEmbedding.visitor_id == Visitor.id,
+        FaceEmbedding.model_name == model_name
+    ).exists()
+    return db.and_(Visitor.embedding_status == EmbeddingStatus.READY, ~has_embedding)
+
+def pending_visitors(after_id, limit, retry_failed, migrate_model=None, visitor_ids=None):
+    """
+    Next page of visitors with a photo but no ready embedding, in id order. When migrating,
+    ready visitors without an embedding for migrate_model instead. visitor_ids limits the
+    page to those visitors.
+    """
+    if migrate_model:
+        pending = _missing_model_embedding(migrate_model)
+    else:
+        statuses = [EmbeddingStatus.PENDING]
+        if retry_failed:
+            statuses.append(EmbeddingStatus.FAILED)
+        pending = db.or_(Visitor.embedding_status.is_(None), Visitor.embedding_status.in_(statuses))
+
+    query = db.session.query(Visitor.id, Visitor.image_path).filter(
+        Visitor.id > after_id,
+        Visitor.image_path.isnot(None),
+        pending
+    )
+    if visitor_ids is not None:
+        query = query.filter(Visitor.id.in_(visitor_ids))
+    return query.order_by(Visitor.id).limit(limit).all()
+
+def exclude_failed_visitors(model_name, visitor_ids):
+    """
+    Mark visitors the new model could not embed as failed, so they no longer hold up the
+    switch-over. They drop out of identification until a new photo of them is embedded.
+
+    Returns:
+        int: Number of visitors marked
+    """
+    visitor_ids = [
+        visitor_id for (visitor_id,) in db.session.query(Visitor.id).filter(
+            Visitor.id.in_(visitor_ids), _missing_model_embedding(model_name)
+        )
+    ]
+    if visitor_ids:
+        visitors = Visitor.__table__
+        db.session.execute(
+            visitors.update().where(visitors.c.id.in_(visitor_ids)).values(embedding_status=EmbeddingStatus.FAILED)
+        )
+        for visitor_id in visitor_ids:
+            record_gallery_change(visitor_id)
+        db.session.commit()
+    return len(visitor_ids)
+
+def write_batch(results, migrating=False):
+    """
+    Store one batch of worker results and update the visitors' status in a single commit.
+    A migration only adds embeddings for the new model: the visitors' status and the served
+    gallery are left alone, so identification carries on undisturbed. Otherwise the model
+    identification is served from decides the status, as in the embedding worker.
+
+    Returns:
+        tuple: (int, list) - number of visitors embedded, and ids of those that failed
+    """
+    visitor_ids = [visitor_id for visitor_id, _, _ in results]
+    existing = {
+        (record.visitor_id, record.model_name): record
+        for record in FaceEmbedding.query.filter(FaceEmbedding.visitor_id.in_(visitor_ids))
+    }
+
+    serving_name = None if migrating else serving_model()
+    ready_ids, failed_ids = [], []
+    for visitor_id, embeddings, error in results:
+        if embeddings is None or (serving_name and embeddings[serving_name] is None):
+            failed_ids.append(visitor_id)
+            continue
+
+        for model_name, embedding in embeddings.items():
+            if embedding is None:
+                continue
+            record = existing.get((visitor_id, model_name))
+            if not record:
+                record = FaceEmbedding(visitor_id=visitor_id, model_name=model_name)
+                db.session.add(record)
+            record.set_embedding(embedding)
+        ready_ids.append(visitor_id)
+
+    if migrating:
+        db.session.commit()
+        return len(ready_ids), failed_ids
+
+    visitors = Visitor.__table__
+    for ids, status in ((ready_ids, EmbeddingStatus.READY), (failed_ids, EmbeddingStatus.FAILED)):
+        if ids:
+            db.session.execute(visitors.update().where(visitors.c.id.in_(ids)).values(embedding_status=status))
+
+    # Running workers pick the new embeddings up incrementally
+    for visitor_id in ready_ids + failed_ids:
+        record_gallery_change(visitor_id)
+
+    db.session.commit()
+    return len(ready_ids), failed_ids
+
+@click.command('backfill-embeddings')
+@click.option('--workers', default=os.cpu_count(), show_default=True, help='Worker processes computing embeddings.')
+@click.option('--batch-size', default=200, show_default=True, help='Embeddings written per database commit.')
+@click.option('--checkpoint', default=None, help='Progress file used to resume [default: backfill_embeddings.json, or one per --model].')
+@click.option('--restart', is_flag=True, help='Ignore an existing checkpoint and start from the first visitor.')
+@click.option('--retry-failed', is_flag=True, help='First retry the visitors the checkpoint lists as failed (with --restart, every failed visitor).')
+@click.option('--model', 'migrate_model', default=None, help='Re-embed every ready visitor with this model (a FACE_MODEL migration).')
+@click.option('--exclude-failed', is_flag=True, help='With --model, mark visitors the new model could not embed as failed so they stop holding up the switch-over.')
+@with_appcontext
+def backfill_embeddings_command(workers, batch_size, checkpoint, restart, retry_failed, migrate_model, exclude_failed):
+    """
+    Compute embeddings for every visitor photo already on disk.
+
+    With --model, build the gallery for a new recognition model while the app keeps identifying
+    on the current one. Set FACE_MODEL to the new model and FACE_MODEL_PREVIOUS to the old one
+    first, so photos registered meanwhile are embedded with both.
+
+    The ids of visitors whose photo could not be embedded are kept in the checkpoint and
+    listed at the end. During a migration they keep the app on the old model until they are
+    retried successfully (--retry-failed) or given up on (--exclude-failed).
+    """
+    if exclude_failed and not migrate_model:
+        raise click.UsageError('--exclude-failed only applies to a migration (--model)')
+    if checkpoint is None:
+        checkpoint = f"backfill_embeddings.{migrate_model.lower()}.json" if migrate_model else 'backfill_embeddings.json'
+    model_names = [migrate_model] if migrate_model else face_model_names(current_app.config)
+    progress = load_checkpoint(checkpoint, restart)
+    if progress['last_visitor_id']:
+        click.echo(f"Resuming after visitor {progress['last_visitor_id']} ({progress['processed']} already processed)")
+
+    static_folder = current_app.static_folder
+    started = time.perf_counter()
+    processed_this_run = 0
+
+    def flush(batch, advance):
+        nonlocal processed_this_run
+        ready, failed_ids = write_batch(batch, migrating=bool(migrate_model))
+        progress.update(
+            processed=progress['processed'] + len(batch),
+            ready=progress['ready'] + ready,
+            failed=progress['failed'] + len(failed_ids),
+            failed_ids=progress['failed_ids'] + failed_ids
+        )
+        if advance:
+            progress['last_visitor_id'] = batch[-1][0]
+        save_checkpoint(checkpoint, progress)
+        processed_this_run += len(batch)
+
+        elapsed = time.perf_counter() - started
+        click.echo(f"{progress['processed']} processed ({progress['ready']} ready, {progress['failed']} failed), "
+                   f"{processed_this_run / elapsed:.1f} images/s")
+
+    def process(pool, page, advance=True):
+        tasks = [(visitor_id, os.path.join(static_folder, image_path), model_names) for visitor_id, image_path in page]
+        batch = []
+
+        # imap keeps input order, so the checkpoint only ever advances past committed visitors
+        for result in pool.imap(_embed_file, tasks, chunksize=4):
+            if result[2]:
+                click.echo(f"Visitor {result[0]}: {result[2]}", err=True)
+            batch.append(result)
+            if len(batch) == batch_size:
+                flush(batch, advance)
+                batch = []
+
+        if batch:
+            flush(batch, advance)
+
+    # Spawn rather than fork: TensorFlow state does not survive a fork
+    context = multiprocessing.get_context('spawn')
+    config = current_app.config
+    runtime = (config['FACE_RUNTIME'], config['FACE_ONNX_DIR'], config['FACE_ONNX_THREADS'])
+    with context.Pool(processes=workers, initializer=_init_worker, initargs=(model_names, *runtime)) as pool:
+        if retry_failed and progress['failed_ids']:
+            # Visitors that fail again are listed afresh; the rest are no longer failures
+            retry_ids = progress['failed_ids']
+            click.echo(f"Retrying {len(retry_ids)} visitors that failed before")
+            progress.update(failed=progress['failed'] - len(retry_ids), failed_ids=[])
+            save_checkpoint(checkpoint, progress)
+            for start in range(0, len(retry_ids), batch_size * workers):
+                chunk = retry_ids[start:start + batch_size * workers]
+                process(pool, pending_visitors(0, len(chunk), True, migrate_model, chunk), advance=False)
+
+        while True:
+            page = pending_visitors(progress['last_visitor_id'], batch_size * workers, retry_failed, migrate_model)
+            if not page:
+                break
+            process(pool, page)
+
+    elapsed = time.perf_counter() - started
+    rate = processed_this_run / elapsed if elapsed else 0.0
+    click.echo(f"Done: {processed_this_run} images in {elapsed:.1f} s ({rate:.1f} images/s), "
+               f"{progress['ready']} ready and {progress['failed']} failed in total")
+
+    failed_ids = progress['failed_ids']
+    if failed_ids:
+        listed = ', '.join(str(visitor_id) for visitor_id in failed_ids[:20])
+        click.echo(f"{len(failed_ids)} visitors could not be embedded: {listed}"
+                   + (" and more (see the checkpoint)" if len(failed_ids) > 20 else ""), err=True)
+
+    if exclude_failed and failed_ids:
+        excluded = exclude_failed_visitors(migrate_model, failed_ids)
+        progress['failed_ids'] = []
+        save_checkpoint(checkpoint, progress)
+        click.echo(f"{excluded} visitors marked failed; they need a new photo to be identified again")
+
+    if migrate_model:
+        status = migration_status(migrate_model)
+        click.echo(f"{migrate_model}: {status['embedded']} of {status['total']} ready visitors embedded"
+                   + (", the app switches over on its next check" if status['complete'] else ""))
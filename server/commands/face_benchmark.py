@@ -0,0 +1,243 @@
+# commands/face_benchmark.py - Speed and accuracy of detector and recognition model combinations
+
+import os
+import json
+import time
+import random
+import platform
+import resource
+import itertools
+import multiprocessing
+import click
+import numpy as np
+from datetime import datetime
+from flask import current_app
+from flask.cli import with_appcontext
+from utils.biometric import model_registry, decode_image, detect_faces, embed_faces, get_tolerance
+from utils.stats import latency_summary
+
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.webp')
+
+def labelled_images(images_dir, per_identity):
+    """
+    Photos of a labelled set laid out one directory per person (like LFW), as (label, path)
+    pairs. People with a single photo are kept: they still make impostor pairs.
+    """
+    images = []
+    for label in sorted(os.listdir(images_dir)):
+        person_dir = os.path.join(images_dir, label)
+        if not os.path.isdir(person_dir):
+            continue
+        paths = sorted(
+            os.path.join(person_dir, name) for name in os.listdir(person_dir)
+            if name.lower().endswith(IMAGE_EXTENSIONS)
+        )[:per_identity]
+        images += [(label, path) for path in paths]
+    return images
+
+def verification_pairs(labels, max_pairs, seed=0):
+    """
+    Genuine pairs (same person) and as many impostor pairs (different people) drawn from the
+    image labels. The pairs only depend on the image set and seed, so runs stay comparable.
+
+    Returns:
+        tuple: (numpy.ndarray, numpy.ndarray) - (n, 2) image index pairs and whether each is genuine
+    """
+    rng = random.Random(seed)
+    by_label = {}
+    for i, label in enumerate(labels):
+        by_label.setdefault(label, []).append(i)
+
+    genuine = [pair for indices in by_label.values() for pair in itertools.combinations(indices, 2)]
+    rng.shuffle(genuine)
+    genuine = genuine[:max_pairs]
+
+    impostor = set()
+    attempts = 0
+    while len(impostor) < len(genuine) and attempts < len(genuine) * 20:
+        attempts += 1
+        i, j = sorted(rng.sample(range(len(labels)), 2))
+        if labels[i] != labels[j]:
+            impostor.add((i, j))
+
+    pairs = genuine + sorted(impostor)
+    return np.array(pairs, dtype=np.int64).reshape(-1, 2), np.arange(len(pairs)) < len(genuine)
+
+def _run_combination(task):
+    """
+    Worker: time decode, detection and embedding of every image with one detector and model.
+    Runs in a fresh process per combination, so the peak RSS is that combination's alone.
+    """
+    detector, model_name, paths, runtime, onnx_dir, onnx_threads = task
+    try:
+        model_registry.configure([model_name], runtime, onnx_dir, onnx_threads)
+        started = time.perf_counter()
+        model_registry.get_detector(detector)
+        model_registry.get_recognition_model(model_name)
+        load_seconds = time.perf_counter() - started
+
+        # Warm-up, so graph building is not counted as the first image's latency
+        with open(paths[0], 'rb') as f:
+            img = decode_image(f.read())
+        faces = detect_faces(img, detector) if img is not None else []
+        embed_faces([faces[0].img if faces else np.zeros((224, 224, 3), dtype=np.uint8)], model_name)
+
+        stages = {'decode': [], 'detect': [], 'embed': [], 'total': []}
+        embeddings = []
+        started = time.perf_counter()
+        for path in paths:
+            image_started = time.perf_counter()
+            with open(path, 'rb') as f:
+                img = decode_image(f.read())
+            decoded = time.perf_counter()
+            stages['decode'].append((decoded - image_started) * 1000)
+            if img is None:
+                embeddings.append(None)
+                continue
+
+            faces = detect_faces(img, detector)
+            detected = time.perf_counter()
+            stages['detect'].append((detected - decoded) * 1000)
+            if not faces:
+                embeddings.append(None)
+                continue
+
+            largest = max(faces, key=lambda face: face.facial_area.w * face.facial_area.h)
+            embeddings.append(embed_faces([largest.img], model_name)[0])
+            finished = time.perf_counter()
+            stages['embed'].append((finished - detected) * 1000)
+            stages['total'].append((finished - image_started) * 1000)
+        elapsed = time.perf_counter() - started
+
+        return {
+            'stages': stages,
+            'embeddings': embeddings,
+            'load_seconds': load_seconds,
+            'elapsed_seconds': elapsed,
+            # ru_maxrss is in kilobytes on Linux
+            'peak_rss_bytes': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024,
+            'error': None
+        }
+    except Exception as e:
+        return {'error': f"{type(e).__name__}: {e}"}
+
+def verification_accuracy(embeddings, pairs, genuine, tolerance):
+    """
+    Accept/reject every pair at the tolerance. A pair with an image where no face was found
+    counts as rejected, as it would be at the gate.
+    """
+    accepted = np.zeros(len(pairs), dtype=bool)
+    distances = np.full(len(pairs), np.nan)
+    for n, (i, j) in enumerate(pairs):
+        if embeddings[i] is None or embeddings[j] is None:
+            continue
+        distances[n] = 1.0 - float(np.dot(embeddings[i], embeddings[j]))
+        accepted[n] = distances[n] <= tolerance
+
+    def mean_distance(mask):
+        values = distances[mask & ~np.isnan(distances)]
+        return round(float(values.mean()), 4) if len(values) else None
+
+    impostor = ~genuine
+    return {
+        'tolerance': tolerance,
+        'genuine_pairs': int(genuine.sum()),
+        'impostor_pairs': int(impostor.sum()),
+        'pairs_missing_a_face': int(np.isnan(distances).sum()),
+        'true_accept_rate': round(float(accepted[genuine].mean()), 4) if genuine.any() else None,
+        'false_accept_rate': round(float(accepted[impostor].mean()), 4) if impostor.any() else None,
+        'accuracy': round(float((accepted == genuine).mean()), 4) if len(pairs) else None,
+        'mean_genuine_distance': mean_distance(genuine),
+        'mean_impostor_distance': mean_distance(impostor)
+    }
+
+@click.command('face-benchmark')
+@click.option('--images', 'images_dir', required=True, help='Labelled photos, one subdirectory per person.')
+@click.option('--detectors', default=None, help='Comma-separated detector backends [default: FACE_BENCHMARK_DETECTORS].')
+@click.option('--models', default=None, help='Comma-separated recognition models [default: FACE_BENCHMARK_MODELS].')
+@click.option('--per-identity', default=10, show_default=True, help='Photos used per person.')
+@click.option('--max-pairs', default=1000, show_default=True, help='Genuine pairs compared, with as many impostor pairs.')
+@click.option('--output', default='face_benchmark.json', show_default=True, help='JSON file the results are written to.')
+@with_appcontext
+def face_benchmark_command(images_dir, detectors, models, per_identity, max_pairs, output):
+    """
+    Run a labelled image set through each detector and model combination, reporting per-stage
+    latency, throughput, peak memory and verification accuracy at each model's tolerance.
+    """
+    config = current_app.config
+    detectors = [d.strip() for d in detectors.split(',') if d.strip()] if detectors else config['FACE_BENCHMARK_DETECTORS']
+    models = [m.strip() for m in models.split(',') if m.strip()] if models else config['FACE_BENCHMARK_MODELS']
+
+    images = labelled_images(images_dir, per_identity)
+    labels = [label for label, _ in images]
+    paths = [path for _, path in images]
+    pairs, genuine = verification_pairs(labels, max_pairs)
+    if len(set(labels)) < 2 or not genuine.any():
+        raise click.ClickException(f"{images_dir} needs two or more people, with two photos of at least one")
+    click.echo(f"{len(paths)} images of {len(set(labels))} people, {int(genuine.sum())} genuine "
+               f"and {int((~genuine).sum())} impostor pairs")
+
+    combinations = list(itertools.product(detectors, models))
+    tasks = [
+        (detector, model_name, paths, config['FACE_RUNTIME'], config['FACE_ONNX_DIR'], config['FACE_ONNX_THREADS'])
+        for detector, model_name in combinations
+    ]
+
+    report = {
+        'created_at': datetime.utcnow().isoformat(),
+        'host': {
+            'machine': platform.machine(),
+            'processor': platform.processor(),
+            'cpu_count': os.cpu_count(),
+            'python': platform.python_version()
+        },
+        'runtime': config['FACE_RUNTIME'],
+        'dataset': {
+            'images_dir': os.path.abspath(images_dir),
+            'images': len(paths),
+            'identities': len(set(labels)),
+            'genuine_pairs': int(genuine.sum()),
+            'impostor_pairs': int((~genuine).sum())
+        },
+        'results': []
+    }
+
+    click.echo(f"{'detector':<12} {'model':<12} {'detect p50':>10} {'embed p50':>10} {'total p95':>10} "
+               f"{'img/s':>7} {'peak RSS':>9} {'TAR':>6} {'FAR':>6} {'acc':>6}")
+
+    # Spawn rather than fork: TensorFlow state does not survive a fork
+    context = multiprocessing.get_context('spawn')
+    with context.Pool(processes=1, maxtasksperchild=1) as pool:
+        for (detector, model_name), result in zip(combinations, pool.imap(_run_combination, tasks)):
+            entry = {'detector': detector, 'model': model_name}
+            if result['error']:
+                entry['error'] = result['error']
+                report['results'].append(entry)
+                click.echo(f"{detector:<12} {model_name:<12} failed: {result['error']}", err=True)
+                continue
+
+            embeddings = result['embeddings']
+            accuracy = verification_accuracy(embeddings, pairs, genuine, get_tolerance(model_name))
+            latency = {stage: latency_summary(values) for stage, values in result['stages'].items()}
+            throughput = len(paths) / result['elapsed_seconds'] if result['elapsed_seconds'] else None
+            detected = sum(embedding is not None for embedding in embeddings)
+            entry.update(
+                latency_ms=latency,
+                throughput_images_per_second=round(throughput, 2) if throughput else None,
+                peak_rss_bytes=result['peak_rss_bytes'],
+                model_load_seconds=round(result['load_seconds'], 3),
+                face_detection_rate=round(detected / len(paths), 4),
+                verification=accuracy
+            )
+            report['results'].append(entry)
+
+            def ms(stage, key):
+                return f"{latency[stage][key]:8.1f}ms" if latency[stage] else f"{'-':>10}"
+
+            click.echo(f"{detector:<12} {model_name:<12} {ms('detect', 'p50')} {ms('embed', 'p50')} {ms('total', 'p95')} "
+                       f"{throughput or 0:7.2f} {result['peak_rss_bytes'] / 2**20:7.0f}MB "
+                       f"{accuracy['true_accept_rate']:6.3f} {accuracy['false_accept_rate']:6.3f} {accuracy['accuracy']:6.3f}")
+
+    with open(output, 'w') as f:
+        json.dump(report, f, indent=2)
+    click.echo(f"Results written to {output}")
@@ -0,0 +1,154 @@
+# commands/face_index.py - Recall, latency and scaling harnesses for the face indexes
+
+import os
+import time
+import click
+import numpy as np
+from flask.cli import with_appcontext
+from utils.biometric import (
+    ExactFaceIndex, ShardedExactFaceIndex, IVFFaceIndex, HNSWFaceIndex, l2_normalize, quantize_embeddings, hnswlib
+)
+from utils.sharded_search import shard_pool
+from utils.gallery import load_gallery
+from utils.stats import latency_summary
+
+def synthetic_gallery(size, dim, identities_per_cluster=50, seed=0):
+    """
+    Generate clustered unit vectors that roughly mimic face embeddings, where
+    people with similar appearance end up close together.
+    """
+    rng = np.random.default_rng(seed)
+    n_clusters = max(1, size // identities_per_cluster)
+    centers = l2_normalize(rng.standard_normal((n_clusters, dim), dtype=np.float32))
+    assignments = rng.integers(0, n_clusters, size)
+
+    embeddings = np.empty((size, dim), dtype=np.float32)
+    for start in range(0, size, 10000):
+        stop = min(size, start + 10000)
+        noise = rng.standard_normal((stop - start, dim), dtype=np.float32) * (1.2 / np.sqrt(dim))
+        embeddings[start:stop] = l2_normalize(centers[assignments[start:stop]] + noise)
+    return np.arange(1, size + 1, dtype=np.int64), embeddings
+
+def noisy_queries(embeddings, count, seed=1):
+    """Probe vectors close to random gallery entries, like a fresh photo of a registered visitor"""
+    rng = np.random.default_rng(seed)
+    picks = rng.choice(len(embeddings), min(count, len(embeddings)), replace=False)
+    dim = embeddings.shape[1]
+    noise = rng.standard_normal((len(picks), dim), dtype=np.float32) * (0.3 / np.sqrt(dim))
+    return l2_normalize(embeddings[picks] + noise)
+
+def measure(index, queries, k, exact_results=None):
+    """Run every query through an index, returning the results, recall@k and a latency summary"""
+    results, latencies = [], []
+    for query in queries:
+        started = time.perf_counter()
+        ids, _ = index.search(query, k=k)
+        latencies.append((time.perf_counter() - started) * 1000)
+        results.append(ids)
+
+    recall = None
+    if exact_results is not None:
+        hits = sum(len(np.intersect1d(found, expected)) for found, expected in zip(results, exact_results))
+        recall = hits / sum(len(expected) for expected in exact_results)
+
+    return results, recall, latency_summary(latencies)
+
+def format_latency(latency):
+    return (f"mean={latency['mean']:8.3f} ms  p50={latency['p50']:8.3f} ms  "
+            f"p95={latency['p95']:8.3f} ms  p99={latency['p99']:8.3f} ms")
+
+@click.command('face-index-recall')
+@click.option('--size', default=50000, show_default=True, help='Synthetic gallery size.')
+@click.option('--dim', default=4096, show_default=True, help='Embedding dimensions (VGG-Face is 4096).')
+@click.option('--queries', default=200, show_default=True, help='Number of probe queries.')
+@click.option('--k', default=10, show_default=True, help='Neighbours compared against exact search.')
+@click.option('--nprobe', default='4,8,16,32', show_default=True, help='IVF nprobe values to sweep.')
+@click.option('--ef', default='32,64,128', show_default=True, help='HNSW ef_search values to sweep.')
+@click.option('--use-gallery', is_flag=True, help='Use the stored gallery instead of synthetic embeddings.')
+@with_appcontext
+def face_index_recall_command(size, dim, queries, k, nprobe, ef, use_gallery):
+    """
+    Compare approximate face indexes against exact search on recall@k and latency.
+
+    A measurement harness to run by hand when tuning nprobe and ef_search, not an automated
+    test: it reports the figures and never fails on low recall.
+    """
+    if use_gallery:
+        visitor_ids, embeddings = load_gallery()
+        if len(visitor_ids) == 0:
+            raise click.ClickException("The stored gallery is empty")
+    else:
+        visitor_ids, embeddings = synthetic_gallery(size, dim)
+    probes = noisy_queries(embeddings, queries)
+    click.echo(f"Gallery: {len(visitor_ids)} x {embeddings.shape[1]}, {len(probes)} queries, k={k}")
+
+    exact = ExactFaceIndex().build(visitor_ids, embeddings)
+    exact_results, _, latency = measure(exact, probes, k)
+    click.echo(f"{'exact':<24} recall@{k}=1.0000  {format_latency(latency)}")
+
+    for value in [int(v) for v in nprobe.split(',') if v]:
+        started = time.perf_counter()
+        index = IVFFaceIndex(nprobe=value).build(visitor_ids, embeddings)
+        build_s = time.perf_counter() - started
+        _, recall, latency = measure(index, probes, k, exact_results)
+        click.echo(f"{'ivf nprobe=' + str(value):<24} recall@{k}={recall:.4f}  "
+                   f"{format_latency(latency)}  build={build_s:.1f} s")
+
+    if hnswlib is None:
+        click.echo("hnswlib is not installed, skipping HNSW")
+        return
+
+    started = time.perf_counter()
+    index = HNSWFaceIndex().build(visitor_ids, embeddings)
+    build_s = time.perf_counter() - started
+    for value in [int(v) for v in ef.split(',') if v]:
+        index.index.set_ef(max(value, k))
+        _, recall, latency = measure(index, probes, k, exact_results)
+        click.echo(f"{'hnsw ef=' + str(value):<24} recall@{k}={recall:.4f}  "
+                   f"{format_latency(latency)}  build={build_s:.1f} s")
+
+def scaling_columns(latency):
+    return ' '.join(f"{latency[stat]:8.3f} ms" for stat in ('mean', 'p50', 'p95', 'p99'))
+
+def default_core_counts():
+    """1, 2, 4, ... up to the machine's core count, which is always included"""
+    cores = os.cpu_count() or 1
+    counts = [2 ** i for i in range(cores.bit_length()) if 2 ** i < cores]
+    return ','.join(str(count) for count in counts + [cores])
+
+@click.command('face-index-scaling')
+@click.option('--sizes', default='10000,100000,1000000', show_default=True, help='Synthetic gallery sizes.')
+@click.option('--cores', default=None, help='Shard process counts to sweep [default: 1, 2, 4, ... up to every core].')
+@click.option('--dim', default=512, show_default=True, help='Embedding dimensions (VGG-Face is 4096: 1M x 4096 float32 needs 16 GB, use --dtype int8).')
+@click.option('--dtype', default='float32', show_default=True, type=click.Choice(['float32', 'float16', 'int8']), help='Gallery storage type.')
+@click.option('--queries', default=100, show_default=True, help='Number of probe queries per configuration.')
+@click.option('--k', default=10, show_default=True, help='Neighbours returned per query.')
+@with_appcontext
+def face_index_scaling_command(sizes, cores, dim, dtype, queries, k):
+    """Measure how sharded exact search scales with worker processes across gallery sizes."""
+    core_counts = [int(v) for v in (cores or default_core_counts()).split(',') if v]
+    click.echo(f"{os.cpu_count()} cores, {dim} dimensions, {dtype}, {queries} queries, k={k}")
+    click.echo(f"{'size':>9} {'processes':>9} {'mean':>11} {'p50':>11} {'p95':>11} {'p99':>11} {'qps':>8} {'speedup':>8} {'exact':>6}")
+
+    for size in [int(v) for v in sizes.split(',') if v]:
+        visitor_ids, embeddings = synthetic_gallery(size, dim)
+        probes = noisy_queries(embeddings, queries)
+        stored, scales = quantize_embeddings(embeddings, dtype)
+        del embeddings
+
+        # Single-threaded scan in this process: the baseline and the expected results
+        exact = ExactFaceIndex().build(visitor_ids, stored, scales)
+        exact_results, _, baseline = measure(exact, probes, k)
+        baseline_ms = baseline['mean']
+        click.echo(f"{size:>9} {'-':>9} {scaling_columns(baseline)} {1000 / baseline_ms:8.1f} {1.0:7.2f}x {'yes':>6}")
+
+        for processes in core_counts:
+            index = ShardedExactFaceIndex(processes).build(visitor_ids, stored, scales)
+            index.search(probes[0], k)  # Start the pool and map the gallery in every worker
+            _, recall, latency = measure(index, probes, k, exact_results)
+            index.release()
+            mean_ms = latency['mean']
+            click.echo(f"{size:>9} {processes:>9} {scaling_columns(latency)} {1000 / mean_ms:8.1f} "
+                       f"{baseline_ms / mean_ms:7.2f}x {'yes' if recall == 1.0 else f'{recall:.4f}':>6}")
+        del exact, stored, scales
+    shard_pool.close()
@@ -0,0 +1,105 @@
+# commands/face_model.py - Export the recognition model to ONNX and check it against DeepFace
+
+import os
+import glob
+import time
+import click
+import numpy as np
+from flask import current_app
+from flask.cli import with_appcontext
+from utils.biometric import (
+    OnnxRecognitionModel, model_registry, onnx_model_path, decode_image, detect_faces,
+    preprocess_face, forward_batch, l2_normalize
+)
+
+def parity_inputs(model, images_dir, limit):
+    """
+    Model inputs to compare the runtimes on: aligned faces from the photos in images_dir,
+    or random images when there are none
+    """
+    paths = sorted(
+        path for path in glob.glob(os.path.join(images_dir, '*'))
+        if path.lower().endswith(('.jpg', '.jpeg', '.png', '.webp'))
+    ) if images_dir else []
+
+    inputs = []
+    for path in paths:
+        with open(path, 'rb') as f:
+            img = decode_image(f.read())
+        if img is not None:
+            inputs += [preprocess_face(face.img, model) for face in detect_faces(img)]
+        if len(inputs) >= limit:
+            break
+
+    if not inputs:
+        rng = np.random.default_rng(0)
+        width, height = model.input_shape
+        inputs = [preprocess_face(rng.integers(0, 256, (height, width, 3), dtype=np.uint8), model) for _ in range(limit)]
+    return np.concatenate(inputs[:limit])
+
+def check_parity(model_name, onnx_path, images_dir, limit, tolerance):
+    """Embed the same inputs with DeepFace and ONNX Runtime and report the distance between them"""
+    keras_model = model_registry.get_recognition_model(model_name, runtime='tensorflow')
+    onnx_model = OnnxRecognitionModel(model_name, onnx_path, current_app.config['FACE_ONNX_THREADS'])
+    batch = parity_inputs(keras_model, images_dir, limit)
+
+    results = {}
+    for name, model in (('tensorflow', keras_model), ('onnx', onnx_model)):
+        forward_batch(model, batch[:1])  # Warm-up
+        started = time.perf_counter()
+        results[name] = l2_normalize(forward_batch(model, batch))
+        elapsed_ms = (time.perf_counter() - started) * 1000
+        click.echo(f"{name:<12} {elapsed_ms:9.1f} ms for {len(batch)} faces ({elapsed_ms / len(batch):.2f} ms/face)")
+
+    distances = 1.0 - np.sum(results['tensorflow'] * results['onnx'], axis=1)
+    click.echo(f"Cosine distance to DeepFace: mean={distances.mean():.2e} max={distances.max():.2e} (tolerance {tolerance:.0e})")
+    return float(distances.max()) <= tolerance
+
+@click.command('export-face-model')
+@click.option('--output', default=None, help='ONNX file to write (defaults to the FACE_ONNX_DIR export).')
+@click.option('--images', 'images_dir', default=None, help='Photos for the parity check (defaults to stored visitor images).')
+@click.option('--limit', default=32, show_default=True, help='Faces used in the parity check.')
+@click.option('--model', 'model_name', default=None, help='DeepFace model to export (defaults to FACE_MODEL).')
+@with_appcontext
+def export_face_model_command(output, images_dir, limit, model_name):
+    """Export the recognition model to ONNX for FACE_RUNTIME = 'onnx', then check it matches DeepFace."""
+    config = current_app.config
+    model_name = model_name or config['FACE_MODEL']
+    path = output or onnx_model_path(config['FACE_ONNX_DIR'], model_name)
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+
+    model = model_registry.get_recognition_model(model_name, runtime='tensorflow')
+    started = time.perf_counter()
+    try:
+        model.model.export(path, format='onnx')
+    except ImportError as e:
+        raise click.ClickException(f"ONNX export needs tf2onnx and onnx (pip install tf2onnx onnx): {e}")
+    click.echo(f"Exported {model_name} to {path} in {time.perf_counter() - started:.1f}s")
+
+    # Never leave an export behind that would change identification results
+    if not check_parity(model_name, path, images_dir or config['IMAGES_DIR'], limit, config['FACE_ONNX_PARITY_TOLERANCE']):
+        os.remove(path)
+        raise click.ClickException("ONNX embeddings differ from DeepFace beyond the tolerance, export removed")
+
+@click.command('check-face-model')
+@click.option('--images', 'images_dir', default=None, help='Photos to compare on (defaults to stored visitor images).')
+@click.option('--limit', default=32, show_default=True, help='Faces to compare.')
+@click.option('--model', 'model_name', default=None, help='DeepFace model to check (defaults to FACE_MODEL).')
+@with_appcontext
+def check_face_model_command(images_dir, limit, model_name):
+    """
+    Compare ONNX Runtime embeddings and speed against DeepFace on the same faces.
+
+    This is a manual check, to run after each export and before setting FACE_RUNTIME=onnx;
+    there is no automated test of ONNX parity.
+    """
+    config = current_app.config
+    model_name = model_name or config['FACE_MODEL']
+    path = onnx_model_path(config['FACE_ONNX_DIR'], model_name)
+    try:
+        passed = check_parity(model_name, path, images_dir or config['IMAGES_DIR'], limit, config['FACE_ONNX_PARITY_TOLERANCE'])
+    except RuntimeError as e:
+        raise click.ClickException(str(e))
+    if not passed:
+        raise click.ClickException("ONNX embeddings differ from DeepFace beyond the tolerance")
+    click.echo("Parity check passed")
@@ -0,0 +1,16 @@
+# commands/gallery.py - Publish memory-mapped gallery snapshots
+
+import click
+from flask.cli import with_appcontext
+from utils.gallery import write_gallery_snapshot
+
+@click.command('snapshot-gallery')
+@click.option('--dtype', type=click.Choice(['float32', 'float16', 'int8']), default=None,
+              help='Storage type of the vectors (defaults to GALLERY_SNAPSHOT_DTYPE).')
+@with_appcontext
+def snapshot_gallery_command(dtype):
+    """Write a new gallery snapshot and publish it to every worker."""
+    meta = write_gallery_snapshot(dtype=dtype)
+    size_mb = meta['size_bytes'] / (1024 * 1024)
+    click.echo(f"Published snapshot {meta['name']}: {meta['count']} embeddings, "
+               f"{meta['dtype']} {meta['layout']} layout, {size_mb:.1f} MB")
@@ -0,0 +1,24 @@
+# commands/inference.py - Run the face inference service on its own
+
+import click
+from flask import current_app
+from flask.cli import with_appcontext
+from utils.inference_service import serve_inference, face_model_names
+
+@click.command('inference-server')
+@click.option('--socket', 'socket_path', default=None, help='Unix socket to listen on (defaults to INFERENCE_SOCKET_PATH).')
+@click.option('--max-pending', default=None, type=int, help='Requests in flight before new ones are refused (defaults to INFERENCE_MAX_PENDING).')
+@with_appcontext
+def inference_server_command(socket_path, max_pending):
+    """Serve face inference to the web workers over a Unix socket."""
+    config = current_app.config
+    serve_inference(
+        socket_path or config['INFERENCE_SOCKET_PATH'],
+        max_pending or config['INFERENCE_MAX_PENDING'],
+        batch_window_ms=config['FACE_BATCH_WINDOW_MS'] if config['FACE_BATCHING_ENABLED'] else None,
+        batch_max_size=config['FACE_BATCH_MAX_SIZE'],
+        model_names=face_model_names(config),
+        runtime=config['FACE_RUNTIME'],
+        onnx_dir=config['FACE_ONNX_DIR'],
+        onnx_threads=config['FACE_ONNX_THREADS']
+    )
@@ -0,0 +1,88 @@
+# commands/probe_benchmark.py - Per-stage latency of the probe pipeline
+
+import os
+import glob
+import time
+import click
+import cv2
+import numpy as np
+from flask import current_app
+from flask.cli import with_appcontext
+from utils.biometric import decode_image, crop_face, detect_faces, represent_image, represent_face_crop, model_registry
+from utils.probe_cache import probe_hash
+from utils.quality import check_probe_quality
+from utils.stats import latency_summary
+
+def read_file(path):
+    with open(path, 'rb') as f:
+        return f.read()
+
+def timed(fn, *args):
+    """Run fn once, returning its result and the elapsed milliseconds"""
+    started = time.perf_counter()
+    result = fn(*args)
+    return result, (time.perf_counter() - started) * 1000
+
+@click.command('probe-benchmark')
+@click.option('--images', 'images_dir', default=None, help='Directory of probe photos (defaults to stored visitor images).')
+@click.option('--limit', default=50, show_default=True, help='Maximum number of images to use.')
+@click.option('--repeat', default=3, show_default=True, help='Passes over the image set.')
+@click.option('--skip-model', is_flag=True, help='Skip the detection and embedding stages.')
+@with_appcontext
+def probe_benchmark_command(images_dir, limit, repeat, skip_model):
+    """Time each stage of identification on real photos: decode, hash, quality gate, detection, embedding."""
+    images_dir = images_dir or current_app.config['IMAGES_DIR']
+    paths = sorted(
+        path for path in glob.glob(os.path.join(images_dir, '*'))
+        if path.lower().endswith(('.jpg', '.jpeg', '.png', '.webp'))
+    )[:limit]
+    if not paths:
+        raise click.ClickException(f"No images found in {images_dir}")
+    if not skip_model:
+        model_registry.warm_up()
+
+    stages = {}
+    def record(stage, ms):
+        stages.setdefault(stage, []).append(ms)
+
+    rejected = 0
+    for _ in range(repeat):
+        for path in paths:
+            image_bytes, ms = timed(read_file, path)
+            record('read', ms)
+
+            full, ms = timed(cv2.imdecode, np.frombuffer(image_bytes, dtype=np.uint8), cv2.IMREAD_COLOR)
+            record('decode (full, cv2)', ms)
+            img, ms = timed(decode_image, image_bytes)
+            record('decode (draft + cap)', ms)
+            if img is None:
+                continue
+
+            (reason, _, face_box), ms = timed(check_probe_quality, img)
+            record('quality gate', ms)
+            if reason is not None:
+                rejected += 1
+            if face_box is not None:
+                _, ms = timed(probe_hash, crop_face(img, face_box, margin=0))
+                record('perceptual hash', ms)
+
+            if skip_model:
+                continue
+            if full is not None:
+                _, ms = timed(detect_faces, full)
+                record('detect (full frame)', ms)
+            _, ms = timed(represent_image, img)
+            record('embed (capped frame)', ms)
+            if face_box is not None:
+                crop = crop_face(img, face_box)
+                _, ms = timed(detect_faces, crop)
+                record('detect (gate crop)', ms)
+                _, ms = timed(represent_face_crop, crop)
+                record('embed (gate crop)', ms)
+
+    click.echo(f"{len(paths)} images x {repeat} passes, {rejected} quality gate rejections")
+    click.echo(f"{'stage':<24} {'runs':>5} {'mean':>10} {'p50':>10} {'p95':>10} {'p99':>10} {'max':>10}")
+    for stage, latencies in stages.items():
+        summary = latency_summary(latencies)
+        columns = ' '.join(f"{summary[stat]:>7.2f} ms" for stat in ('mean', 'p50', 'p95', 'p99', 'max'))
+        click.echo(f"{stage:<24} {summary['count']:>5} {columns}")
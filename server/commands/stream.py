@@ -0,0 +1,43 @@
+# commands/stream.py - Identify visitors on a gate camera stream
+
+import sys
+import json
+import signal
+import threading
+import click
+from flask.cli import with_appcontext
+from utils.stream_identify import run_stream
+
+@click.command('identify-stream')
+@click.argument('source')
+@click.option('--camera', 'camera_id', default='gate', show_default=True, help='Camera name put on every event.')
+@click.option('--sample-fps', default=None, type=float, help='Frames identified per second (defaults to STREAM_SAMPLE_FPS).')
+@click.option('--max-seconds', default=None, type=float, help='Stop after this much of the stream.')
+@click.option('--events', 'events_path', default=None, help='Append events to this JSON lines file instead of stdout.')
+@with_appcontext
+def identify_stream_command(source, camera_id, sample_fps, max_seconds, events_path):
+    """
+    Identify faces on a camera stream and print one JSON event per person seen.
+
+    SOURCE is a camera index, an RTSP or MJPEG URL, or a video file, which is replayed at its
+    own frame timestamps. Banned visitors are also logged as warnings. Latency statistics are
+    printed to stderr when the stream ends or on Ctrl+C.
+    """
+    events_file = open(events_path, 'a') if events_path else sys.stdout
+    stop_event = threading.Event()
+
+    def emit(event):
+        events_file.write(json.dumps(event) + '\n')
+        events_file.flush()
+
+    # Ctrl+C finishes the current frame and still reports the statistics
+    signal.signal(signal.SIGINT, lambda signum, frame: stop_event.set())
+    try:
+        stats = run_stream(source, camera_id, emit, sample_fps, max_seconds, stop_event)
+    except ValueError as e:
+        raise click.ClickException(str(e))
+    finally:
+        if events_path:
+            events_file.close()
+
+    click.echo(json.dumps(stats, indent=2), err=True)
@@ -9,6 +9,15 @@ class Config:
     SECRET_KEY = os.environ.get('SECRET_KEY') or 'hard-to-guess-string'
     SQLALCHEMY_TRACK_MODIFICATIONS = False
     IMAGES_DIR = os.path.join(basedir, 'static/images')
+
+    # Upload limits: the body is checked against Content-Length before it is read, and each image
+    # is counted against MAX_IMAGE_UPLOAD_BYTES as it is read (raw and multipart bodies fit more)
+    MAX_IMAGE_UPLOAD_BYTES = 8 * 1024 * 1024
+    MAX_CONTENT_LENGTH = MAX_IMAGE_UPLOAD_BYTES * 4 // 3 + 64 * 1024  # Room for base64 JSON bodies and form fields
+
+    # Identification probes are processed in memory; keep a sampled copy only for auditing
+    PROBE_AUDIT_SAMPLE_RATE = float(os.environ.get('PROBE_AUDIT_SAMPLE_RATE') or 0.0)  # 0.0 disables, 1.0 keeps every probe
+    PROBE_AUDIT_DIR = os.path.join(basedir, 'probe_audit')
     
     # JWT settings
     JWT_SECRET_KEY = os.environ.get('JWT_SECRET_KEY') or 'jwt-secret-key'
@@ -16,7 +25,114 @@ class Config:
     JWT_TOKEN_LOCATION = ['headers']
     JWT_HEADER_NAME = 'Authorization'
 
-    FACE_RECOGNITION_TOLERANCE = 0.4
+    FACE_RECOGNITION_TOLERANCE = 0.4  # Match threshold for models missing from FACE_MODEL_TOLERANCES
+
+    # Recognition model (a DeepFace name: 'VGG-Face', 'Facenet512', 'SFace', 'ArcFace', ...); embeddings are stored per model.
+    # To switch, set FACE_MODEL to the new model and FACE_MODEL_PREVIOUS to the old one, then run
+    # `flask backfill-embeddings --model <new>`. Identification stays on the old gallery until the new one is complete.
+    FACE_MODEL = os.environ.get('FACE_MODEL') or 'VGG-Face'
+    FACE_MODEL_PREVIOUS = os.environ.get('FACE_MODEL_PREVIOUS') or None
+    FACE_MODEL_TOLERANCES = {  # Cosine distance thresholds, DeepFace's except the stricter VGG-Face one used here
+        'VGG-Face': 0.4, 'Facenet': 0.40, 'Facenet512': 0.30, 'ArcFace': 0.68, 'SFace': 0.593, 'GhostFaceNet': 0.65
+    }
+    FACE_MIGRATION_CHECK_SECONDS = 30  # How often workers check whether the new model's gallery is complete
+    IDENTIFY_BATCH_MAX_IMAGES = 32  # Probe images accepted by one batch identification request
+    IDENTIFY_BATCH_MAX_CONTENT_LENGTH = 24 * 1024 * 1024  # Whole batch request body, however many images it holds
+
+    # Admission control, per process, for requests carrying a face image: registration, identification (sync, batch
+    # and queued as a job) and verification. Identification by national ID is not limited.
+    BIOMETRIC_MAX_CONCURRENT = int(os.environ.get('BIOMETRIC_MAX_CONCURRENT') or 4)
+    BIOMETRIC_MAX_QUEUED = int(os.environ.get('BIOMETRIC_MAX_QUEUED') or 8)  # Requests waiting for a slot; more get 429
+    BIOMETRIC_QUEUE_TIMEOUT_SECONDS = 2.0  # Longest a request waits for a slot before it gets 429
+    BIOMETRIC_RETRY_AFTER_SECONDS = 1
+
+    # Quality gate run on probes before face recognition; failing probes get 422 with a reason
+    QUALITY_GATE_ENABLED = os.environ.get('QUALITY_GATE_ENABLED', '1') == '1'
+    QUALITY_MIN_SHARPNESS = 40.0  # Variance of the Laplacian at half resolution
+    QUALITY_MIN_BRIGHTNESS = 40  # Mean gray level, 0-255
+    QUALITY_MAX_BRIGHTNESS = 220
+    QUALITY_MIN_FACE_PIXELS = 80  # Face width in the original image
+
+    # Cache of recent identification results, keyed by a perceptual hash of the probe
+    PROBE_CACHE_ENABLED = os.environ.get('PROBE_CACHE_ENABLED', '1') == '1'
+    PROBE_CACHE_SIZE = 512
+    PROBE_CACHE_TTL_SECONDS = 10
+    PROBE_CACHE_MAX_HAMMING = 0  # Bits (of 256) a near-duplicate face may differ by; 0 for exact repeats only
+
+    # Registration photos are searched against the gallery first; likely duplicates get 409 unless allow_duplicate is set
+    DUPLICATE_CHECK_ENABLED = os.environ.get('DUPLICATE_CHECK_ENABLED', '1') == '1'
+    DUPLICATE_CHECK_BUDGET_MS = 1500  # Registration goes ahead unchecked if embedding and search take longer
+    DUPLICATE_CHECK_TOLERANCE = None  # Cosine distance for a likely duplicate, defaults to the model's match tolerance
+    DUPLICATE_CHECK_MAX_RESULTS = 5
+    DUPLICATE_CHECK_WORKERS = 2  # Checks run at once; registrations beyond that are refused with 503, not queued
+
+    # Camera stream identification (`flask identify-stream`)
+    STREAM_SAMPLE_FPS = 5  # Frames identified per second; the rest are skipped without decoding
+    STREAM_TRACK_IOU = 0.3  # Overlap needed to continue a face's track in the next sampled frame
+    STREAM_TRACK_MAX_MISSED = 5  # Sampled frames a track survives without its face before it ends
+    STREAM_TRACK_MIN_SIMILARITY = 0.5  # Colour histogram correlation below which an overlapping face starts a new track
+    STREAM_TRACK_RECHECK_SIMILARITY = 0.8  # Below this, a continued identified track is embedded again at once
+    STREAM_RETRY_SECONDS = 1.0  # How often an unmatched face is embedded again
+    STREAM_MAX_ATTEMPTS = 3  # Embeddings of an unmatched face before it is reported unknown
+    STREAM_REVERIFY_SECONDS = 3.0  # How often an identified face is embedded again, in case someone else took its track
+
+    # Asynchronous identification jobs
+    IDENTIFY_JOB_WORKERS = 4  # Searches run at once per process
+    IDENTIFY_JOB_QUEUE_SIZE = 64  # Jobs waiting per process before new ones are refused with 503
+    IDENTIFY_JOB_TTL_SECONDS = 3600  # Finished jobs are deleted after this
+    IDENTIFY_JOB_STREAM_SECONDS = 60  # Longest an event stream stays open
+    EMBEDDING_WORKERS = 2  # Background threads computing embeddings for new registrations
+    FACE_MODEL_WARMUP = os.environ.get('FACE_MODEL_WARMUP', '0') == '1'  # Build models at startup instead of on the first request
+
+    # Recognition model runtime: 'tensorflow' (DeepFace/Keras) or 'onnx' (ONNX Runtime on CPU, needs onnxruntime
+    # and an export from `flask export-face-model`)
+    FACE_RUNTIME = os.environ.get('FACE_RUNTIME') or 'tensorflow'
+    FACE_ONNX_DIR = os.environ.get('FACE_ONNX_DIR') or os.path.join(basedir, 'onnx')
+    FACE_ONNX_THREADS = int(os.environ.get('FACE_ONNX_THREADS', '0'))  # 0 uses every core
+    FACE_ONNX_PARITY_TOLERANCE = 1e-4  # Largest cosine distance allowed between ONNX and DeepFace embeddings
+
+    # Detector and model combinations compared by `flask face-benchmark`
+    FACE_BENCHMARK_DETECTORS = ['opencv', 'ssd', 'mtcnn', 'retinaface']
+    FACE_BENCHMARK_MODELS = ['VGG-Face', 'Facenet512', 'ArcFace', 'SFace']
+
+    # Micro-batching of concurrent embedding requests into one forward pass
+    FACE_BATCHING_ENABLED = os.environ.get('FACE_BATCHING_ENABLED', '1') == '1'
+    FACE_BATCH_WINDOW_MS = 10  # How long the first request in a batch waits for others (5-20 ms is typical)
+    FACE_BATCH_MAX_SIZE = 16
+
+    # Separate process holding the face models, reached by web workers over a Unix socket
+    INFERENCE_SERVICE_ENABLED = os.environ.get('INFERENCE_SERVICE_ENABLED', '0') == '1'
+    INFERENCE_SERVICE_AUTOSTART = os.environ.get('INFERENCE_SERVICE_AUTOSTART', '1') == '1'  # Off when run with `flask inference-server`
+    INFERENCE_SOCKET_PATH = os.environ.get('INFERENCE_SOCKET_PATH') or os.path.join(basedir, 'inference.sock')
+    INFERENCE_TIMEOUT_SECONDS = 5.0
+    INFERENCE_MAX_PENDING = 32  # Requests in flight in the service; more are refused with 503
+
+    # Face index used for 1:N identification
+    FACE_INDEX_BACKEND = os.environ.get('FACE_INDEX_BACKEND') or 'ivf'  # 'exact', 'ivf' or 'hnsw' (needs hnswlib)
+    FACE_INDEX_EXACT_THRESHOLD = 20000  # Galleries smaller than this are always searched exactly
+    # Exact searches split across this many worker processes per web process (0 or 1 scans in the request thread).
+    # Only FACE_INDEX_SHARD_POOLS web processes per host run them, so a host has at most POOLS x SHARDS shard workers.
+    FACE_INDEX_SHARDS = int(os.environ.get('FACE_INDEX_SHARDS', '0'))
+    FACE_INDEX_SHARD_POOLS = int(os.environ.get('FACE_INDEX_SHARD_POOLS', '1'))  # The other web processes scan in the request thread
+    FACE_INDEX_SHARD_LOCK_DIR = os.path.join(basedir, 'shard_pools')  # Lock files of the pools running on this host
+    FACE_INDEX_SHARD_MIN_SIZE = 10000  # Smaller galleries are scanned in one piece, faster than the round trip
+    FACE_INDEX_IVF_NLIST = None  # Number of clusters, defaults to sqrt(gallery size)
+    FACE_INDEX_IVF_NPROBE = 16  # Clusters scanned per query: higher is more accurate, slower
+    FACE_INDEX_HNSW_M = 16
+    FACE_INDEX_HNSW_EF_CONSTRUCTION = 200
+    FACE_INDEX_HNSW_EF_SEARCH = 64  # Candidate list size per query: higher is more accurate, slower
+    WATCHLIST_LATENCY_BUDGET_MS = 5  # Banned-visitor check runs before the full search; slower checks are logged
+
+    # Memory-mapped gallery snapshot shared by every worker on the host
+    GALLERY_SNAPSHOT_ENABLED = os.environ.get('GALLERY_SNAPSHOT_ENABLED', '0') == '1'
+    GALLERY_SNAPSHOT_DIR = os.path.join(basedir, 'gallery_snapshots')
+    GALLERY_SNAPSHOT_DTYPE = os.environ.get('GALLERY_SNAPSHOT_DTYPE') or 'float16'  # 'float32', 'float16' or 'int8'
+
+    # Incremental gallery updates, propagated to every worker through the gallery_changes table
+    GALLERY_SYNC_SECONDS = 2  # How often a worker applies new gallery changes (and looks for a newer snapshot)
+    GALLERY_MAX_PENDING_CHANGES = 5000  # Incremental changes held before the base index is rebuilt
+    GALLERY_CHANGE_RETENTION_HOURS = 24  # Older change log entries are pruned; older snapshots are rewritten on load
+    GALLERY_CHANGE_GAP_SECONDS = 60  # How long a skipped change id is looked for again, in case its transaction commits late
     
     @staticmethod
     def init_app(app):
@@ -1,4 +1,5 @@
-from flask import request, jsonify
+import os
+from flask import current_app, request, jsonify
 from models.user import Admin, SecurityPersonnel, Visitor, UserRole
 from models.visit import Visit, VisitStatus
 from models.ban import Ban
@@ -6,6 +7,13 @@ from models.incident import Incident
 from extensions import db
 from sqlalchemy import desc, func
 from datetime import datetime, date
+from utils.biometric import model_registry, inference_batcher
+from utils.gallery import gallery_status
+from utils.identify_jobs import job_stats
+from utils.admission import biometric_admission
+from utils.probe_cache import probe_cache
+from utils.duplicates import duplicate_check_stats
+from utils.inference_service import get_inference_client, InferenceServiceError
 
 ### 🚀 Helper Function: Fetch Full Data with Related Objects ###
 def detailed_security_dict(security):
@@ -343,3 +351,25 @@ def get_all_bans(page=1, per_page=10, active_only=False):
         "pages": bans.pages,
         "current_page": page
     }), 200
+
+def get_biometric_status():
+    """Report the face models and gallery of the worker serving this request."""
+    status = {
+        "pid": os.getpid(),
+        "model_registry": model_registry.stats(),
+        "inference": inference_batcher.stats(),
+        "gallery": gallery_status(),
+        "identify_jobs": job_stats(),
+        "admission": biometric_admission.stats(),
+        "probe_cache": probe_cache.stats(),
+        "duplicate_check": duplicate_check_stats()
+    }
+
+    # With the inference service enabled, the models live there instead
+    if current_app.config["INFERENCE_SERVICE_ENABLED"]:
+        try:
+            status["inference_service"] = get_inference_client().stats()
+        except InferenceServiceError as e:
+            status["inference_service"] = {"error": str(e)}
+
+    return jsonify(status), 200
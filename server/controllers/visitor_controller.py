@@ -1,15 +1,127 @@
 #controllers/visitor_controller.py
-from flask import jsonify, request
+import os
+import json
+import time
+from flask import current_app, jsonify, request, url_for, Response, stream_with_context
 from sqlalchemy.exc import IntegrityError
 from utils.nationalid import find_visitor_by_national_id
 from utils.auth import verify_secret_code
-from utils.biometric import save_image, find_matching_visitor
-from models.user import Visitor, SecurityPersonnel
+from utils.biometric import (
+    save_image, save_image_stream, remove_image, read_image_stream, decode_base64_image, decode_image, audit_probe,
+    find_matching_visitor, get_stored_embedding, verify_embedding, get_tolerance
+)
+from utils.inference_service import (
+    compute_probe_embedding, compute_face_embeddings, InferenceServiceError, InferenceBusyError, InferenceTimeoutError
+)
+from utils.gallery import get_face_index, get_face_model, check_watchlist, record_gallery_change, apply_gallery_changes
+from utils.embedding_worker import submit_embedding
+from utils.duplicates import find_duplicate_faces
+from utils.quality import check_probe_quality, QUALITY_REASONS
+from utils.probe_cache import cached_match, store_match, probe_cache
+from utils.identify_jobs import submit_job, wait_for_job, queue_depth, JobQueueFullError
+from models.user import Visitor, SecurityPersonnel, EmbeddingStatus, visitor_registrations
 from models.visit import Visit
 from models.ban import Ban
+from models.gallery_change import GalleryChangeType
+from models.identify_job import IdentifyJob, IdentifyJobStatus
 from models.incident import Incident
 from extensions import db
-from datetime import datetime
+from datetime import datetime, timedelta
+
+def inference_error_response(error):
+    """Map an inference service failure to the response a gate client can act on"""
+    if isinstance(error, InferenceBusyError):
+        response = jsonify({"success": False, "message": "Face recognition is busy, try again shortly"})
+        return response, 503, {"Retry-After": "1"}
+    if isinstance(error, InferenceTimeoutError):
+        return jsonify({"success": False, "message": "Face recognition timed out"}), 504
+    return jsonify({"success": False, "message": str(error)}), 503
+
+def probe_quality_response(img):
+    """
+    Run the quality gate on a decoded probe.
+    Returns the error response if it fails (None if it passes or the gate is off) and the face box it found.
+    """
+    if not current_app.config["QUALITY_GATE_ENABLED"]:
+        return None, None
+
+    reason, metrics, face_box = check_probe_quality(img)
+    if reason is None:
+        return None, face_box
+    return (jsonify({
+        "success": False,
+        "message": QUALITY_REASONS[reason],
+        "reason": reason,
+        "quality": metrics
+    }), 422), None
+
+def match_probe(probe_embedding, model_name):
+    """
+    Best matching visitor id and distance for a probe embedded with model_name, checking the
+    banned watchlist first. If the gallery switched models in between, nothing is compared.
+    """
+    if model_name != get_face_model():
+        current_app.logger.warning(f"Face gallery left {model_name} while a probe was being embedded")
+        return None, float('inf')
+
+    best_match_id, distance = check_watchlist(probe_embedding)
+    if best_match_id is None:
+        best_match_id, distance = find_matching_visitor(probe_embedding, get_face_index())
+    return best_match_id, distance
+
+def visitor_identity_dict(visitor, last_ban=None):
+    """Visitor details returned by identification, with the latest ban for banned visitors"""
+    response_data = visitor.to_dict()
+    response_data["is_banned"] = visitor.is_banned
+
+    if visitor.is_banned:
+        if last_ban is None:
+            last_ban = Ban.query.filter_by(visitor_id=visitor.id).order_by(Ban.issued_at.desc()).first()
+        if last_ban:
+            response_data["ban_reason"] = last_ban.reason
+            response_data["banned_by"] = last_ban.issued_by_id  # Can replace with actual security officer name
+    return response_data
+
+def run_identify_job(app, job_id, image_bytes, img, face_box):
+    """Pool worker: identify one probe and store the outcome on its job"""
+    with app.app_context():
+        job = IdentifyJob.query.get(job_id)
+        job.status = IdentifyJobStatus.RUNNING
+        job.started_at = datetime.utcnow()
+        db.session.commit()
+
+        try:
+            phash, cached = cached_match(img, face_box)
+            if cached:
+                best_match_id, distance = cached
+                face_detected = True
+            else:
+                model_name = get_face_model()
+                probe_embedding = compute_probe_embedding(img, image_bytes, face_box, model_name)
+                best_match_id, distance = match_probe(probe_embedding, model_name)
+                face_detected = probe_embedding is not None
+                if face_detected:
+                    store_match(phash, best_match_id, distance)
+
+            visitor = Visitor.query.get(best_match_id) if best_match_id is not None else None
+            job.set_result({
+                "found": visitor is not None,
+                "visitor": visitor_identity_dict(visitor) if visitor else None,
+                "distance": distance if visitor else None,
+                "face_detected": face_detected
+            })
+            job.status = IdentifyJobStatus.DONE
+        except Exception as e:
+            db.session.rollback()
+            job = IdentifyJob.query.get(job_id)
+            job.status = IdentifyJobStatus.FAILED
+            job.error = str(e)
+            app.logger.error(f"Identification job {job_id} failed: {str(e)}")
+
+        job.finished_at = datetime.utcnow()
+        IdentifyJob.prune(datetime.utcnow() - timedelta(seconds=app.config["IDENTIFY_JOB_TTL_SECONDS"]))
+        db.session.commit()
+        return job.status == IdentifyJobStatus.DONE
 
 class VisitorController:
     
@@ -34,7 +146,54 @@ class VisitorController:
                 "message": "A visitor with this phone number or national ID already exists"
             }), 400
 
-        image_path = save_image(data["image_data"]) if data.get("image_data") else None
+        image_path = None
+        if data.get("image_stream"):
+            image_path = save_image_stream(data["image_stream"])
+        elif data.get("image_data"):
+            image_path = save_image(data["image_data"])
+        if (data.get("image_stream") or data.get("image_data")) and not image_path:
+            return jsonify({"success": False, "message": "Invalid image data"}), 400
+
+        # The same face under another identity would make every later search ambiguous
+        duplicate_check, embeddings = None, {}
+        if image_path and current_app.config["DUPLICATE_CHECK_ENABLED"]:
+            with open(os.path.join(current_app.static_folder, image_path), "rb") as f:
+                duplicate_check, embeddings, duplicates = find_duplicate_faces(f.read())
+
+            if duplicate_check == "busy":
+                remove_image(image_path)
+                response = jsonify({"success": False, "message": "Face checks are busy, try again shortly"})
+                return response, 503, {"Retry-After": "1"}
+
+            if duplicates:
+                visitors = {v.id: v for v in Visitor.query.filter(Visitor.id.in_([vid for vid, _ in duplicates]))}
+                candidates = [
+                    {
+                        "id": visitors[visitor_id].uuid,
+                        "first_name": visitors[visitor_id].first_name,
+                        "last_name": visitors[visitor_id].last_name,
+                        "is_banned": visitors[visitor_id].is_banned,
+                        "distance": distance
+                    }
+                    for visitor_id, distance in duplicates if visitor_id in visitors
+                ]
+                allow_duplicate = str(data.get("allow_duplicate", "")).lower() in ("1", "true")
+                banned = any(candidate["is_banned"] for candidate in candidates)
+
+                # A banned visitor can never be registered again under a new identity
+                if candidates and (banned or not allow_duplicate):
+                    remove_image(image_path)
+                    return jsonify({
+                        "success": False,
+                        "message": "This face matches a banned visitor" if banned else
+                                   "This face matches visitors already registered; resend with allow_duplicate to register anyway",
+                        "duplicates": candidates
+                    }), 409
+                if candidates:
+                    current_app.logger.warning(
+                        f"Visitor registered despite matching {[c['id'] for c in candidates]}, "
+                        f"confirmed by security {security_guard.id}"
+                    )
 
         try:
             new_visitor = Visitor(
@@ -42,16 +201,22 @@ class VisitorController:
                 last_name=data["last_name"],
                 phone_number=data["phone_number"],
                 national_id=data["national_id"],
-                image_path=image_path
+                image_path=image_path,
+                embedding_status=EmbeddingStatus.PENDING if image_path else None
             )
 
             db.session.add(new_visitor)
             db.session.commit()
 
+            # Embed the face in the background so registration returns immediately
+            if image_path:
+                submit_embedding(new_visitor.id, embeddings)
+
             return jsonify({
                 "success": True, 
                 "message": "Visitor registered successfully",
-                "visitor_id": new_visitor.id
+                "visitor_id": new_visitor.id,
+                "duplicate_check": duplicate_check
             }), 201
 
         except IntegrityError:
@@ -61,6 +226,71 @@ class VisitorController:
                 "message": "A visitor with this phone number or national ID already exists"
             }), 400
 
+    @staticmethod
+    def update_visitor_photo(data):
+        """
+        Replaces a visitor's photo. The old embedding stays searchable until the new one is ready:
+        the gallery searches pending visitors that still have one, so a rebuild, snapshot or ban
+        while the new photo is embedded does not drop them.
+        """
+        visitor = Visitor.query.filter_by(uuid=data.get("visitor_id")).first()
+        is_valid, security_guard = verify_secret_code(data.get("secret_code"))
+
+        if not visitor:
+            return jsonify({"success": False, "message": "Visitor not found"}), 404
+        if not is_valid:
+            return jsonify({"success": False, "message": "Invalid security code"}), 403
+
+        image_path = None
+        if data.get("image_stream"):
+            image_path = save_image_stream(data["image_stream"])
+        elif data.get("image_data"):
+            image_path = save_image(data["image_data"])
+        if not image_path:
+            return jsonify({"success": False, "message": "Invalid image data"}), 400
+
+        old_image_path = visitor.image_path
+        visitor.image_path = image_path
+        visitor.embedding_status = EmbeddingStatus.PENDING
+        db.session.commit()
+
+        submit_embedding(visitor.id)
+        remove_image(old_image_path)
+        probe_cache.invalidate([visitor.id])
+
+        return jsonify({
+            "success": True,
+            "message": "Visitor photo updated successfully",
+            "visitor": visitor.to_dict()
+        }), 200
+
+    @staticmethod
+    def delete_visitor(visitor_uuid):
+        """
+        Deletes a visitor together with their visits, bans, incidents and photo.
+        """
+        visitor = Visitor.query.filter_by(uuid=str(visitor_uuid)).first()
+        if not visitor:
+            return jsonify({"success": False, "message": "Visitor not found"}), 404
+
+        image_path = visitor.image_path
+
+        Incident.query.filter_by(visitor_id=visitor.id).delete()
+        Ban.query.filter_by(visitor_id=visitor.id).delete()
+        Visit.query.filter_by(visitor_id=visitor.id).delete()
+        db.session.execute(visitor_registrations.delete().where(visitor_registrations.c.visitor_id == visitor.id))
+        record_gallery_change(visitor.id)
+        visitor_id = visitor.id
+        db.session.delete(visitor)
+        db.session.commit()
+
+        # Other workers drop the visitor on their next gallery sync
+        apply_gallery_changes()
+        probe_cache.invalidate([visitor_id])
+        remove_image(image_path)
+
+        return jsonify({"success": True, "message": "Visitor deleted successfully"}), 200
+
     
     @staticmethod
     def identify_visitor(data):
@@ -72,29 +302,272 @@ class VisitorController:
         if "national_id" in data:
             visitor_info = Visitor.query.filter_by(national_id=data["national_id"]).first()  # 🔴 FIX: Removed `.filter_by(is_banned=False)`
 
-        elif "image_data" in data:
-            image_path = save_image(data["image_data"])
-            visitors = Visitor.query.all()
-            best_match, _ = find_matching_visitor(image_path, visitors)
-            if best_match:
-                visitor_info = best_match.to_dict()
+        elif "image_stream" in data or "image_data" in data:
+            try:
+                if "image_stream" in data:
+                    image_bytes = read_image_stream(data["image_stream"])
+                else:
+                    image_bytes = decode_base64_image(data["image_data"])
+            except (TypeError, ValueError):
+                return jsonify({"success": False, "message": "Invalid image data"}), 400
+
+            audit_probe(image_bytes)
+
+            # Decoded once, already downscaled and upright; the cache, the gate and the model share it
+            img = decode_image(image_bytes)
+            if img is None:
+                return jsonify({"success": False, "message": "Invalid image data"}), 400
+
+            # Reject unusable photos before any model runs, so the guard can retake at once
+            rejection, face_box = probe_quality_response(img)
+            if rejection:
+                return rejection
+
+            # A retried photo of the same face reuses the recent result
+            phash, cached = cached_match(img, face_box)
+            if cached:
+                best_match_id, _ = cached
+            else:
+                model_name = get_face_model()
+                try:
+                    # Only the face the gate found is passed on to detection and embedding
+                    probe_embedding = compute_probe_embedding(img, image_bytes, face_box, model_name)
+                except InferenceServiceError as e:
+                    return inference_error_response(e)
+
+                # Banned visitors are checked first against their own small index
+                best_match_id, distance = match_probe(probe_embedding, model_name)
+                if probe_embedding is not None:
+                    store_match(phash, best_match_id, distance)
+
+            if best_match_id is not None:
+                visitor_info = Visitor.query.get(best_match_id)
 
         if visitor_info:
             #  Include ban status & history
-            response_data = visitor_info.to_dict()
-            response_data["is_banned"] = visitor_info.is_banned
-
-            if visitor_info.is_banned:
-                last_ban = Ban.query.filter_by(visitor_id=visitor_info.id).order_by(Ban.issued_at.desc()).first()
-                if last_ban:
-                    response_data["ban_reason"] = last_ban.reason
-                    response_data["banned_by"] = last_ban.issued_by_id  # Can replace with actual security officer name
-
-            return jsonify({"success": True, "visitor": response_data}), 200
+            return jsonify({"success": True, "visitor": visitor_identity_dict(visitor_info)}), 200
         
         return jsonify({"success": False, "message": "Visitor not found"}), 404
 
+    @staticmethod
+    def verify_visitor(visitor_uuid, data):
+        """
+        1:1 verification: checks that a probe face belongs to a visitor already identified
+        by national ID or badge, comparing against that visitor's stored embedding only.
+        """
+        visitor = Visitor.query.filter_by(uuid=str(visitor_uuid)).first()
+        if not visitor:
+            return jsonify({"success": False, "message": "Visitor not found"}), 404
+
+        model_name = get_face_model()
+        stored_embedding = get_stored_embedding(visitor, model_name)
+        if stored_embedding is None:
+            if visitor.embedding_status == EmbeddingStatus.PENDING:
+                return jsonify({"success": False, "message": "The visitor's photo is still being processed"}), 409
+            return jsonify({"success": False, "message": "Visitor has no enrolled face"}), 409
+
+        try:
+            if data.get("image_stream"):
+                image_bytes = read_image_stream(data["image_stream"])
+            elif data.get("image_data"):
+                image_bytes = decode_base64_image(data["image_data"])
+            else:
+                return jsonify({"success": False, "message": "No image provided"}), 400
+        except (TypeError, ValueError):
+            return jsonify({"success": False, "message": "Invalid image data"}), 400
+
+        audit_probe(image_bytes)
+        img = decode_image(image_bytes)
+        if img is None:
+            return jsonify({"success": False, "message": "Invalid image data"}), 400
+        rejection, face_box = probe_quality_response(img)
+        if rejection:
+            return rejection
+
+        try:
+            probe_embedding = compute_probe_embedding(img, image_bytes, face_box, model_name)
+        except InferenceServiceError as e:
+            return inference_error_response(e)
+        if probe_embedding is None:
+            return jsonify({"success": False, "message": QUALITY_REASONS["no_face"], "reason": "no_face"}), 422
+
+        match, distance = verify_embedding(probe_embedding, stored_embedding, model_name=model_name)
+        return jsonify({
+            "success": True,
+            "match": match,
+            "distance": distance,
+            "tolerance": get_tolerance(model_name),
+            "visitor": visitor_identity_dict(visitor) if match else {"id": visitor.uuid}
+        }), 200
+
+    @staticmethod
+    def identify_visitors_batch(data):
+        """
+        Identifies every face in several probe images or one group photo.
+        All faces are embedded in one batched pass and matched individually.
+        """
+        images = data.get("images", [])
+        if not isinstance(images, list) or not all(isinstance(image_data, str) for image_data in images):
+            return jsonify({"success": False, "message": "images must be a list of base64-encoded images"}), 400
+
+        try:
+            images_bytes = [read_image_stream(stream) for stream in data.get("image_streams", [])]
+            if data.get("image_stream"):
+                images_bytes.append(read_image_stream(data["image_stream"]))
+            images_bytes += [decode_base64_image(image_data) for image_data in images]
+            if data.get("image_data"):
+                images_bytes.append(decode_base64_image(data["image_data"]))
+        except (TypeError, ValueError):
+            return jsonify({"success": False, "message": "Invalid image data"}), 400
+
+        if not images_bytes:
+            return jsonify({"success": False, "message": "No images provided"}), 400
+        max_images = current_app.config["IDENTIFY_BATCH_MAX_IMAGES"]
+        if len(images_bytes) > max_images:
+            return jsonify({"success": False, "message": f"At most {max_images} images per batch"}), 400
+
+        for image_bytes in images_bytes:
+            audit_probe(image_bytes)
+        model_name = get_face_model()
+        try:
+            detections = compute_face_embeddings(images_bytes, model_name)
+        except InferenceServiceError as e:
+            return inference_error_response(e)
+
+        matches = [
+            [(box, *match_probe(embedding, model_name)) for box, embedding in faces] if faces is not None else None
+            for faces in detections
+        ]
+
+        # Load every matched visitor, and the latest ban of the banned ones, in two queries
+        matched_ids = {visitor_id for faces in matches if faces for _, visitor_id, _ in faces if visitor_id is not None}
+        visitors = {visitor.id: visitor for visitor in Visitor.query.filter(Visitor.id.in_(matched_ids))} if matched_ids else {}
+        last_bans = {}
+        banned_ids = [visitor.id for visitor in visitors.values() if visitor.is_banned]
+        if banned_ids:
+            for ban in Ban.query.filter(Ban.visitor_id.in_(banned_ids)).order_by(Ban.issued_at):
+                last_bans[ban.visitor_id] = ban
+
+        results, face_count, matched_count = [], 0, 0
+        for position, faces in enumerate(matches):
+            if faces is None:
+                results.append({"index": position, "error": "Invalid image data", "faces": []})
+                continue
+
+            image_faces = []
+            for box, visitor_id, distance in faces:
+                visitor = visitors.get(visitor_id)
+                image_faces.append({
+                    "box": box,
+                    "visitor": visitor_identity_dict(visitor, last_bans.get(visitor.id)) if visitor else None,
+                    "distance": distance if visitor else None
+                })
+            face_count += len(image_faces)
+            matched_count += sum(1 for face in image_faces if face["visitor"])
+            results.append({"index": position, "faces": image_faces})
+
+        return jsonify({
+            "success": True,
+            "images": results,
+            "face_count": face_count,
+            "matched_count": matched_count
+        }), 200
+
     
+    @staticmethod
+    def create_identify_job(data):
+        """
+        Queues a face identification and returns its job at once, so the search
+        does not hold a web worker. Refused with 503 when the queue is full.
+        """
+        try:
+            if data.get("image_stream"):
+                image_bytes = read_image_stream(data["image_stream"])
+            elif data.get("image_data"):
+                image_bytes = decode_base64_image(data["image_data"])
+            else:
+                return jsonify({"success": False, "message": "No image provided"}), 400
+        except (TypeError, ValueError):
+            return jsonify({"success": False, "message": "Invalid image data"}), 400
+
+        audit_probe(image_bytes)
+        img = decode_image(image_bytes)
+        if img is None:
+            return jsonify({"success": False, "message": "Invalid image data"}), 400
+        rejection, face_box = probe_quality_response(img)
+        if rejection:
+            return rejection
+
+        job = IdentifyJob()
+        db.session.add(job)
+        db.session.commit()
+
+        try:
+            submit_job(job.id, run_identify_job, current_app._get_current_object(), job.id, image_bytes, img, face_box)
+        except JobQueueFullError as e:
+            db.session.delete(job)
+            db.session.commit()
+            return jsonify({"success": False, "message": str(e)}), 503, {"Retry-After": "1"}
+
+        status_url = url_for("visitor.get_identify_job", job_id=job.id)
+        return jsonify({
+            "success": True,
+            "job_id": job.id,
+            "status": job.status.value,
+            "queue_depth": queue_depth(),
+            "status_url": status_url,
+            "events_url": url_for("visitor.stream_identify_job", job_id=job.id)
+        }), 202, {"Location": status_url}
+
+    @staticmethod
+    def get_identify_job(job_id):
+        """
+        Returns the current state of an identification job, with its result once done.
+        """
+        job = IdentifyJob.query.get(job_id)
+        if not job:
+            return jsonify({"success": False, "message": "Job not found"}), 404
+        return jsonify({"success": True, "job": job.to_dict()}), 200
+
+    @staticmethod
+    def stream_identify_job(job_id):
+        """
+        Streams an identification job's status changes as server-sent events,
+        ending with its result (or after IDENTIFY_JOB_STREAM_SECONDS).
+
+        Each open stream holds a worker for up to IDENTIFY_JOB_STREAM_SECONDS, so it needs an
+        async server (gunicorn -k gevent); on sync workers, clients should poll get_identify_job.
+        """
+        if not IdentifyJob.query.get(job_id):
+            return jsonify({"success": False, "message": "Job not found"}), 404
+
+        deadline = time.monotonic() + current_app.config["IDENTIFY_JOB_STREAM_SECONDS"]
+
+        def events():
+            last_status, last_sent = None, time.monotonic()
+            while True:
+                db.session.expire_all()
+                job = IdentifyJob.query.get(job_id)
+                if job is None:
+                    return
+                if job.status != last_status:
+                    last_status, last_sent = job.status, time.monotonic()
+                    yield f"event: {job.status.value}\ndata: {json.dumps(job.to_dict())}\n\n"
+                if job.is_finished or time.monotonic() > deadline:
+                    return
+
+                # Jobs run by this process wake us up directly; others are polled
+                wait_for_job(job_id, 0.25)
+                if time.monotonic() - last_sent > 15:
+                    last_sent = time.monotonic()
+                    yield ": keep-alive\n\n"
+
+        return Response(
+            stream_with_context(events()),
+            mimetype="text/event-stream",
+            headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+        )
+
     @staticmethod
     def ban_visitor(data):
         """
@@ -121,8 +594,12 @@ class VisitorController:
         )
 
         db.session.add(ban_record)
+        record_gallery_change(visitor.id, GalleryChangeType.BAN)
         db.session.commit()
 
+        # Other workers pick the ban up on their next gallery sync
+        apply_gallery_changes()
+
         return jsonify({"success": True, "message": "Visitor banned successfully"}), 200
 
     @staticmethod
@@ -146,7 +623,9 @@ class VisitorController:
             active_ban.lifted_at = db.func.now()
             active_ban.lifted_by_id = security_guard.id
 
+        record_gallery_change(visitor.id, GalleryChangeType.BAN)
         db.session.commit()
+        apply_gallery_changes()
 
         return jsonify({"success": True, "message": "Visitor unbanned successfully"}), 200
 
@@ -0,0 +1,42 @@
+# models/face_embedding.py - Stored face embeddings used for identification
+
+import datetime
+import numpy as np
+from extensions import db
+
+class FaceEmbedding(db.Model):
+    __tablename__ = 'face_embeddings'
+    __table_args__ = (
+        db.UniqueConstraint('visitor_id', 'model_name', name='uq_face_embedding_visitor_model'),
+    )
+
+    id = db.Column(db.Integer, primary_key=True)
+    visitor_id = db.Column(db.Integer, db.ForeignKey('visitors.id'), nullable=False, index=True)
+    model_name = db.Column(db.String(50), nullable=False, index=True)
+    dimensions = db.Column(db.Integer, nullable=False)
+    vector = db.Column(db.LargeBinary, nullable=False)  # float32, L2-normalized
+    created_at = db.Column(db.DateTime, default=datetime.datetime.utcnow)
+    updated_at = db.Column(db.DateTime, default=datetime.datetime.utcnow, onupdate=datetime.datetime.utcnow, index=True)
+
+    # Relationships
+    visitor = db.relationship('Visitor', back_populates='face_embeddings')
+
+    def set_embedding(self, embedding):
+        """Store an embedding as raw float32 bytes."""
+        embedding = np.asarray(embedding, dtype=np.float32).ravel()
+        self.dimensions = embedding.shape[0]
+        self.vector = embedding.tobytes()
+
+    def get_embedding(self):
+        """Return the stored embedding as a float32 NumPy array."""
+        return np.frombuffer(self.vector, dtype=np.float32)
+
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'visitor_id': self.visitor_id,
+            'model_name': self.model_name,
+            'dimensions': self.dimensions,
+            'created_at': self.created_at.isoformat() if self.created_at else None,
+            'updated_at': self.updated_at.isoformat() if self.updated_at else None
+        }
@@ -0,0 +1,25 @@
+# models/gallery_change.py - Change log that keeps every worker's face gallery in sync
+
+import enum
+import datetime
+from extensions import db
+
+class GalleryChangeType(enum.Enum):
+    EMBEDDING = "embedding"  # A visitor's embedding was added, replaced or removed
+    BAN = "ban"  # A visitor was banned or unbanned
+
+class GalleryChange(db.Model):
+    __tablename__ = 'gallery_changes'
+
+    id = db.Column(db.Integer, primary_key=True)
+    visitor_id = db.Column(db.Integer, nullable=False, index=True)  # No foreign key: deleted visitors are logged too
+    change_type = db.Column(db.Enum(GalleryChangeType), nullable=False, default=GalleryChangeType.EMBEDDING)
+    created_at = db.Column(db.DateTime, default=datetime.datetime.utcnow, nullable=False, index=True)
+
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'visitor_id': self.visitor_id,
+            'change_type': self.change_type.value,
+            'created_at': self.created_at.isoformat() if self.created_at else None
+        }
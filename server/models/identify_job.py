@@ -0,0 +1,58 @@
+# models/identify_job.py - Asynchronous identification requests and their results
+
+import enum
+import json
+import uuid
+import datetime
+from extensions import db
+
+class IdentifyJobStatus(enum.Enum):
+    QUEUED = "queued"
+    RUNNING = "running"
+    DONE = "done"
+    FAILED = "failed"
+
+class IdentifyJob(db.Model):
+    __tablename__ = 'identify_jobs'
+
+    id = db.Column(db.String(36), primary_key=True, default=lambda: str(uuid.uuid4()))
+    status = db.Column(db.Enum(IdentifyJobStatus), nullable=False, default=IdentifyJobStatus.QUEUED, index=True)
+    result = db.Column(db.Text, nullable=True)  # JSON
+    error = db.Column(db.Text, nullable=True)
+    created_at = db.Column(db.DateTime, default=datetime.datetime.utcnow, nullable=False, index=True)
+    started_at = db.Column(db.DateTime, nullable=True)
+    finished_at = db.Column(db.DateTime, nullable=True)
+
+    @property
+    def is_finished(self):
+        return self.status in (IdentifyJobStatus.DONE, IdentifyJobStatus.FAILED)
+
+    @staticmethod
+    def prune(older_than):
+        """Delete finished jobs created before a cutoff; the caller commits"""
+        IdentifyJob.query.filter(
+            IdentifyJob.created_at < older_than,
+            IdentifyJob.status.in_([IdentifyJobStatus.DONE, IdentifyJobStatus.FAILED])
+        ).delete(synchronize_session=False)
+
+    def set_result(self, result):
+        self.result = json.dumps(result)
+
+    def to_dict(self):
+        queue_seconds = run_seconds = None
+        if self.started_at:
+            queue_seconds = (self.started_at - self.created_at).total_seconds()
+            if self.finished_at:
+                run_seconds = (self.finished_at - self.started_at).total_seconds()
+
+        return {
+            'id': self.id,
+            'status': self.status.value,
+            'result': json.loads(self.result) if self.result else None,
+            'error': self.error,
+            'created_at': self.created_at.isoformat() if self.created_at else None,
+            'started_at': self.started_at.isoformat() if self.started_at else None,
+            'finished_at': self.finished_at.isoformat() if self.finished_at else None,
+            'queue_seconds': queue_seconds,
+            'run_seconds': run_seconds
+        }
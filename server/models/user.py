@@ -16,6 +16,11 @@ class UserRole(enum.Enum):
     SECURITY = "security"
     ADMIN = "admin"
 
+class EmbeddingStatus(enum.Enum):
+    PENDING = "pending"
+    READY = "ready"
+    FAILED = "failed"
+
 class User(db.Model):
     __tablename__ = 'users'
     
@@ -52,11 +57,14 @@ class Visitor(User):
     national_id = db.Column(db.String(256), unique=True, nullable=False, index=True)  #  Ensured non-null & indexed
     image_path = db.Column(db.String(255), unique=True, nullable=True)
     is_banned = db.Column(db.Boolean, default=False, index=True)  #  Indexed for frequent filtering
+    embedding_status = db.Column(db.Enum(EmbeddingStatus), nullable=True, index=True)  #  None when there is no photo
 
     # Relationships
     visits = db.relationship('Visit', back_populates='visitor', lazy='dynamic')
     bans = db.relationship('Ban', back_populates='visitor', lazy='dynamic')
     incidents = db.relationship('Incident', back_populates='visitor', lazy='dynamic')
+    face_embeddings = db.relationship('FaceEmbedding', back_populates='visitor', lazy='dynamic',
+                                      cascade='all, delete-orphan')
     
     __mapper_args__ = {
         'polymorphic_identity': UserRole.VISITOR,
@@ -66,7 +74,8 @@ class Visitor(User):
         base_dict = super().to_dict()
         base_dict.update({
             'is_banned': self.is_banned,
-            'image_path': self.image_path
+            'image_path': self.image_path,
+            'embedding_status': self.embedding_status.value if self.embedding_status else None
         })
         return base_dict
 
@@ -13,7 +13,8 @@ from controllers.admin_controller import (
     get_all_visits,
     get_all_incidents,
     get_all_bans,
-    get_admin_dashboard_summary
+    get_admin_dashboard_summary,
+    get_biometric_status
 )
 from utils.auth import is_admin
 
@@ -150,4 +151,14 @@ def get_all_bans_route():
     return get_all_bans(page, per_page, active_only)
 
 # Admin Dashboard Summary Route
-admin_bp.route('/dashboard/summary', methods=['GET'])(get_admin_dashboard_summary)
\ No newline at end of file
+admin_bp.route('/dashboard/summary', methods=['GET'])(get_admin_dashboard_summary)
+
+# Biometrics Status Route
+@admin_bp.route("/biometrics/status", methods=["GET"])
+@jwt_required()
+def get_biometric_status_route():
+    """Get face model load times and memory usage for this worker"""
+    if not is_admin():
+        return jsonify({"error": "Access denied. Admins only."}), 403
+    
+    return get_biometric_status()
@@ -1,13 +1,61 @@
 # routes/visitor_routes.py
-from flask import Blueprint, request, jsonify
+from flask import Blueprint, current_app, request, jsonify
+from flask_jwt_extended import jwt_required
 from sqlalchemy.exc import IntegrityError
+from werkzeug.exceptions import RequestEntityTooLarge
 from controllers.visitor_controller import VisitorController
 from models.user import Visitor
+from utils.auth import is_admin
+from utils.admission import limit_biometric
 
 visitor_bp = Blueprint("visitor", __name__)
 
+def get_request_data():
+    """
+    Read request fields and the visitor image from any supported body format.
+
+    - application/json: fields plus "image_data" as a base64 string (legacy clients)
+    - multipart/form-data: form fields plus the image file in the "image" part
+      (and, for batch identification, any number of "images" parts)
+    - image/*: the raw image as the body, fields in the query string
+
+    Uploaded images are passed on as an unread stream under "image_stream".
+    """
+    if request.mimetype == "multipart/form-data":
+        data = request.form.to_dict()
+        image = request.files.get("image")
+        if image:
+            data["image_stream"] = image.stream
+        images = request.files.getlist("images")
+        if images:
+            data["image_streams"] = [image.stream for image in images]
+        return data
+
+    if request.mimetype.startswith("image/"):
+        data = request.args.to_dict()
+        data["image_stream"] = request.stream
+        return data
+
+    return request.get_json(silent=True) or {}
+
+@visitor_bp.errorhandler(RequestEntityTooLarge)
+def request_too_large(error):
+    """Reject oversized uploads: by Content-Length before the body is read, or once an image passes the limit"""
+    config = current_app.config
+    if request.endpoint == "visitor.identify_visitors_batch" and request.content_length \
+            and request.content_length > config["IDENTIFY_BATCH_MAX_CONTENT_LENGTH"]:
+        limit_mb = config["IDENTIFY_BATCH_MAX_CONTENT_LENGTH"] // (1024 * 1024)
+        return jsonify({"success": False, "message": f"Batch upload exceeds the {limit_mb} MB limit"}), 413
+
+    limit_mb = config["MAX_IMAGE_UPLOAD_BYTES"] // (1024 * 1024)
+    return jsonify({
+        "success": False,
+        "message": f"Image upload exceeds the {limit_mb} MB limit"
+    }), 413
+
 #Register a new visitor
 @visitor_bp.route("/register", methods=["POST"])
+@limit_biometric
 def register_visitor():
     """
     Register a new visitor.
@@ -19,10 +67,18 @@ def register_visitor():
         "phone_number": "123456789",
         "national_id": "12345678",
         "image_data": "base64-encoded image",
-        "secret_code": "SEC123"
+        "secret_code": "SEC123",
+        "allow_duplicate": false
     }
+
+    Or multipart/form-data with the same fields and the photo as an "image" file part.
+
+    The photo is searched against registered faces first. Likely duplicates are returned
+    with 409 and their distances; set allow_duplicate to register anyway (never allowed
+    when a match is banned). While every check worker is busy the registration is refused
+    with 503 and Retry-After.
     """
-    data = request.json
+    data = get_request_data()
 
     try:
         # Check for existing visitor with same phone number
@@ -39,14 +95,50 @@ def register_visitor():
             "success": False, 
             "message": "A visitor with this phone number or national ID already exists"
         }), 400
+    except RequestEntityTooLarge as e:
+        return request_too_large(e)
     except Exception as e:
         return jsonify({
             "success": False, 
             "message": f"Registration failed: {str(e)}"
         }), 500
 
+#Replace a visitor's photo
+@visitor_bp.route("/photo", methods=["PUT"])
+def update_visitor_photo():
+    """
+    Replace a visitor's photo and re-compute their face embedding.
+
+    Request JSON:
+    {
+        "visitor_id": "550e8400-e29b-41d4-a716-446655440000",
+        "image_data": "base64-encoded image",
+        "secret_code": "SEC123"
+    }
+
+    Or multipart/form-data with the same fields and the photo as an "image" file part.
+    """
+    data = get_request_data()
+    return VisitorController.update_visitor_photo(data)
+
+#Delete a visitor (admins only)
+@visitor_bp.route("/<uuid:visitor_uuid>", methods=["DELETE"])
+@jwt_required()
+def delete_visitor(visitor_uuid):
+    """
+    Delete a visitor and all of their records.
+
+    URL Parameter:
+    visitor_uuid - The UUID of the visitor
+    """
+    if not is_admin():
+        return jsonify({"error": "Access denied. Admins only."}), 403
+
+    return VisitorController.delete_visitor(visitor_uuid)
+
 #Identify an existing visitor
 @visitor_bp.route("/identify", methods=["POST"])
+@limit_biometric
 def identify_visitor():
     """
     Identify a visitor using either National ID or Face Image.
@@ -56,10 +148,95 @@ def identify_visitor():
         "national_id": "12345678"   # OR
         "image_data": "base64-encoded image"
     }
+
+    Or multipart/form-data with an "image" file part, or a raw image/jpeg body.
+    Face searches over the BIOMETRIC_MAX_CONCURRENT limit get 429 with Retry-After.
     """
-    data = request.json
+    data = get_request_data()
     return VisitorController.identify_visitor(data)
 
+#Verify that a face belongs to a known visitor
+@visitor_bp.route("/<uuid:visitor_uuid>/verify", methods=["POST"])
+@limit_biometric
+def verify_visitor(visitor_uuid):
+    """
+    1:1 check of a probe face against one visitor, for when the guard already
+    has their national ID or badge. Much cheaper than a 1:N identification.
+
+    Request JSON:
+    {
+        "image_data": "base64-encoded image"
+    }
+
+    Or multipart/form-data with an "image" file part, or a raw image/jpeg body.
+    Returns the match decision and the cosine distance to the visitor's stored face.
+    """
+    data = get_request_data()
+    return VisitorController.verify_visitor(visitor_uuid, data)
+
+#Identify every face in several images or a group photo
+@visitor_bp.route("/identify/batch", methods=["POST"])
+@limit_biometric
+def identify_visitors_batch():
+    """
+    Identify every face in a batch of probe images, or in one group photo.
+
+    Request JSON:
+    {
+        "images": ["base64-encoded image", ...]
+    }
+
+    Or multipart/form-data with one "images" file part per photo, or a raw
+    image/jpeg body holding a single group photo.
+
+    Each face is returned with its bounding box and matched visitor (or null).
+    """
+    # Several probes need more than one upload's room, but the body is held (and decoded) in memory whole
+    request.max_content_length = current_app.config["IDENTIFY_BATCH_MAX_CONTENT_LENGTH"]
+
+    data = get_request_data()
+    return VisitorController.identify_visitors_batch(data)
+
+#Identify asynchronously: queue a job, then poll it or stream its events
+@visitor_bp.route("/identify/jobs", methods=["POST"])
+@limit_biometric
+def create_identify_job():
+    """
+    Queue a face identification and return a job id immediately (202).
+
+    Request JSON:
+    {
+        "image_data": "base64-encoded image"
+    }
+
+    Or multipart/form-data with an "image" file part, or a raw image/jpeg body.
+    Follow up with GET /identify/jobs/<job_id> or GET /identify/jobs/<job_id>/events.
+    """
+    data = get_request_data()
+    return VisitorController.create_identify_job(data)
+
+@visitor_bp.route("/identify/jobs/<string:job_id>", methods=["GET"])
+def get_identify_job(job_id):
+    """
+    Get the status of an identification job, and its result once done.
+    
+    URL Parameter:
+    job_id - The job id returned when the job was queued
+    """
+    return VisitorController.get_identify_job(job_id)
+
+@visitor_bp.route("/identify/jobs/<string:job_id>/events", methods=["GET"])
+def stream_identify_job(job_id):
+    """
+    Stream an identification job's status changes as server-sent events.
+    Needs an async worker (gunicorn -k gevent): a sync worker is tied up while the stream
+    is open. Poll GET /identify/jobs/<job_id> instead on sync workers.
+    
+    URL Parameter:
+    job_id - The job id returned when the job was queued
+    """
+    return VisitorController.stream_identify_job(job_id)
+
 #Ban a visitor
 @visitor_bp.route("/ban", methods=["POST"])
 def ban_visitor():
@@ -0,0 +1,107 @@
+# utils/admission.py - Admission control for biometric endpoints
+
+import time
+import threading
+from collections import deque
+from functools import wraps
+from flask import current_app, jsonify, request
+from utils.stats import percentiles
+
+class AdmissionController:
+    """
+    Caps how many biometric requests a process works on at once. Requests over the cap wait
+    in a short bounded queue; once that is full, or the wait times out, they are turned away
+    immediately so a burst of face searches can't starve the rest of the API.
+    """
+
+    def __init__(self):
+        self._condition = threading.Condition()
+        self._active = 0
+        self._waiting = 0
+        self._admitted = 0
+        self._rejected = 0
+        self._wait_ms = deque(maxlen=1000)
+
+    def acquire(self, max_concurrent, max_queued, timeout):
+        """
+        Take a slot, waiting up to timeout seconds in the queue if all are busy
+
+        Returns:
+            bool: True if admitted (the caller must release), False if rejected
+        """
+        started = time.perf_counter()
+        with self._condition:
+            if self._active >= max_concurrent:
+                if self._waiting >= max_queued:
+                    self._rejected += 1
+                    return False
+
+                self._waiting += 1
+                try:
+                    admitted = self._condition.wait_for(lambda: self._active < max_concurrent, timeout)
+                finally:
+                    self._waiting -= 1
+                if not admitted:
+                    self._rejected += 1
+                    return False
+
+            self._active += 1
+            self._admitted += 1
+            self._wait_ms.append((time.perf_counter() - started) * 1000)
+            return True
+
+    def release(self):
+        with self._condition:
+            self._active -= 1
+            self._condition.notify()
+
+    def stats(self):
+        config = current_app.config
+        return {
+            'max_concurrent': config['BIOMETRIC_MAX_CONCURRENT'],
+            'max_queued': config['BIOMETRIC_MAX_QUEUED'],
+            'active': self._active,
+            'waiting': self._waiting,
+            'admitted': self._admitted,
+            'rejected': self._rejected,
+            'wait_ms': percentiles(self._wait_ms)
+        }
+
+biometric_admission = AdmissionController()
+
+FIELDS_ONLY_BODY_BYTES = 1024  # JSON bodies this small hold form fields, never a base64 image
+
+def _carries_image():
+    """
+    Whether the request carries a face image, decided from its headers and query string so
+    the body is not read before admission. Identification by national ID stays unlimited:
+    a JSON body too small for an image, or national_id in the query string.
+    """
+    if request.mimetype == "multipart/form-data" or request.mimetype.startswith("image/"):
+        return True
+    if "national_id" in request.args:
+        return False
+    return request.content_length is None or request.content_length > FIELDS_ONLY_BODY_BYTES
+
+def limit_biometric(view):
+    """
+    Route decorator applying admission control to biometric work.
+    Requests over capacity get 429 with Retry-After before their image is read.
+    """
+    @wraps(view)
+    def wrapped(*args, **kwargs):
+        if not _carries_image():
+            return view(*args, **kwargs)
+
+        config = current_app.config
+        if not biometric_admission.acquire(
+            config['BIOMETRIC_MAX_CONCURRENT'], config['BIOMETRIC_MAX_QUEUED'], config['BIOMETRIC_QUEUE_TIMEOUT_SECONDS']
+        ):
+            response = jsonify({"success": False, "message": "Too many face recognition requests, try again shortly"})
+            return response, 429, {"Retry-After": str(config['BIOMETRIC_RETRY_AFTER_SECONDS'])}
+
+        try:
+            return view(*args, **kwargs)
+        finally:
+            biometric_admission.release()
+    return wrapped
@@ -1,15 +1,47 @@
 # utils/biometric.py - Utilities for image storage and facial recognition
 
 import os
+import io
 import uuid
 import base64
+import time
+import random
+import queue
+import resource
+import threading
+import weakref
+from abc import ABC, abstractmethod
+from collections import deque
+from concurrent.futures import Future
 from datetime import datetime
 import numpy as np
 import cv2
+from PIL import Image, ImageOps
 from deepface import DeepFace
+from deepface.modules import detection, preprocessing
 from flask import current_app
+from werkzeug.exceptions import RequestEntityTooLarge
 import requests
 from tqdm import tqdm
+from extensions import db
+from models.face_embedding import FaceEmbedding
+from utils.stats import percentiles
+from utils.sharded_search import SharedArray, cosine_distances, top_k, shard_bounds, search_shards, shard_pool
+
+try:
+    import hnswlib
+except ImportError:  # Optional, only needed for FACE_INDEX_BACKEND = 'hnsw'
+    hnswlib = None
+
+try:
+    import onnxruntime
+except ImportError:  # Optional, only needed for FACE_RUNTIME = 'onnx'
+    onnxruntime = None
+
+DEFAULT_FACE_MODEL = 'VGG-Face'  # Used until the registry is configured from FACE_MODEL
+FACE_DETECTOR_BACKEND = 'opencv'
+IMAGE_CHUNK_SIZE = 64 * 1024
+PROBE_MAX_EDGE = 1280  # Longest image edge the face pipeline works on
 
 def download_vgg_face_weights():
     """Download VGG Face weights if not already downloaded"""
@@ -45,6 +77,63 @@ def download_vgg_face_weights():
     print("Download complete!")
     return weights_file
 
+def decode_base64_image(image_data):
+    """
+    Decode a base64 image string, with or without a data URL header, to raw bytes.
+    Raises RequestEntityTooLarge if the image is over MAX_IMAGE_UPLOAD_BYTES.
+    """
+    # Remove header from base64 string if present
+    if 'base64,' in image_data:
+        image_data = image_data.split('base64,')[1]
+    
+    image_bytes = base64.b64decode(image_data)
+    if len(image_bytes) > current_app.config['MAX_IMAGE_UPLOAD_BYTES']:
+        raise RequestEntityTooLarge()
+    return image_bytes
+
+def decode_image(image_bytes, max_edge=PROBE_MAX_EDGE):
+    """
+    Decode encoded image bytes (JPEG, PNG, ...) to a BGR NumPy array ready for the face pipeline:
+    JPEGs are downscaled during decoding (DCT scaling, much cheaper than a full decode),
+    EXIF orientation is applied, and the long edge is capped at max_edge.
+    
+    Returns:
+        numpy.ndarray or None: The decoded image, or None if the bytes are not an image
+    """
+    if not image_bytes:
+        return None
+    try:
+        img = Image.open(io.BytesIO(image_bytes))
+        width, height = img.size
+        if max_edge and max(width, height) > max_edge:
+            # JPEG only: decode at the smallest 1/2, 1/4 or 1/8 scale still covering the target
+            ratio = max_edge / max(width, height)
+            img.draft('RGB', (int(width * ratio), int(height * ratio)))
+        img = ImageOps.exif_transpose(img)
+        img = cv2.cvtColor(np.asarray(img.convert('RGB')), cv2.COLOR_RGB2BGR)
+    except (OSError, ValueError, Image.DecompressionBombError):
+        return None
+
+    # What is left after draft scaling is under 2x, where linear interpolation is fine and far cheaper than area
+    scale = max_edge / max(img.shape[:2]) if max_edge else 1
+    if scale < 1:
+        img = cv2.resize(img, None, fx=scale, fy=scale, interpolation=cv2.INTER_LINEAR)
+    return img
+
+def crop_face(img, face_box, margin=0.3):
+    """
+    Cut a face out of an image with a margin around it, so the detector can
+    re-find and align it on a small crop instead of the whole frame
+    
+    Args:
+        face_box (tuple): (x, y, w, h) of the face in image pixels
+        margin (float): Extra border on each side, as a fraction of the face size
+    """
+    x, y, w, h = face_box
+    pad_x, pad_y = int(w * margin), int(h * margin)
+    height, width = img.shape[:2]
+    return img[max(0, y - pad_y):min(height, y + h + pad_y), max(0, x - pad_x):min(width, x + w + pad_x)]
+
 def save_image(image_data):
     """
     Save base64 encoded image data to the filesystem
@@ -56,12 +145,8 @@ def save_image(image_data):
         str: Path to the saved image
     """
     try:
-        # Remove header from base64 string if present
-        if 'base64,' in image_data:
-            image_data = image_data.split('base64,')[1]
-        
         # Decode base64 string
-        image_bytes = base64.b64decode(image_data)
+        image_bytes = decode_base64_image(image_data)
         
         # Generate unique filename
         filename = f"{uuid.uuid4()}.jpg"
@@ -72,68 +157,1002 @@ def save_image(image_data):
             f.write(image_bytes)
         
         return os.path.join('images', filename)  # Return relative path
+    except RequestEntityTooLarge:
+        raise
+    except Exception as e:
+        print(f"Error saving image: {str(e)}")
+        return None
+
+def remove_image(image_path):
+    """Delete a saved visitor image, given the relative path returned when it was saved"""
+    if not image_path:
+        return
+    try:
+        os.remove(os.path.join(current_app.static_folder, image_path))
+    except FileNotFoundError:
+        pass
+    except OSError as e:
+        print(f"Error removing image {image_path}: {str(e)}")
+
+def _copy_image_stream(stream, write):
+    """
+    Pass an uploaded image on in fixed-size chunks, raising RequestEntityTooLarge as soon as it
+    passes MAX_IMAGE_UPLOAD_BYTES. MAX_CONTENT_LENGTH leaves room for base64 bodies, so raw and
+    multipart uploads are held to the image limit here.
+    """
+    limit = current_app.config['MAX_IMAGE_UPLOAD_BYTES']
+    size = 0
+    while True:
+        chunk = stream.read(IMAGE_CHUNK_SIZE)
+        if not chunk:
+            return
+        size += len(chunk)
+        if size > limit:
+            raise RequestEntityTooLarge()
+        write(chunk)
+
+def save_image_stream(stream):
+    """
+    Save an uploaded image to the filesystem in fixed-size chunks, without buffering it in memory
+    
+    Args:
+        stream (file-like): Binary stream of the encoded image
+        
+    Returns:
+        str: Path to the saved image
+    """
+    filename = f"{uuid.uuid4()}.jpg"
+    file_path = os.path.join(current_app.config['IMAGES_DIR'], filename)
+    try:
+        with open(file_path, 'wb') as f:
+            _copy_image_stream(stream, f.write)
+        
+        return os.path.join('images', filename)  # Return relative path
+    except RequestEntityTooLarge:
+        os.remove(file_path)
+        raise
     except Exception as e:
         print(f"Error saving image: {str(e)}")
         return None
 
-def verify_face(stored_image_path, new_image_path, tolerance=0.4):
+def read_image_stream(stream):
+    """Read an uploaded image stream in fixed-size chunks into a single bytes object"""
+    buffer = bytearray()
+    _copy_image_stream(stream, buffer.extend)
+    return bytes(buffer)
+
+def audit_probe(image_bytes):
+    """
+    Keep a sampled copy of an identification probe for auditing.
+    Nothing is written unless PROBE_AUDIT_SAMPLE_RATE is above zero.
+    
+    Returns:
+        str or None: Path of the stored probe, if this one was sampled
+    """
+    sample_rate = current_app.config['PROBE_AUDIT_SAMPLE_RATE']
+    if sample_rate <= 0 or random.random() >= sample_rate:
+        return None
+
+    try:
+        audit_dir = os.path.join(current_app.config['PROBE_AUDIT_DIR'], datetime.utcnow().strftime('%Y-%m-%d'))
+        os.makedirs(audit_dir, exist_ok=True)
+        file_path = os.path.join(audit_dir, f"{uuid.uuid4()}.jpg")
+        with open(file_path, 'wb') as f:
+            f.write(image_bytes)
+        return file_path
+    except Exception as e:
+        print(f"Error auditing probe image: {str(e)}")
+        return None
+
+def onnx_model_path(onnx_dir, model_name):
+    """Where the ONNX export of a recognition model is stored"""
+    return os.path.join(onnx_dir, f"{model_name.lower()}.onnx")
+
+class OnnxRecognitionModel:
+    """
+    Recognition model exported to ONNX (flask export-face-model) and run by ONNX Runtime
+    on CPU. Stands in for the DeepFace model: same input size, same raw embeddings.
+    """
+
+    def __init__(self, model_name, model_path, threads=0):
+        if onnxruntime is None:
+            raise RuntimeError("FACE_RUNTIME = 'onnx' requires the onnxruntime package (pip install onnxruntime)")
+        if not os.path.exists(model_path):
+            raise RuntimeError(f"No ONNX export of {model_name} at {model_path}, run 'flask export-face-model' first")
+
+        options = onnxruntime.SessionOptions()
+        options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+        options.intra_op_num_threads = threads  # 0 lets ONNX Runtime use every core
+        self.session = onnxruntime.InferenceSession(model_path, sess_options=options, providers=['CPUExecutionProvider'])
+        self.input_name = self.session.get_inputs()[0].name
+
+        _, height, width, _ = self.session.get_inputs()[0].shape  # NHWC, as exported from Keras
+        self.model_name = model_name
+        self.input_shape = (width, height)
+        self.output_shape = self.session.get_outputs()[0].shape[-1]
+
+    def forward_batch(self, batch):
+        return self.session.run(None, {self.input_name: batch.astype(np.float32, copy=False)})[0]
+
+class FaceModelRegistry:
+    """
+    Process-wide cache of the face detector and recognition model.
+    Each model is built once on first use (or at warm-up) and reused by every request.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._models = {}
+        self._stats = {}
+        self._warm_up_seconds = None
+        self.model_names = [DEFAULT_FACE_MODEL]
+        self.runtime = 'tensorflow'
+        self.onnx_dir = None
+        self.onnx_threads = 0
+
+    @property
+    def model_name(self):
+        """The recognition model new embeddings are computed with"""
+        return self.model_names[0]
+
+    def configure(self, model_names, runtime='tensorflow', onnx_dir=None, onnx_threads=0):
+        """
+        Choose the recognition models and how they run: 'tensorflow' (DeepFace/Keras) or 'onnx' (ONNX Runtime).
+        The first model is the default; others (the previous model during a migration) are warmed up too.
+        """
+        if runtime not in ('tensorflow', 'onnx'):
+            raise ValueError(f"Unknown face runtime '{runtime}'")
+        self.model_names = list(model_names)
+        self.runtime = runtime
+        self.onnx_dir = onnx_dir
+        self.onnx_threads = onnx_threads
+
+    def _get(self, key, loader):
+        model = self._models.get(key)
+        if model is not None:
+            return model
+
+        with self._lock:
+            if key not in self._models:
+                rss_before = get_rss_bytes()
+                started = time.perf_counter()
+                self._models[key] = loader()
+                self._stats[key] = {
+                    'load_seconds': round(time.perf_counter() - started, 3),
+                    'rss_delta_bytes': get_rss_bytes() - rss_before,
+                    'loaded_at': datetime.utcnow().isoformat()
+                }
+            return self._models[key]
+
+    def get_recognition_model(self, model_name=None, runtime=None):
+        model_name = model_name or self.model_name
+        if (runtime or self.runtime) == 'onnx':
+            return self._get(
+                f"recognition:{model_name}:onnx",
+                lambda: OnnxRecognitionModel(model_name, onnx_model_path(self.onnx_dir, model_name), self.onnx_threads)
+            )
+        return self._get(
+            f"recognition:{model_name}",
+            lambda: DeepFace.build_model(model_name=model_name, task='facial_recognition')
+        )
+
+    def get_detector(self, detector_backend=FACE_DETECTOR_BACKEND):
+        return self._get(
+            f"detector:{detector_backend}",
+            lambda: DeepFace.build_model(model_name=detector_backend, task='face_detector')
+        )
+
+    def warm_up(self):
+        """Build every model and push one dummy image through detection and embedding"""
+        started = time.perf_counter()
+        detect_faces(np.zeros((480, 640, 3), dtype=np.uint8))
+        for model_name in self.model_names:
+            embed_faces([np.zeros((224, 224, 3), dtype=np.uint8)], model_name)
+        self._warm_up_seconds = round(time.perf_counter() - started, 3)
+        return self.stats()
+
+    def stats(self):
+        """Load time and memory footprint of every loaded model, plus current process RSS"""
+        return {
+            'model_names': self.model_names,
+            'runtime': self.runtime,
+            'models': dict(self._stats),
+            'warm_up_seconds': self._warm_up_seconds,
+            'rss_bytes': get_rss_bytes()
+        }
+
+def get_rss_bytes():
+    """Resident set size of the current process in bytes"""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError):
+        # Peak rather than current RSS, but good enough where /proc is unavailable
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+model_registry = FaceModelRegistry()
+
+def detect_faces(img, detector_backend=FACE_DETECTOR_BACKEND):
+    """
+    Detect and align every face in a BGR image with the shared detector, or with another
+    DeepFace backend when comparing them
+    
+    Returns:
+        list: DeepFace DetectedFace objects with the aligned crop and facial area
+    """
+    model_registry.get_detector(detector_backend)
+    return detection.detect_faces(detector_backend=detector_backend, img=img, align=True)
+
+def preprocess_face(face, model):
+    """Resize and normalize a face crop into a (1, h, w, 3) model input"""
+    target_width, target_height = model.input_shape
+    img = preprocessing.resize_image(img=face, target_size=(target_height, target_width))
+    return preprocessing.normalize_input(img=img, normalization='base')
+
+def forward_batch(model, batch):
+    """
+    Run a whole batch through the Keras network behind a DeepFace model, or through
+    ONNX Runtime for an exported one. DeepFace's own forward() only returns the first row.
+    """
+    if isinstance(model, OnnxRecognitionModel):
+        return model.forward_batch(batch)
+    return np.asarray(model.model(batch, training=False), dtype=np.float32)
+
+def embed_faces(face_images, model_name=None):
+    """
+    Embed aligned face crops with a shared recognition model. When micro-batching is
+    enabled the crops join concurrent requests in the inference batcher.
+    
+    Args:
+        face_images (list): BGR face crops
+        model_name (str): DeepFace model name, defaults to the registry's current model
+        
+    Returns:
+        numpy.ndarray: L2-normalized float32 embeddings of shape (n, d)
+    """
+    model_name = model_name or model_registry.model_name
+    model = model_registry.get_recognition_model(model_name)
+    inputs = [preprocess_face(face, model) for face in face_images]
+
+    if inference_batcher.enabled:
+        embeddings = inference_batcher.embed(inputs, model_name)
+    else:
+        embeddings = forward_batch(model, np.concatenate(inputs))
+    return l2_normalize(embeddings)
+
+class InferenceBatcher:
+    """
+    Gathers face inputs from concurrent requests for a short window and embeds them in one
+    forward pass on a dispatcher thread, instead of every request running its own
+    single-image pass on the same cores.
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.window_seconds = 0.01
+        self.max_batch_size = 16
+        self._queue = None
+        self._pid = None
+        self._lock = threading.Lock()
+        self._stats_lock = threading.Lock()  # The dispatcher records batches while requests read the stats
+        self._batches = 0
+        self._items = 0
+        self._batch_sizes = deque(maxlen=1000)
+        self._wait_ms = deque(maxlen=1000)
+        self._forward_ms = deque(maxlen=1000)
+
+    def configure(self, window_ms, max_batch_size):
+        """Enable batching with the given collection window and batch size cap"""
+        self.window_seconds = window_ms / 1000
+        self.max_batch_size = max_batch_size
+        self.enabled = True
+
+    def _get_queue(self):
+        """Start the dispatcher lazily, and again after a fork, since threads don't survive one"""
+        with self._lock:
+            if self._pid != os.getpid():
+                self._queue = queue.Queue()
+                threading.Thread(
+                    target=self._dispatch_loop, args=(self._queue,), name='inference-batcher', daemon=True
+                ).start()
+                self._pid = os.getpid()
+            return self._queue
+
+    def embed(self, inputs, model_name):
+        """
+        Embed preprocessed face inputs, blocking until the batch they join has run
+        
+        Args:
+            inputs (list): Model inputs of shape (1, h, w, 3), as from preprocess_face
+            model_name (str): Model the inputs were preprocessed for
+            
+        Returns:
+            numpy.ndarray: Raw (unnormalized) embeddings of shape (n, d)
+        """
+        pending = self._get_queue()
+        futures = []
+        for face_input in inputs:
+            future = Future()
+            pending.put((model_name, face_input, future, time.perf_counter()))
+            futures.append(future)
+        return np.vstack([future.result() for future in futures])
+
+    def _dispatch_loop(self, pending):
+        while True:
+            # The window opens when the first input arrives, so an idle server adds no delay
+            items = [pending.get()]
+            deadline = time.perf_counter() + self.window_seconds
+            while len(items) < self.max_batch_size:
+                remaining = deadline - time.perf_counter()
+                if remaining <= 0:
+                    break
+                try:
+                    items.append(pending.get(timeout=remaining))
+                except queue.Empty:
+                    break
+
+            # Only during a model migration are two models in use; each runs its own pass
+            by_model = {}
+            for item in items:
+                by_model.setdefault(item[0], []).append(item)
+            for model_name, model_items in by_model.items():
+                self._run_batch(model_name, model_items)
+
+    def _run_batch(self, model_name, items):
+        started = time.perf_counter()
+        try:
+            model = model_registry.get_recognition_model(model_name)
+            embeddings = forward_batch(model, np.concatenate([face_input for _, face_input, _, _ in items]))
+        except Exception as e:
+            for _, _, future, _ in items:
+                future.set_exception(e)
+            return
+
+        forward_ms = (time.perf_counter() - started) * 1000
+        for embedding, (_, _, future, _) in zip(embeddings, items):
+            future.set_result(embedding)
+
+        with self._stats_lock:
+            self._batches += 1
+            self._items += len(items)
+            self._batch_sizes.append(len(items))
+            self._forward_ms.append(forward_ms)
+            self._wait_ms.extend((started - enqueued_at) * 1000 for _, _, _, enqueued_at in items)
+
+    def stats(self):
+        """Batch size, queue wait and forward pass time over the most recent batches"""
+        with self._stats_lock:
+            batches, items = self._batches, self._items
+            batch_sizes, wait_ms, forward_ms = list(self._batch_sizes), list(self._wait_ms), list(self._forward_ms)
+        return {
+            'enabled': self.enabled,
+            'window_ms': self.window_seconds * 1000,
+            'max_batch_size': self.max_batch_size,
+            'batches': batches,
+            'items': items,
+            'batch_size': percentiles(batch_sizes, mean=True),
+            'wait_ms': percentiles(wait_ms, mean=True),
+            'forward_ms': percentiles(forward_ms, mean=True)
+        }
+
+inference_batcher = InferenceBatcher()
+
+def represent_image(img, model_name=None):
+    """
+    Embed the largest face in a BGR image, with the given model or the registry's current one
+    
+    Returns:
+        numpy.ndarray or None: L2-normalized float32 embedding, or None if no face was found
+    """
+    faces = detect_faces(img)
+    if not faces:
+        return None
+
+    largest = max(faces, key=lambda face: face.facial_area.w * face.facial_area.h)
+    return embed_faces([largest.img], model_name)[0]
+
+def represent_face_crop(crop, model_name=None):
+    """
+    Embed a face crop already located by the quality gate. The detector only runs
+    on the small crop, to align the face. If it finds none, the gate's box was not a
+    face the recognition model can use, and nothing is embedded.
+    
+    Returns:
+        numpy.ndarray or None: L2-normalized float32 embedding, or None if no face was found
+    """
+    return represent_image(crop, model_name)
+
+def represent_faces(images, model_name=None):
+    """
+    Detect every face in each BGR image and embed all of them in one batched pass
+    
+    Args:
+        images (list): BGR images, e.g. several probes or one group photo
+        
+    Returns:
+        list: Per image, a list of (box, embedding) pairs where box holds the face's
+              x, y, w, h in image pixels and the detector confidence
+    """
+    detections = [detect_faces(img) for img in images]
+    crops = [face.img for faces in detections for face in faces]
+    embeddings = embed_faces(crops, model_name) if crops else []
+
+    results, position = [], 0
+    for faces in detections:
+        image_faces = []
+        for face in faces:
+            area = face.facial_area
+            box = {
+                'x': int(area.x), 'y': int(area.y), 'w': int(area.w), 'h': int(area.h),
+                'confidence': float(face.confidence) if face.confidence is not None else None
+            }
+            image_faces.append((box, embeddings[position]))
+            position += 1
+        results.append(image_faces)
+    return results
+
+def get_probe_faces(images_bytes, model_name=None):
+    """
+    Detect and embed every face in several encoded probe images
+    
+    Returns:
+        list: Per image, a list of (box, embedding) pairs, or None if the image could not be decoded
+    """
+    images = [decode_image(image_bytes) for image_bytes in images_bytes]
+    decoded = represent_faces([img for img in images if img is not None], model_name)
+    decoded.reverse()
+    return [decoded.pop() if img is not None else None for img in images]
+
+def verify_face(stored_image_path, new_image_path, tolerance=None, model_name=None):
     """
     Compare a stored image with a new image and return if they match
     
     Args:
         stored_image_path (str): Path to the stored image
         new_image_path (str): Path to the new image
-        tolerance (float): Similarity threshold (lower is stricter)
+        tolerance (float): Similarity threshold (lower is stricter), defaults to the model's
+        model_name (str): DeepFace model name, defaults to the registry's current model
         
     Returns:
         tuple: (bool, float) - whether the faces match and the similarity score
     """
-    try:
-        # Ensure the full path is used
-        full_stored_path = os.path.join(current_app.static_folder, stored_image_path)
-        full_new_path = os.path.join(current_app.static_folder, new_image_path)
-        
-        # Use DeepFace for face comparison
-        result = DeepFace.verify(
-            img1_path=full_new_path,
-            img2_path=full_stored_path,
-            model_name='VGG-Face',
-            distance_metric='cosine',
-            detector_backend='opencv'
-        )
+    stored_embedding = get_face_embedding(stored_image_path, model_name)
+    new_embedding = get_face_embedding(new_image_path, model_name)
+
+    return verify_embedding(new_embedding, stored_embedding, tolerance, model_name)
+
+def get_face_embedding(image_path, model_name=None):
+    """
+    Compute the face embedding for a stored image
+    
+    Args:
+        image_path (str): Path to the image, relative to the static folder
+        model_name (str): DeepFace model name, defaults to the registry's current model
         
-        # Log the verification result for debugging
-        print(f"Face verification result: {result}")
+    Returns:
+        numpy.ndarray or None: L2-normalized float32 embedding, or None if no face was found
+    """
+    try:
+        full_path = os.path.join(current_app.static_folder, image_path)
+        with open(full_path, 'rb') as f:
+            img = decode_image(f.read())
+        if img is None:
+            raise ValueError(f"Could not read image {full_path}")
+        return represent_image(img, model_name)
+    except Exception as e:
+        print(f"Error computing face embedding: {str(e)}")
+        return None
+
+def get_probe_embedding(image_bytes, model_name=None):
+    """
+    Compute the face embedding of an identification probe entirely in memory
+    
+    Args:
+        image_bytes (bytes): Encoded probe image
+        model_name (str): DeepFace model name, defaults to the registry's current model
         
-        # Return match status and distance
-        return result['verified'], result['distance']
+    Returns:
+        numpy.ndarray or None: L2-normalized float32 embedding, or None if no face was found
+    """
+    try:
+        img = decode_image(image_bytes)
+        if img is None:
+            raise ValueError("Probe is not a valid image")
+        return represent_image(img, model_name)
     except Exception as e:
-        print(f"Error verifying face: {str(e)}")
-        return False, float('inf')
+        print(f"Error computing probe embedding: {str(e)}")
+        return None
+
+def l2_normalize(embedding):
+    """Return a float32 copy of the embedding(s) scaled to unit length"""
+    embedding = np.asarray(embedding, dtype=np.float32)
+    norms = np.linalg.norm(embedding, axis=-1, keepdims=True)
+    return embedding / np.maximum(norms, 1e-10)
 
-def find_matching_visitor(new_image_path, visitors):
+def store_face_embedding(visitor, embedding, model_name=None):
     """
-    Find the best matching visitor from a list of visitors
+    Attach an embedding to a visitor, replacing any previous one for the same model.
+    The caller is responsible for committing the session.
+    """
+    model_name = model_name or model_registry.model_name
+    record = FaceEmbedding.query.filter_by(visitor_id=visitor.id, model_name=model_name).first()
+    if not record:
+        record = FaceEmbedding(visitor_id=visitor.id, model_name=model_name)
+        db.session.add(record)
+    record.set_embedding(embedding)
+    return record
+
+def get_stored_embedding(visitor, model_name=None):
+    """Return a visitor's stored embedding for a model, or None if there is none"""
+    record = FaceEmbedding.query.filter_by(
+        visitor_id=visitor.id, model_name=model_name or model_registry.model_name
+    ).first()
+    return record.get_embedding() if record else None
+
+def get_tolerance(model_name=None):
+    """Match threshold (cosine distance) for a model: each model spreads faces differently"""
+    config = current_app.config
+    return config['FACE_MODEL_TOLERANCES'].get(model_name or model_registry.model_name, config['FACE_RECOGNITION_TOLERANCE'])
+
+def verify_embedding(probe_embedding, stored_embedding, tolerance=None, model_name=None):
+    """
+    1:1 comparison of a probe against one stored embedding
     
     Args:
-        new_image_path (str): Path to the new image
-        visitors (list): List of Visitor objects
+        probe_embedding (numpy.ndarray): L2-normalized embedding of the probe face
+        stored_embedding (numpy.ndarray): L2-normalized embedding it is checked against
+        tolerance (float): Maximum cosine distance for a match (lower is stricter)
+        model_name (str): Model both embeddings come from, sets the default tolerance
         
     Returns:
-        tuple: (Visitor, float) - best matching visitor and similarity score
+        tuple: (bool, float) - whether the faces match and their distance
+    """
+    if tolerance is None:
+        tolerance = get_tolerance(model_name)
+
+    if probe_embedding is None or stored_embedding is None:
+        return False, float('inf')
+
+    distance = float(1.0 - stored_embedding @ probe_embedding)
+    return distance <= tolerance, distance
+
+def quantize_embeddings(embeddings, dtype='float32', chunk_size=65536):
     """
-    best_match = None
-    best_distance = float('inf')
+    Convert L2-normalized float32 embeddings to a compact storage type
     
-    for visitor in visitors:
-        if not visitor.image_path:
-            continue
-            
-        verified, distance = verify_face(visitor.image_path, new_image_path)
+    Args:
+        embeddings (numpy.ndarray): L2-normalized float32 matrix of shape (n, d)
+        dtype (str): 'float32', 'float16' or 'int8'
+        
+    Returns:
+        tuple: (numpy.ndarray, numpy.ndarray or None) - stored matrix and, for int8, per-vector scales
+               chosen so that (row @ probe) * scale is the cosine similarity of the quantized direction
+    """
+    if dtype == 'float32':
+        return np.ascontiguousarray(embeddings, dtype=np.float32), None
+    if dtype == 'float16':
+        return embeddings.astype(np.float16), None
+    if dtype != 'int8':
+        raise ValueError(f"Unsupported gallery dtype: {dtype}")
+
+    quantized = np.empty(embeddings.shape, dtype=np.int8)
+    scales = np.empty(len(embeddings), dtype=np.float32)
+    for start in range(0, len(embeddings), chunk_size):
+        chunk = embeddings[start:start + chunk_size]
+        max_abs = np.maximum(np.abs(chunk).max(axis=1, keepdims=True), 1e-10)
+        rows = np.round(chunk / max_abs * 127).astype(np.int8)
+        quantized[start:start + chunk_size] = rows
+        scales[start:start + chunk_size] = 1.0 / np.maximum(np.linalg.norm(rows.astype(np.float32), axis=1), 1e-10)
+    return quantized, scales
+
+class FaceIndex(ABC):
+    """
+    Interface for a nearest-neighbour index over L2-normalized face embeddings.
+    Distances returned by search() are cosine distances (1 - cosine similarity).
+    """
+
+    @abstractmethod
+    def build(self, visitor_ids, embeddings):
+        """Index a whole gallery, replacing any earlier contents, and return the index"""
+
+    @abstractmethod
+    def search(self, probe_embedding, k=1):
+        """
+        Return the k nearest gallery entries to the probe
         
-        # Update best match if this one is better
-        if verified and distance < best_distance:
-            best_match = visitor
-            best_distance = distance
+        Returns:
+            tuple: (numpy.ndarray, numpy.ndarray) - visitor ids and distances, nearest first
+        """
+
+    @abstractmethod
+    def __len__(self):
+        """Number of visitors in the index"""
+
+class ExactFaceIndex(FaceIndex):
+    """Brute-force search with one matrix-vector product over the whole gallery"""
+
+    def __init__(self):
+        self.visitor_ids = np.empty(0, dtype=np.int64)
+        self.embeddings = np.empty((0, 0), dtype=np.float32)
+        self.scales = None
+
+    def build(self, visitor_ids, embeddings, scales=None):
+        """Index the gallery as given: float16/int8 and memory-mapped matrices are used without copying"""
+        self.visitor_ids = np.asarray(visitor_ids, dtype=np.int64)
+        if embeddings.dtype not in (np.float32, np.float16, np.int8):
+            embeddings = embeddings.astype(np.float32)
+        self.embeddings = embeddings
+        self.scales = scales
+        return self
+
+    def search(self, probe_embedding, k=1):
+        if len(self.visitor_ids) == 0:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32)
+        distances = cosine_distances(probe_embedding, self.embeddings, self.scales)
+        best = top_k(distances, k)
+        return self.visitor_ids[best], distances[best]
+
+    def __len__(self):
+        return len(self.visitor_ids)
+
+class ShardedExactFaceIndex(FaceIndex):
+    """
+    Exact search with the gallery split into contiguous shards, each scanned by a worker
+    process and the per-shard top-k merged here. The matrix lives in shared memory (or the
+    snapshot file it was mapped from), so no worker holds a private copy.
+    """
+
+    def __init__(self, shards):
+        self.shards = shards
+        self.visitor_ids = np.empty(0, dtype=np.int64)
+        self._arrays = []
+        self._sources = None
+        self._bounds = []
+
+    def build(self, visitor_ids, embeddings, scales=None):
+        self.release()
+        self.visitor_ids = np.asarray(visitor_ids, dtype=np.int64)
+        if embeddings.dtype not in (np.float32, np.float16, np.int8):
+            embeddings = embeddings.astype(np.float32)
+        self._arrays = [SharedArray(embeddings)] + ([SharedArray(scales)] if scales is not None else [])
+        self._sources = (self._arrays[0].source, self._arrays[1].source if scales is not None else None)
+        self._bounds = shard_bounds(len(self.visitor_ids), self.shards)
+        # Shared memory is not freed with the index unless released
+        weakref.finalize(self, ShardedExactFaceIndex._release_arrays, self._arrays)
+        return self
+
+    @staticmethod
+    def _release_arrays(arrays):
+        for array in arrays:
+            array.release()
+
+    def release(self):
+        """Free the shared gallery now rather than when the index is garbage collected"""
+        self._release_arrays(self._arrays)
+
+    def search(self, probe_embedding, k=1):
+        if len(self.visitor_ids) == 0:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32)
+        rows, distances = search_shards(self._sources, self._bounds, probe_embedding, k, self.shards)
+        return self.visitor_ids[rows], distances
+
+    def __len__(self):
+        return len(self.visitor_ids)
+
+class IVFFaceIndex(FaceIndex):
+    """
+    Inverted-file index: the gallery is clustered with spherical k-means and a query
+    only scans the nprobe clusters whose centroids are closest to it.
+    """
+
+    def __init__(self, nlist=None, nprobe=16, train_iterations=10, seed=0):
+        self.nlist = nlist
+        self.nprobe = nprobe
+        self.train_iterations = train_iterations
+        self.seed = seed
+        self.centroids = None
+        self.offsets = None
+        self.visitor_ids = np.empty(0, dtype=np.int64)
+        self.embeddings = np.empty((0, 0), dtype=np.float32)
+        self.scales = None
+
+    @classmethod
+    def from_arrays(cls, visitor_ids, embeddings, centroids, offsets, scales=None, nprobe=16):
+        """Wrap an already clustered layout, e.g. a memory-mapped gallery snapshot, without copying it"""
+        index = cls(nlist=len(centroids), nprobe=nprobe)
+        index.visitor_ids = visitor_ids
+        index.embeddings = embeddings
+        index.centroids = np.asarray(centroids, dtype=np.float32)
+        index.offsets = np.asarray(offsets, dtype=np.int64)
+        index.scales = scales
+        return index
+
+    def _assign(self, embeddings, chunk_size=65536):
+        """Nearest centroid for every row, computed in chunks to bound memory"""
+        assignments = np.empty(len(embeddings), dtype=np.int64)
+        for start in range(0, len(embeddings), chunk_size):
+            chunk = embeddings[start:start + chunk_size]
+            assignments[start:start + chunk_size] = np.argmax(chunk @ self.centroids.T, axis=1)
+        return assignments
+
+    def _train(self, embeddings, nlist):
+        rng = np.random.default_rng(self.seed)
+        sample_size = min(len(embeddings), nlist * 64)
+        sample = embeddings[rng.choice(len(embeddings), sample_size, replace=False)]
+        self.centroids = sample[rng.choice(sample_size, nlist, replace=False)].copy()
+
+        for _ in range(self.train_iterations):
+            assignments = self._assign(sample)
+            sums = np.zeros_like(self.centroids)
+            np.add.at(sums, assignments, sample)
+            counts = np.bincount(assignments, minlength=nlist)
+
+            # Re-seed empty clusters from random sample points
+            empty = counts == 0
+            if empty.any():
+                sums[empty] = sample[rng.choice(sample_size, int(empty.sum()), replace=False)]
+            self.centroids = l2_normalize(sums)
+
+    def build(self, visitor_ids, embeddings):
+        visitor_ids = np.asarray(visitor_ids, dtype=np.int64)
+        embeddings = np.ascontiguousarray(embeddings, dtype=np.float32)
+        nlist = max(1, min(len(embeddings), self.nlist or int(np.sqrt(len(embeddings)))))
+
+        self._train(embeddings, nlist)
+        assignments = self._assign(embeddings)
+
+        # Store vectors grouped by cluster so each list is one contiguous slice
+        order = np.argsort(assignments, kind='stable')
+        self.visitor_ids = visitor_ids[order]
+        self.embeddings = embeddings[order]
+        self.offsets = np.searchsorted(assignments[order], np.arange(nlist + 1))
+        return self
+
+    def search(self, probe_embedding, k=1):
+        if len(self.visitor_ids) == 0:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32)
+
+        nprobe = min(self.nprobe, len(self.centroids))
+        lists = top_k(-(self.centroids @ probe_embedding), nprobe)
+
+        # Each list is a contiguous slice, so scanning it never copies the gallery
+        candidates, distances = [], []
+        for i in lists:
+            start, stop = self.offsets[i], self.offsets[i + 1]
+            if start == stop:
+                continue
+            scales = self.scales[start:stop] if self.scales is not None else None
+            candidates.append(np.arange(start, stop))
+            distances.append(cosine_distances(probe_embedding, self.embeddings[start:stop], scales))
+        if not candidates:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32)
+
+        candidates = np.concatenate(candidates)
+        distances = np.concatenate(distances)
+        best = top_k(distances, k)
+        return self.visitor_ids[candidates[best]], distances[best]
+
+    def __len__(self):
+        return len(self.visitor_ids)
+
+class HNSWFaceIndex(FaceIndex):
+    """Hierarchical navigable small-world graph index, backed by the optional hnswlib package"""
+
+    def __init__(self, m=16, ef_construction=200, ef_search=64):
+        if hnswlib is None:
+            raise RuntimeError("The 'hnsw' face index requires the hnswlib package (pip install hnswlib)")
+        self.m = m
+        self.ef_construction = ef_construction
+        self.ef_search = ef_search
+        self.index = None
+        self.size = 0
+        self.visitor_ids = np.empty(0, dtype=np.int64)
+
+    def build(self, visitor_ids, embeddings):
+        embeddings = np.ascontiguousarray(embeddings, dtype=np.float32)
+        self.visitor_ids = np.asarray(visitor_ids, dtype=np.int64)
+        self.index = hnswlib.Index(space='cosine', dim=embeddings.shape[1])
+        self.index.init_index(max_elements=len(embeddings), ef_construction=self.ef_construction, M=self.m)
+        self.index.add_items(embeddings, np.asarray(visitor_ids, dtype=np.int64))
+        self.index.set_ef(self.ef_search)
+        self.size = len(embeddings)
+        return self
+
+    def search(self, probe_embedding, k=1):
+        if self.size == 0:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32)
+        labels, distances = self.index.knn_query(probe_embedding, k=min(k, self.size))
+        return labels[0].astype(np.int64), distances[0]
+
+    def __len__(self):
+        return self.size
+
+class MutableFaceIndex(FaceIndex):
+    """
+    Incremental updates on top of a static index. Added or replaced embeddings are appended to
+    an exact delta, and removed or replaced base entries are hidden by tombstones; searches merge
+    both. The delta's buffers double when full, so a change costs one row and a copy of the live
+    mask rather than a copy of the whole delta. Rows are only written past the count searches
+    read up to, and the mask is swapped in whole, so concurrent searches never need the lock.
+    Rebuild the base once pending_changes grows large.
+    """
+
+    def __init__(self, base, model_name=None):
+        self.base = base
+        self.model_name = model_name  # Recognition model the embeddings come from
+        self._lock = threading.Lock()
+        self._reset()
+
+    def _reset(self):
+        self._sorted_base_ids = np.sort(np.asarray(self.base.visitor_ids, dtype=np.int64))
+        self._delta_rows = {}  # Visitor id -> delta row holding their current embedding
+        # (visitor ids, vectors, live mask, rows in use), published together as one consistent view
+        self._delta_view = (np.empty(0, dtype=np.int64), None, np.empty(0, dtype=bool), 0)
+        self._tombstones = frozenset()
+        self._tombstone_array = np.empty(0, dtype=np.int64)
+        self._hidden_base_count = 0
+
+    def build(self, visitor_ids, embeddings):
+        """
+        Index a whole new gallery in the base and drop the pending changes. Like the other
+        indexes' build(), not safe while searches run: the gallery swaps in a new index instead.
+        """
+        with self._lock:
+            self.base.build(visitor_ids, embeddings)
+            self._reset()
+        return self
+
+    def _in_base(self, visitor_id):
+        position = np.searchsorted(self._sorted_base_ids, visitor_id)
+        return position < len(self._sorted_base_ids) and self._sorted_base_ids[position] == visitor_id
+
+    def update(self, changes):
+        """
+        Apply a batch of changes in one step
+        
+        Args:
+            changes (dict): Visitor id -> new embedding, or None to remove the visitor
+        """
+        if not changes:
+            return
+
+        with self._lock:
+            new_tombstones = set(changes) - self._tombstones
+            if new_tombstones:
+                self._tombstones = self._tombstones | new_tombstones
+                self._tombstone_array = np.fromiter(self._tombstones, dtype=np.int64)
+                self._hidden_base_count += sum(int(self._in_base(visitor_id)) for visitor_id in new_tombstones)
+
+            ids, vectors, live, count = self._delta_view
+            live = live.copy()  # Searches in flight keep the mask they started with
+            added = []
+            for visitor_id, embedding in changes.items():
+                row = self._delta_rows.pop(visitor_id, None)
+                if row is not None:
+                    live[row] = False
+                if embedding is not None:
+                    added.append((visitor_id, l2_normalize(embedding)))
+
+            if added:
+                ids, vectors, live, count = self._append_delta(ids, vectors, live, count, added)
+            self._delta_view = (ids, vectors, live, count)
+
+    def _append_delta(self, ids, vectors, live, count, added):
+        """Write new delta rows, moving the live rows to buffers twice their size when full"""
+        if vectors is None or count + len(added) > len(ids):
+            keep = np.flatnonzero(live[:count])
+            capacity = max(16, 2 * (len(keep) + len(added)))
+            new_ids = np.empty(capacity, dtype=np.int64)
+            new_vectors = np.empty((capacity, added[0][1].shape[-1]), dtype=np.float32)
+            new_live = np.zeros(capacity, dtype=bool)
+            new_ids[:len(keep)] = ids[keep]
+            if len(keep):
+                new_vectors[:len(keep)] = vectors[keep]
+            new_live[:len(keep)] = True
+            self._delta_rows = {int(visitor_id): row for row, visitor_id in enumerate(new_ids[:len(keep)])}
+            ids, vectors, live, count = new_ids, new_vectors, new_live, len(keep)
+
+        for visitor_id, embedding in added:
+            ids[count], vectors[count], live[count] = visitor_id, embedding, True
+            self._delta_rows[visitor_id] = count
+            count += 1
+        return ids, vectors, live, count
+
+    def _search_delta(self, probe_embedding, k):
+        ids, vectors, live, count = self._delta_view
+        live = live[:count]
+        if not live.any():
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32)
+        distances = cosine_distances(probe_embedding, vectors[:count])
+        distances[~live] = np.inf
+        best = top_k(distances, min(k, int(live.sum())))
+        return ids[best], distances[best]
+
+    def add(self, visitor_id, embedding):
+        """Add a visitor's embedding, replacing any earlier one"""
+        self.update({int(visitor_id): embedding})
+
+    def remove(self, visitor_id):
+        """Remove a visitor from the index; a no-op if they are not in it"""
+        self.update({int(visitor_id): None})
+
+    @property
+    def pending_changes(self):
+        """Number of entries served from the delta or hidden by tombstones"""
+        return len(self._delta_rows) + len(self._tombstones)
+
+    def search(self, probe_embedding, k=1):
+        tombstones = self._tombstone_array
+
+        # Over-fetch from the base only by the hidden entries that turn up among the nearest,
+        # widening the search until k live ones are found; k + every tombstone always suffices
+        fetch, most = k, k + len(tombstones)
+        while True:
+            base_ids, base_distances = self.base.search(probe_embedding, fetch)
+            if not len(tombstones):
+                break
+            live = ~np.isin(base_ids, tombstones)
+            hidden = len(base_ids) - int(live.sum())
+            if hidden == 0 or len(base_ids) - hidden >= k or len(base_ids) < fetch or fetch >= most:
+                base_ids, base_distances = base_ids[live], base_distances[live]
+                break
+            fetch = min(max(2 * fetch, k + 2 * hidden), most)
+
+        delta_ids, delta_distances = self._search_delta(probe_embedding, k)
+        visitor_ids = np.concatenate([base_ids, delta_ids])
+        distances = np.concatenate([base_distances, delta_distances])
+        best = top_k(distances, k)
+        return visitor_ids[best], distances[best]
+
+    def __len__(self):
+        return len(self.base) - self._hidden_base_count + len(self._delta_rows)
+
+def create_face_index(backend=None, gallery_size=0):
+    """
+    Create an empty face index configured from the app settings.
+    Small galleries always get an exact index, where brute force is both faster and lossless.
+    """
+    config = current_app.config
+    backend = backend or config['FACE_INDEX_BACKEND']
+
+    if backend == 'exact' or gallery_size < config['FACE_INDEX_EXACT_THRESHOLD']:
+        if (config['FACE_INDEX_SHARDS'] > 1 and gallery_size >= config['FACE_INDEX_SHARD_MIN_SIZE']
+                and shard_pool.available()):
+            return ShardedExactFaceIndex(config['FACE_INDEX_SHARDS'])
+        return ExactFaceIndex()
+    if backend == 'ivf':
+        return IVFFaceIndex(nlist=config['FACE_INDEX_IVF_NLIST'], nprobe=config['FACE_INDEX_IVF_NPROBE'])
+    if backend == 'hnsw':
+        return HNSWFaceIndex(
+            m=config['FACE_INDEX_HNSW_M'],
+            ef_construction=config['FACE_INDEX_HNSW_EF_CONSTRUCTION'],
+            ef_search=config['FACE_INDEX_HNSW_EF_SEARCH']
+        )
+    raise ValueError(f"Unknown face index backend: {backend}")
+
+def find_matching_visitor(probe_embedding, face_index, tolerance=None):
+    """
+    Find the best matching visitor for a probe embedding
     
-    return best_match, best_distance
\ No newline at end of file
+    Args:
+        probe_embedding (numpy.ndarray): L2-normalized embedding of the probe face
+        face_index (FaceIndex): Index over the gallery embeddings
+        tolerance (float): Maximum cosine distance for a match (lower is stricter)
+        
+    Returns:
+        tuple: (int, float) - best matching visitor id (or None) and its distance
+    """
+    if tolerance is None:
+        tolerance = get_tolerance(getattr(face_index, 'model_name', None))
+
+    if probe_embedding is None or len(face_index) == 0:
+        return None, float('inf')
+
+    visitor_ids, distances = face_index.search(probe_embedding, k=1)
+    if len(visitor_ids) == 0:
+        return None, float('inf')
+
+    best_distance = float(distances[0])
+    if best_distance <= tolerance:
+        return int(visitor_ids[0]), best_distance
+    return None, best_distance
@@ -0,0 +1,144 @@
+# utils/duplicates.py - Registration-time search for visitors already enrolled with the same face
+
+import os
+import time
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+from flask import current_app
+from utils.biometric import get_tolerance
+from utils.gallery import get_face_index, get_face_model, apply_gallery_changes
+from utils.inference_service import compute_embedding, InferenceServiceError
+from utils.stats import percentiles
+
+_executor = None
+_executor_pid = None
+_executor_lock = threading.Lock()
+_in_flight = 0  # Checks submitted and not yet finished, including ones past their budget
+_stats_lock = threading.Lock()
+_stats = {
+    'checked': 0,
+    'duplicates': 0,
+    'no_face': 0,
+    'timed_out': 0,
+    'busy': 0,
+    'unavailable': 0,
+    'error': 0,
+    'check_ms': deque(maxlen=1000)
+}
+
+def _get_executor():
+    """Create the pool lazily, and again after a fork, so each process owns its threads"""
+    global _executor, _executor_pid, _in_flight
+
+    with _executor_lock:
+        if _executor is None or _executor_pid != os.getpid():
+            _executor = ThreadPoolExecutor(
+                max_workers=current_app.config['DUPLICATE_CHECK_WORKERS'],
+                thread_name_prefix='duplicate-check'
+            )
+            _executor_pid = os.getpid()
+            _in_flight = 0
+        return _executor
+
+def _submit(app, image_bytes, model_name):
+    """
+    Start a check on an idle worker, or return None if every worker is busy. Checks are never
+    queued: the budget would run out while one waited, and it would be skipped unchecked.
+    """
+    global _in_flight
+
+    executor = _get_executor()
+    with _executor_lock:
+        if _in_flight >= app.config['DUPLICATE_CHECK_WORKERS']:
+            return None
+        _in_flight += 1
+    future = executor.submit(_embed_and_search, app, image_bytes, model_name)
+    future.add_done_callback(_finished)
+    return future
+
+def _finished(future):
+    global _in_flight
+    with _executor_lock:
+        _in_flight -= 1
+
+def _embed_and_search(app, image_bytes, model_name):
+    """
+    Worker: embed the new photo, the same way the embedding worker would, and return it with
+    the gallery entries within the duplicate tolerance
+    """
+    with app.app_context():
+        embedding = compute_embedding(image_bytes, model_name)
+        if embedding is None or get_face_model() != model_name:
+            return embedding, []
+
+        # Catch up on changes since the last sync, so a registration made moments ago is searched too
+        apply_gallery_changes()
+        config = app.config
+        tolerance = config['DUPLICATE_CHECK_TOLERANCE'] or get_tolerance(model_name)
+        visitor_ids, distances = get_face_index().search(embedding, k=config['DUPLICATE_CHECK_MAX_RESULTS'])
+        return embedding, [
+            (int(visitor_id), float(distance))
+            for visitor_id, distance in zip(visitor_ids, distances) if distance <= tolerance
+        ]
+
+def find_duplicate_faces(image_bytes):
+    """
+    Search the identification gallery for the face in a registration photo, giving up once
+    DUPLICATE_CHECK_BUDGET_MS has passed so a slow model never holds up registration. When
+    all DUPLICATE_CHECK_WORKERS are already checking other photos the outcome is 'busy'
+    and nothing is checked; the caller should refuse the registration rather than let it
+    through unchecked.
+
+    Returns:
+        tuple: (str, dict, list) - the outcome ('checked', 'no_face', 'timed_out', 'busy',
+               'unavailable' or 'error'), the photo's embedding by model name when one was
+               computed (so it need not be computed again), and (visitor_id, distance) pairs
+               of likely duplicates, nearest first
+    """
+    app = current_app._get_current_object()
+    started = time.perf_counter()
+    embedding, duplicates = None, []
+
+    try:
+        model_name = get_face_model()
+        future = _submit(app, image_bytes, model_name)
+        if future is None:
+            outcome = 'busy'
+            app.logger.warning("Every duplicate face check worker is busy, turning the registration away")
+        else:
+            embedding, duplicates = future.result(timeout=app.config['DUPLICATE_CHECK_BUDGET_MS'] / 1000)
+            outcome = 'checked' if embedding is not None else 'no_face'
+    except FutureTimeoutError:
+        # Already running, so it can't be cancelled; it keeps its worker until it finishes
+        future.cancel()
+        outcome = 'timed_out'
+        app.logger.warning("Duplicate face check exceeded its budget, registering without it")
+    except InferenceServiceError as e:
+        outcome = 'unavailable'
+        app.logger.warning(f"Duplicate face check unavailable: {str(e)}")
+    except Exception as e:
+        outcome = 'error'
+        app.logger.error(f"Duplicate face check failed: {str(e)}")
+
+    with _stats_lock:
+        _stats[outcome] += 1
+        _stats['duplicates'] += int(bool(duplicates))
+        _stats['check_ms'].append((time.perf_counter() - started) * 1000)
+    return outcome, ({model_name: embedding} if embedding is not None else {}), duplicates
+
+def duplicate_check_stats():
+    """Outcomes and latency of this process's registration duplicate checks"""
+    config = current_app.config
+    return {
+        'enabled': config['DUPLICATE_CHECK_ENABLED'],
+        'budget_ms': config['DUPLICATE_CHECK_BUDGET_MS'],
+        'checked': _stats['checked'],
+        'duplicates': _stats['duplicates'],
+        'no_face': _stats['no_face'],
+        'timed_out': _stats['timed_out'],
+        'busy': _stats['busy'],
+        'unavailable': _stats['unavailable'],
+        'error': _stats['error'],
+        'check_ms': percentiles(_stats['check_ms'])
+    }
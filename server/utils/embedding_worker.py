@@ -0,0 +1,108 @@
+# utils/embedding_worker.py - Background computation of visitor face embeddings
+
+import os
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from flask import current_app
+from extensions import db
+from models.user import Visitor, EmbeddingStatus
+from utils.biometric import store_face_embedding
+from utils.gallery import record_gallery_change, serving_model
+from utils.inference_service import compute_embedding, face_model_names, InferenceServiceError
+
+SERVICE_RETRIES = 3
+
+_executor = None
+_executor_pid = None
+_executor_lock = threading.Lock()
+
+def _get_executor():
+    """Create the worker pool lazily, and again after a fork, so each process owns its threads"""
+    global _executor, _executor_pid
+
+    with _executor_lock:
+        if _executor is None or _executor_pid != os.getpid():
+            _executor = ThreadPoolExecutor(
+                max_workers=current_app.config['EMBEDDING_WORKERS'],
+                thread_name_prefix='embedding-worker'
+            )
+            _executor_pid = os.getpid()
+        return _executor
+
+def submit_embedding(visitor_id, embeddings=None):
+    """
+    Queue a visitor's photo for embedding. The visitor row must already be committed.
+    Embeddings already computed for the photo, by model name, are stored as they are.
+    
+    Returns:
+        concurrent.futures.Future: Resolves to the final EmbeddingStatus
+    """
+    app = current_app._get_current_object()
+    return _get_executor().submit(_embed_visitor, app, visitor_id, embeddings or {})
+
+def _embed_visitor(app, visitor_id, precomputed):
+    """
+    Compute and store one visitor's embedding, recording the outcome in embedding_status.
+    During a model migration both galleries get one, so neither falls behind. Only the model
+    identification is served from decides the status: a photo the other model can't embed is
+    left for backfill-embeddings --model to report, rather than dropping the visitor from the
+    gallery in use.
+    """
+    with app.app_context():
+        try:
+            visitor = Visitor.query.get(visitor_id)
+            if not visitor or not visitor.image_path:
+                return None
+
+            image_path = visitor.image_path
+            embeddings = {
+                model_name: precomputed[model_name] if model_name in precomputed
+                else _compute_file_embedding(app, image_path, model_name)
+                for model_name in face_model_names(app.config)
+            }
+
+            # The photo was replaced while this one was embedding; the newer job will store its result
+            db.session.refresh(visitor)
+            if visitor.image_path != image_path:
+                return None
+
+            for model_name, embedding in embeddings.items():
+                if embedding is not None:
+                    store_face_embedding(visitor, embedding, model_name)
+                else:
+                    # An embedding of an earlier photo must not outlive it
+                    visitor.face_embeddings.filter_by(model_name=model_name).delete()
+
+            if embeddings[serving_model()] is None:
+                visitor.embedding_status = EmbeddingStatus.FAILED
+            else:
+                visitor.embedding_status = EmbeddingStatus.READY
+
+            record_gallery_change(visitor.id)
+            db.session.commit()
+            return visitor.embedding_status
+        except Exception as e:
+            db.session.rollback()
+            app.logger.error(f"Error embedding visitor {visitor_id}: {str(e)}")
+
+            visitor = Visitor.query.get(visitor_id)
+            if visitor:
+                visitor.embedding_status = EmbeddingStatus.FAILED
+                record_gallery_change(visitor.id)
+                db.session.commit()
+            return EmbeddingStatus.FAILED
+
+def _compute_file_embedding(app, image_path, model_name):
+    """Embed a stored photo, backing off and retrying while the inference service is busy or down"""
+    with open(os.path.join(app.static_folder, image_path), 'rb') as f:
+        image_bytes = f.read()
+
+    for attempt in range(SERVICE_RETRIES):
+        try:
+            return compute_embedding(image_bytes, model_name)
+        except InferenceServiceError as e:
+            if attempt == SERVICE_RETRIES - 1:
+                raise
+            app.logger.warning(f"Inference service error, retrying: {str(e)}")
+            time.sleep(2 ** attempt)
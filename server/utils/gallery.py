@@ -0,0 +1,562 @@
+# utils/gallery.py - Process-wide face gallery used for identification
+
+import os
+import json
+import time
+import fcntl
+import shutil
+import threading
+from collections import deque
+from datetime import datetime, timedelta
+import numpy as np
+from flask import current_app
+from extensions import db
+from models.user import Visitor, EmbeddingStatus
+from models.face_embedding import FaceEmbedding
+from models.gallery_change import GalleryChange, GalleryChangeType
+from utils.biometric import (
+    ExactFaceIndex, IVFFaceIndex, MutableFaceIndex, create_face_index, quantize_embeddings,
+    find_matching_visitor
+)
+from utils.stats import percentiles
+
+SNAPSHOT_POINTER = 'CURRENT'
+SNAPSHOT_LOCK = '.lock'
+
+# A pending visitor with an embedding is having their photo replaced: the embedding of the
+# old photo stays searchable until the new one is stored. Failed visitors are never searched.
+SEARCHABLE_STATUSES = (EmbeddingStatus.READY, EmbeddingStatus.PENDING)
+
+def _gallery_query(model_name, *columns):
+    """Query over the embeddings that identification may use: one model, visitor not failed"""
+    return db.session.query(*columns).join(Visitor, Visitor.id == FaceEmbedding.visitor_id).filter(
+        FaceEmbedding.model_name == model_name,
+        Visitor.embedding_status.in_(SEARCHABLE_STATUSES)
+    )
+
+def migration_status(model_name=None):
+    """How many ready visitors have an embedding for a model (FACE_MODEL by default)"""
+    model_name = model_name or current_app.config['FACE_MODEL']
+    total = db.session.query(db.func.count(Visitor.id)).filter(Visitor.embedding_status == EmbeddingStatus.READY).scalar()
+    embedded = _gallery_query(model_name, db.func.count(FaceEmbedding.id)).filter(
+        Visitor.embedding_status == EmbeddingStatus.READY
+    ).scalar()
+    return {'model_name': model_name, 'embedded': embedded, 'total': total, 'complete': embedded >= total}
+
+def serving_model():
+    """
+    Model identification should run on: FACE_MODEL, except during a migration, when it stays
+    on FACE_MODEL_PREVIOUS until every ready visitor has an embedding for the new model
+    """
+    config = current_app.config
+    if config['FACE_MODEL_PREVIOUS'] and not migration_status()['complete']:
+        return config['FACE_MODEL_PREVIOUS']
+    return config['FACE_MODEL']
+
+def load_gallery(model_name=None):
+    """
+    Load every ready embedding for a model (the serving one by default) as one matrix.
+    Visitors whose embedding is still pending or failed are left out.
+
+    Returns:
+        tuple: (numpy.ndarray, numpy.ndarray) - visitor ids of shape (n,) and embeddings of shape (n, d)
+    """
+    rows = _gallery_query(
+        model_name or serving_model(), FaceEmbedding.visitor_id, FaceEmbedding.vector
+    ).order_by(FaceEmbedding.visitor_id).all()
+
+    if not rows:
+        return np.empty(0, dtype=np.int64), np.empty((0, 0), dtype=np.float32)
+
+    visitor_ids = np.fromiter((row.visitor_id for row in rows), dtype=np.int64, count=len(rows))
+    embeddings = np.vstack([np.frombuffer(row.vector, dtype=np.float32) for row in rows])
+    return visitor_ids, embeddings
+
+def load_watchlist(model_name=None):
+    """Ready embeddings of banned visitors only, as (visitor ids, embeddings)"""
+    rows = _gallery_query(model_name or serving_model(), FaceEmbedding.visitor_id, FaceEmbedding.vector).filter(
+        Visitor.is_banned.is_(True)
+    ).order_by(FaceEmbedding.visitor_id).all()
+
+    if not rows:
+        return np.empty(0, dtype=np.int64), np.empty((0, 0), dtype=np.float32)
+
+    visitor_ids = np.fromiter((row.visitor_id for row in rows), dtype=np.int64, count=len(rows))
+    embeddings = np.vstack([np.frombuffer(row.vector, dtype=np.float32) for row in rows])
+    return visitor_ids, embeddings
+
+def get_gallery_version(model_name=None):
+    """Cheap fingerprint of the stored gallery, changes whenever an embedding is added, updated or removed"""
+    count, last_updated = _gallery_query(
+        model_name or serving_model(), db.func.count(FaceEmbedding.id), db.func.max(FaceEmbedding.updated_at)
+    ).one()
+    return f"{count}:{last_updated.isoformat() if last_updated else ''}"
+
+### Snapshots ###
+
+class GallerySnapshot:
+    """
+    A published gallery snapshot, opened read-only with mmap so that every worker
+    process on the host shares the same physical pages. Changes made after it was
+    written are replayed on top from the change log.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, 'meta.json')) as f:
+            self.meta = json.load(f)
+
+        self.name = self.meta['name']
+        self.gallery_version = self.meta['gallery_version']
+        self.visitor_ids = self._load('ids.npy')
+        self.embeddings = self._load('vectors.npy')
+        self.scales = self._load('scales.npy')
+        self.centroids = self._load('centroids.npy')
+        self.offsets = self._load('offsets.npy')
+
+    def _load(self, filename):
+        file_path = os.path.join(self.path, filename)
+        if not os.path.exists(file_path):
+            return None
+        return np.load(file_path, mmap_mode='r')
+
+    def build_index(self, nprobe):
+        """Index over the mapped arrays; nothing is copied into process memory"""
+        if self.meta['layout'] == 'ivf':
+            return IVFFaceIndex.from_arrays(
+                self.visitor_ids, self.embeddings, self.centroids, self.offsets, self.scales, nprobe=nprobe
+            )
+        index = create_face_index(backend='exact', gallery_size=len(self.visitor_ids))
+        return index.build(self.visitor_ids, self.embeddings, self.scales)
+
+def read_snapshot_pointer(snapshot_dir):
+    """Name of the currently published snapshot, or None if there is none yet"""
+    try:
+        with open(os.path.join(snapshot_dir, SNAPSHOT_POINTER)) as f:
+            return f.read().strip() or None
+    except FileNotFoundError:
+        return None
+
+def _publish_snapshot(snapshot_dir, name):
+    """Atomically point CURRENT at a snapshot, then drop all but it and its predecessor"""
+    previous = read_snapshot_pointer(snapshot_dir)
+    tmp_path = os.path.join(snapshot_dir, f"{SNAPSHOT_POINTER}.tmp")
+    with open(tmp_path, 'w') as f:
+        f.write(name)
+    os.replace(tmp_path, os.path.join(snapshot_dir, SNAPSHOT_POINTER))
+
+    # Workers still mapping an unlinked snapshot keep their pages until they swap
+    for entry in os.listdir(snapshot_dir):
+        entry_path = os.path.join(snapshot_dir, entry)
+        if os.path.isdir(entry_path) and entry not in (name, previous):
+            shutil.rmtree(entry_path, ignore_errors=True)
+
+def write_gallery_snapshot(dtype=None, blocking=True, model_name=None):
+    """
+    Build a snapshot of the stored gallery and publish it for every worker.
+    Only one process writes at a time; with blocking=False this returns None
+    instead of waiting when another process already holds the lock.
+
+    Args:
+        dtype (str): Storage type, 'float32', 'float16' or 'int8' (defaults to GALLERY_SNAPSHOT_DTYPE)
+        model_name (str): Model whose gallery is written (defaults to the serving one)
+
+    Returns:
+        dict or None: Metadata of the published snapshot
+    """
+    config = current_app.config
+    snapshot_dir = config['GALLERY_SNAPSHOT_DIR']
+    dtype = dtype or config['GALLERY_SNAPSHOT_DTYPE']
+    model_name = model_name or serving_model()
+    os.makedirs(snapshot_dir, exist_ok=True)
+
+    with open(os.path.join(snapshot_dir, SNAPSHOT_LOCK), 'w') as lock_file:
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | (0 if blocking else fcntl.LOCK_NB))
+        except BlockingIOError:
+            return None
+
+        # Read the change id before the embeddings, so a write racing the load is replayed afterwards
+        last_change_id = latest_change_id()
+        version = get_gallery_version(model_name)
+        visitor_ids, embeddings = load_gallery(model_name)
+
+        # HNSW graphs cannot be memory-mapped, so snapshots use the IVF layout instead
+        backend = 'ivf' if config['FACE_INDEX_BACKEND'] == 'hnsw' else None
+        index = create_face_index(backend=backend, gallery_size=len(visitor_ids))
+        layout = 'ivf' if isinstance(index, IVFFaceIndex) and len(visitor_ids) else 'exact'
+        if layout == 'ivf':
+            index.build(visitor_ids, embeddings)
+            visitor_ids, embeddings = index.visitor_ids, index.embeddings
+
+        stored, scales = quantize_embeddings(embeddings, dtype)
+
+        name = f"{datetime.utcnow().strftime('%Y%m%dT%H%M%S%f')}-{len(visitor_ids)}"
+        tmp_path = os.path.join(snapshot_dir, f".{name}.tmp")
+        os.makedirs(tmp_path)
+        np.save(os.path.join(tmp_path, 'ids.npy'), visitor_ids)
+        np.save(os.path.join(tmp_path, 'vectors.npy'), stored)
+        if scales is not None:
+            np.save(os.path.join(tmp_path, 'scales.npy'), scales)
+        if layout == 'ivf':
+            np.save(os.path.join(tmp_path, 'centroids.npy'), index.centroids)
+            np.save(os.path.join(tmp_path, 'offsets.npy'), index.offsets)
+
+        meta = {
+            'name': name,
+            'gallery_version': version,
+            'last_change_id': last_change_id,
+            'model_name': model_name,
+            'dtype': dtype,
+            'layout': layout,
+            'count': int(len(visitor_ids)),
+            'dimensions': int(stored.shape[1]) if stored.ndim == 2 else 0,
+            'size_bytes': int(stored.nbytes),
+            'created_at': datetime.utcnow().isoformat()
+        }
+        with open(os.path.join(tmp_path, 'meta.json'), 'w') as f:
+            json.dump(meta, f, indent=2)
+
+        os.rename(tmp_path, os.path.join(snapshot_dir, name))
+        _publish_snapshot(snapshot_dir, name)
+        return meta
+
+### Change log ###
+
+def record_gallery_change(visitor_id, change_type=GalleryChangeType.EMBEDDING):
+    """Log a change to a visitor's gallery entry in the current transaction; the caller commits"""
+    db.session.add(GalleryChange(visitor_id=visitor_id, change_type=change_type))
+
+def latest_change_id():
+    return db.session.query(db.func.max(GalleryChange.id)).scalar() or 0
+
+### Per-process index ###
+
+_lock = threading.Lock()
+_sync_lock = threading.Lock()
+_state = {
+    'model_name': None,
+    'index': None,
+    'watchlist': None,
+    'snapshot': None,
+    'last_change_id': 0,
+    'change_gaps': {},
+    'base_built_at': None,
+    'sync_pid': None,
+    'pruned_at': 0.0,
+    'migration_checked_at': 0.0
+}
+_sync_stats = {
+    'last_sync_at': None,
+    'changes_applied': 0,
+    'base_rebuilds': 0,
+    'staleness': deque(maxlen=1000),
+    'max_staleness': 0.0
+}
+_change_listeners = []
+_watchlist_stats = {
+    'checks': 0,
+    'hits': 0,
+    'over_budget': 0,
+    'latency_ms': deque(maxlen=1000)
+}
+
+def on_gallery_change(listener):
+    """Register listener(visitor_ids), called whenever this process applies changes for those visitors"""
+    _change_listeners.append(listener)
+
+def get_face_index():
+    """
+    Return this process's face index. The first call loads it, from the shared snapshot
+    if enabled or from the database otherwise, and starts the background sync thread
+    that applies later changes incrementally.
+    """
+    if _state['index'] is None or _state['sync_pid'] != os.getpid():
+        with _lock, _sync_lock:
+            if _state['index'] is None:
+                _load_base()
+            if _state['sync_pid'] != os.getpid():
+                _start_sync_thread()
+    return _state['index']
+
+def get_face_model():
+    """Recognition model this process's gallery holds; probes must be embedded with it"""
+    get_face_index()
+    return _state['model_name']
+
+def get_watchlist_index():
+    """Return this process's index over banned visitors, loaded and synced together with the face index"""
+    get_face_index()
+    return _state['watchlist']
+
+def check_watchlist(probe_embedding):
+    """
+    Match a probe against banned visitors only. The watchlist is small and searched exactly,
+    so this answers "is this person banned?" well within WATCHLIST_LATENCY_BUDGET_MS,
+    before any full-gallery search.
+
+    Returns:
+        tuple: (int, float) - matching banned visitor id (or None) and its distance
+    """
+    watchlist = get_watchlist_index()
+
+    started = time.perf_counter()
+    visitor_id, distance = find_matching_visitor(probe_embedding, watchlist)
+    elapsed_ms = (time.perf_counter() - started) * 1000
+
+    _watchlist_stats['checks'] += 1
+    _watchlist_stats['latency_ms'].append(elapsed_ms)
+    if visitor_id is not None:
+        _watchlist_stats['hits'] += 1
+
+    budget_ms = current_app.config['WATCHLIST_LATENCY_BUDGET_MS']
+    if elapsed_ms > budget_ms:
+        _watchlist_stats['over_budget'] += 1
+        current_app.logger.warning(
+            f"Watchlist check took {elapsed_ms:.1f} ms for {len(watchlist)} entries (budget {budget_ms} ms)"
+        )
+
+    return visitor_id, distance
+
+def apply_gallery_changes():
+    """Apply pending changes to this process's indexes now, rather than on the next sync"""
+    if _state['index'] is None:
+        return
+    with _sync_lock:
+        _state['last_change_id'] = _apply_changes(
+            _state['index'], _state['watchlist'], _state['last_change_id'], _state['change_gaps']
+        )
+
+def _load_base():
+    """Build a fresh base index from the snapshot or the database, then replay the changes made since"""
+    config = current_app.config
+    model_name = serving_model()
+
+    if config['GALLERY_SNAPSHOT_ENABLED']:
+        snapshot_dir = config['GALLERY_SNAPSHOT_DIR']
+        name = read_snapshot_pointer(snapshot_dir)
+        snapshot = GallerySnapshot(os.path.join(snapshot_dir, name)) if name else None
+
+        # Changes older than the retention window are pruned, so an old snapshot can't be caught up
+        if (snapshot is None or snapshot.meta['model_name'] != model_name
+                or _snapshot_age_hours(snapshot) > config['GALLERY_CHANGE_RETENTION_HOURS']):
+            write_gallery_snapshot(model_name=model_name)
+            snapshot = GallerySnapshot(os.path.join(snapshot_dir, read_snapshot_pointer(snapshot_dir)))
+
+        base = snapshot.build_index(config['FACE_INDEX_IVF_NPROBE'])
+        since = snapshot.meta['last_change_id']
+    else:
+        snapshot = None
+        since = latest_change_id()
+        visitor_ids, embeddings = load_gallery(model_name)
+        base = create_face_index(gallery_size=len(visitor_ids))
+        if len(visitor_ids):
+            base.build(visitor_ids, embeddings)
+
+    watchlist = MutableFaceIndex(ExactFaceIndex().build(*load_watchlist(model_name)), model_name)
+
+    index = MutableFaceIndex(base, model_name)
+    change_gaps = _change_gaps_before(since)
+    last_change_id = _apply_changes(index, watchlist, since, change_gaps, measure=False)
+    _state.update(
+        model_name=model_name, index=index, watchlist=watchlist, snapshot=snapshot,
+        last_change_id=last_change_id, change_gaps=change_gaps, base_built_at=datetime.utcnow(),
+        migration_checked_at=time.monotonic()
+    )
+    _sync_stats['base_rebuilds'] += 1
+
+def _snapshot_age_hours(snapshot):
+    created_at = datetime.fromisoformat(snapshot.meta['created_at'])
+    return (datetime.utcnow() - created_at).total_seconds() / 3600
+
+def _change_gaps_before(since, lookback=1000):
+    """
+    Change ids at or below since that are not visible yet. Ids are handed out when a change is
+    written, not when its transaction commits, so a slow transaction can commit a lower id after
+    higher ones have been read. Ids older than the oldest visible one were pruned, not delayed.
+    """
+    visible = {
+        change_id for (change_id,) in
+        db.session.query(GalleryChange.id).filter(GalleryChange.id > since - lookback, GalleryChange.id <= since)
+    }
+    if not visible:
+        return {}
+    now = time.monotonic()
+    return {change_id: now for change_id in range(min(visible) + 1, since) if change_id not in visible}
+
+def _late_changes(gaps):
+    """Changes that have committed since their ids were found missing; gaps past the wait are given up"""
+    cutoff = time.monotonic() - current_app.config['GALLERY_CHANGE_GAP_SECONDS']
+    for change_id in [change_id for change_id, found_at in gaps.items() if found_at < cutoff]:
+        # Most often a rolled-back transaction, whose id is never used
+        del gaps[change_id]
+    if not gaps:
+        return []
+
+    changes = GalleryChange.query.filter(GalleryChange.id.in_(list(gaps))).all()
+    for change in changes:
+        del gaps[change.id]
+    return changes
+
+def _apply_changes(index, watchlist, since, gaps, measure=True, batch_size=1000):
+    """
+    Bring the face index and watchlist up to date with the change log. Each changed visitor is
+    re-read from the database, so replaying a change twice or out of order is harmless.
+
+    Ids skipped on the way, whose transactions may still commit, are kept in gaps (change id ->
+    when it was found missing) and looked for again on later calls, for up to
+    GALLERY_CHANGE_GAP_SECONDS.
+
+    Returns:
+        int: Id of the highest change applied
+    """
+    changes = _late_changes(gaps)
+    while True:
+        new_changes = GalleryChange.query.filter(GalleryChange.id > since).order_by(GalleryChange.id).limit(batch_size).all()
+        if new_changes:
+            now = time.monotonic()
+            new_ids = {change.id for change in new_changes}
+            for change_id in range(since + 1, new_changes[-1].id):
+                if change_id not in new_ids:
+                    gaps[change_id] = now
+            since = new_changes[-1].id
+        changes += new_changes
+        if not changes:
+            return since
+
+        visitor_ids = {change.visitor_id for change in changes}
+        rows = _gallery_query(index.model_name, FaceEmbedding.visitor_id, FaceEmbedding.vector, Visitor.is_banned).filter(
+            FaceEmbedding.visitor_id.in_(visitor_ids)
+        ).all()
+        embeddings = {row.visitor_id: np.frombuffer(row.vector, dtype=np.float32) for row in rows}
+        banned = {row.visitor_id for row in rows if row.is_banned}
+
+        index.update({visitor_id: embeddings.get(visitor_id) for visitor_id in visitor_ids})
+        watchlist.update({
+            visitor_id: embeddings[visitor_id] if visitor_id in banned else None
+            for visitor_id in visitor_ids
+        })
+        for listener in _change_listeners:
+            listener(visitor_ids)
+
+        if measure:
+            now = datetime.utcnow()
+            for change in changes:
+                staleness = (now - change.created_at).total_seconds()
+                _sync_stats['staleness'].append(staleness)
+                _sync_stats['max_staleness'] = max(_sync_stats['max_staleness'], staleness)
+            _sync_stats['changes_applied'] += len(changes)
+
+        changes = []
+
+def _start_sync_thread():
+    app = current_app._get_current_object()
+    threading.Thread(target=_sync_loop, args=(app,), name='gallery-sync', daemon=True).start()
+    _state['sync_pid'] = os.getpid()
+
+def _sync_loop(app):
+    while True:
+        time.sleep(app.config['GALLERY_SYNC_SECONDS'])
+        with app.app_context():
+            try:
+                sync_gallery()
+            except Exception as e:
+                db.session.rollback()
+                app.logger.error(f"Error syncing face gallery: {str(e)}")
+
+def sync_gallery():
+    """
+    One sync round: swap to a newly published snapshot, or else apply new changes from the log,
+    and rebuild the base once the incremental delta has grown past GALLERY_MAX_PENDING_CHANGES.
+    """
+    config = current_app.config
+    snapshot_enabled = config['GALLERY_SNAPSHOT_ENABLED']
+
+    if snapshot_enabled:
+        name = read_snapshot_pointer(config['GALLERY_SNAPSHOT_DIR'])
+        if name and (_state['snapshot'] is None or _state['snapshot'].name != name):
+            with _lock, _sync_lock:
+                _load_base()
+            return
+
+    if _cutover_due():
+        with _lock, _sync_lock:
+            _load_base()
+        current_app.logger.info(f"Face gallery switched to {_state['model_name']}")
+        return
+
+    apply_gallery_changes()
+    _sync_stats['last_sync_at'] = datetime.utcnow().isoformat()
+
+    if _state['index'].pending_changes > config['GALLERY_MAX_PENDING_CHANGES']:
+        if snapshot_enabled:
+            # Every worker swaps to it on its next sync
+            write_gallery_snapshot(blocking=False)
+        else:
+            with _lock, _sync_lock:
+                _load_base()
+
+    _prune_change_log()
+
+def _cutover_due():
+    """During a migration, whether the new model's gallery has become complete since this process loaded"""
+    config = current_app.config
+    if _state['model_name'] == config['FACE_MODEL']:
+        return False
+    if time.monotonic() - _state['migration_checked_at'] < config['FACE_MIGRATION_CHECK_SECONDS']:
+        return False
+    _state['migration_checked_at'] = time.monotonic()
+    return serving_model() != _state['model_name']
+
+def _prune_change_log():
+    """Drop change log entries older than the retention window, at most once an hour per process"""
+    if time.monotonic() - _state['pruned_at'] < 3600:
+        return
+    _state['pruned_at'] = time.monotonic()
+
+    cutoff = datetime.utcnow() - timedelta(hours=current_app.config['GALLERY_CHANGE_RETENTION_HOURS'])
+    GalleryChange.query.filter(GalleryChange.created_at < cutoff).delete(synchronize_session=False)
+    db.session.commit()
+
+def gallery_status():
+    """Size, source and sync lag of this process's gallery, for monitoring"""
+    index = _state['index']
+    snapshot = _state['snapshot']
+    config = current_app.config
+
+    # Time from a change being committed to this process applying it
+    staleness = percentiles(_sync_stats['staleness'])
+    if staleness is not None:
+        staleness.update(last=float(_sync_stats['staleness'][-1]), max=_sync_stats['max_staleness'])
+
+    return {
+        'mode': 'snapshot' if config['GALLERY_SNAPSHOT_ENABLED'] else 'memory',
+        'model_name': _state['model_name'],
+        'migration': migration_status() if config['FACE_MODEL_PREVIOUS'] else None,
+        'size': len(index) if index is not None else None,
+        'index': type(index.base).__name__ if index is not None else None,
+        'pending_changes': index.pending_changes if index is not None else None,
+        'last_change_id': _state['last_change_id'],
+        'change_gaps': len(_state['change_gaps']),
+        'base_built_at': _state['base_built_at'].isoformat() if _state['base_built_at'] else None,
+        'snapshot': snapshot.meta if snapshot is not None else None,
+        'watchlist': _watchlist_status(),
+        'sync': {
+            'interval_seconds': config['GALLERY_SYNC_SECONDS'],
+            'last_sync_at': _sync_stats['last_sync_at'],
+            'changes_applied': _sync_stats['changes_applied'],
+            'base_rebuilds': _sync_stats['base_rebuilds'],
+            'staleness_seconds': staleness
+        }
+    }
+
+def _watchlist_status():
+    watchlist = _state['watchlist']
+    return {
+        'size': len(watchlist) if watchlist is not None else None,
+        'checks': _watchlist_stats['checks'],
+        'hits': _watchlist_stats['hits'],
+        'budget_ms': current_app.config['WATCHLIST_LATENCY_BUDGET_MS'],
+        'over_budget': _watchlist_stats['over_budget'],
+        'latency_ms': percentiles(_watchlist_stats['latency_ms'])
+    }
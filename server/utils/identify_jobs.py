@@ -0,0 +1,111 @@
+# utils/identify_jobs.py - Bounded worker pool for asynchronous identification jobs
+
+import os
+import time
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from flask import current_app
+from utils.stats import percentiles
+
+class JobQueueFullError(Exception):
+    """Every worker is busy and the queue is at IDENTIFY_JOB_QUEUE_SIZE"""
+
+_executor = None
+_executor_pid = None
+_lock = threading.Lock()
+_finished = {}  # job id -> threading.Event, for jobs run by this process
+_stats = {
+    'queued': 0,
+    'running': 0,
+    'completed': 0,
+    'failed': 0,
+    'rejected': 0,
+    'queue_ms': deque(maxlen=1000),
+    'run_ms': deque(maxlen=1000),
+    'total_ms': deque(maxlen=1000)
+}
+
+def _get_executor():
+    """Create the pool lazily, and again after a fork, so each process owns its threads"""
+    global _executor, _executor_pid
+
+    if _executor is None or _executor_pid != os.getpid():
+        _executor = ThreadPoolExecutor(
+            max_workers=current_app.config['IDENTIFY_JOB_WORKERS'],
+            thread_name_prefix='identify-job'
+        )
+        _executor_pid = os.getpid()
+        _finished.clear()
+        _stats.update(queued=0, running=0)
+    return _executor
+
+def submit_job(job_id, fn, *args):
+    """
+    Run fn(*args) for a job on the pool. Jobs wait in a bounded queue; when it is
+    full the job is refused rather than left to wait indefinitely.
+
+    Raises:
+        JobQueueFullError: The queue is full
+    """
+    with _lock:
+        executor = _get_executor()
+        if _stats['queued'] >= current_app.config['IDENTIFY_JOB_QUEUE_SIZE']:
+            _stats['rejected'] += 1
+            raise JobQueueFullError("Identification queue is full")
+        _stats['queued'] += 1
+        _finished[job_id] = threading.Event()
+
+    executor.submit(_run, job_id, time.perf_counter(), fn, *args)
+
+def _run(job_id, submitted_at, fn, *args):
+    started = time.perf_counter()
+    with _lock:
+        _stats['queued'] -= 1
+        _stats['running'] += 1
+
+    succeeded = False
+    try:
+        succeeded = fn(*args) is not False
+    finally:
+        finished = time.perf_counter()
+        with _lock:
+            _stats['running'] -= 1
+            _stats['completed' if succeeded else 'failed'] += 1
+            _stats['queue_ms'].append((started - submitted_at) * 1000)
+            _stats['run_ms'].append((finished - started) * 1000)
+            _stats['total_ms'].append((finished - submitted_at) * 1000)
+            event = _finished.pop(job_id, None)
+        if event:
+            event.set()
+
+def wait_for_job(job_id, timeout):
+    """
+    Block until a job run by this process finishes, or the timeout passes.
+    For jobs on other processes (or already finished) this just sleeps the timeout,
+    and the caller re-reads the job from the database.
+    """
+    event = _finished.get(job_id)
+    if event is None:
+        time.sleep(timeout)
+        return False
+    return event.wait(timeout)
+
+def queue_depth():
+    return _stats['queued']
+
+def job_stats():
+    """Queue depth, saturation and latency of this process's identification jobs"""
+    config = current_app.config
+    return {
+        'workers': config['IDENTIFY_JOB_WORKERS'],
+        'queue_size': config['IDENTIFY_JOB_QUEUE_SIZE'],
+        'queue_depth': _stats['queued'],
+        'running': _stats['running'],
+        'completed': _stats['completed'],
+        'failed': _stats['failed'],
+        'rejected': _stats['rejected'],
+        'queue_ms': percentiles(_stats['queue_ms']),
+        'run_ms': percentiles(_stats['run_ms']),
+        'total_ms': percentiles(_stats['total_ms'])
+    }
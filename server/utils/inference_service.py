@@ -0,0 +1,448 @@
+# utils/inference_service.py - Out-of-process face inference over a Unix socket
+
+import os
+import sys
+import json
+import time
+import fcntl
+import signal
+import socket
+import struct
+import threading
+import subprocess
+import socketserver
+import numpy as np
+from flask import current_app
+from utils.biometric import (
+    decode_image, crop_face, represent_image, represent_face_crop, get_probe_embedding, get_probe_faces,
+    model_registry, inference_batcher
+)
+
+HEADER_LENGTH = struct.Struct('!I')
+
+class InferenceServiceError(Exception):
+    """The inference service could not produce an answer"""
+
+class InferenceBusyError(InferenceServiceError):
+    """The inference service is at capacity and turned the request away"""
+
+class InferenceTimeoutError(InferenceServiceError):
+    """The inference service did not answer within the request timeout"""
+
+### Wire format ###
+# Every message is a length-prefixed JSON header followed by header['size'] raw payload bytes
+
+def write_message(stream, header, payload=b''):
+    header = dict(header, size=len(payload))
+    encoded = json.dumps(header).encode()
+    stream.write(HEADER_LENGTH.pack(len(encoded)) + encoded + payload)
+    stream.flush()
+
+def read_message(stream):
+    prefix = stream.read(HEADER_LENGTH.size)
+    if len(prefix) < HEADER_LENGTH.size:
+        raise EOFError("Connection closed")
+    header = json.loads(_read_exact(stream, HEADER_LENGTH.unpack(prefix)[0]))
+    return header, _read_exact(stream, header['size'])
+
+def _read_exact(stream, size):
+    data = stream.read(size)
+    if len(data) < size:
+        raise EOFError("Connection closed mid-message")
+    return data
+
+### Server ###
+
+class InferenceServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """
+    Holds the face models and embeds images sent by web workers. At most max_pending
+    requests are in flight; any more are answered 'busy' at once rather than queued,
+    so overload shows up at the web workers as backpressure instead of latency.
+    """
+    daemon_threads = True
+
+    def __init__(self, socket_path, max_pending):
+        self.max_pending = max_pending
+        self.slots = threading.BoundedSemaphore(max_pending)
+        self.started_at = time.time()
+        self.counts = {'ok': 0, 'no_face': 0, 'invalid_image': 0, 'busy': 0, 'error': 0}
+        self._counts_lock = threading.Lock()  # Every connection has its own handler thread
+        super().__init__(socket_path, InferenceRequestHandler)
+
+    def count(self, status):
+        with self._counts_lock:
+            self.counts[status] += 1
+
+    def dispatch(self, header, payload):
+        op = header.get('op')
+        if op == 'ping':
+            return {'status': 'ok', 'pid': os.getpid()}, b''
+        if op == 'stats':
+            return {'status': 'ok', 'stats': self.stats()}, b''
+        if op not in ('embed', 'embed_crop', 'embed_faces'):
+            return {'status': 'error', 'message': f"Unknown operation {op}"}, b''
+
+        if not self.slots.acquire(blocking=False):
+            self.count('busy')
+            return {'status': 'busy'}, b''
+        try:
+            # Web workers name the model their gallery holds; it differs from the default during a migration
+            model_name = header.get('model')
+            if op == 'embed_faces':
+                return self._embed_faces(header, payload, model_name)
+            if op == 'embed_crop':
+                crop = np.frombuffer(payload, dtype=np.uint8).reshape(header['shape'])
+                embedding = represent_face_crop(crop, model_name)
+            else:
+                img = decode_image(payload)
+                if img is None:
+                    self.count('invalid_image')
+                    return {'status': 'invalid_image'}, b''
+                embedding = represent_image(img, model_name)
+
+            status = 'no_face' if embedding is None else 'ok'
+            self.count(status)
+            return {'status': status}, b'' if embedding is None else embedding.astype(np.float32).tobytes()
+        except Exception as e:
+            self.count('error')
+            return {'status': 'error', 'message': str(e)}, b''
+        finally:
+            self.slots.release()
+
+    def _embed_faces(self, header, payload, model_name):
+        """Every face in several images; embeddings are returned back to back in the payload"""
+        images_bytes, offset = [], 0
+        for size in header['sizes']:
+            images_bytes.append(payload[offset:offset + size])
+            offset += size
+
+        results = get_probe_faces(images_bytes, model_name)
+        faces = [None if image_faces is None else [box for box, _ in image_faces] for image_faces in results]
+        embeddings = [embedding for image_faces in results if image_faces for _, embedding in image_faces]
+        self.count('ok')
+        result = np.asarray(embeddings, dtype=np.float32).tobytes() if embeddings else b''
+        return {'status': 'ok', 'faces': faces}, result
+
+    def stats(self):
+        with self._counts_lock:
+            responses = dict(self.counts)
+        return {
+            'pid': os.getpid(),
+            'uptime_seconds': time.time() - self.started_at,
+            'max_pending': self.max_pending,
+            'responses': responses,
+            'model_registry': model_registry.stats(),
+            'inference': inference_batcher.stats()
+        }
+
+class InferenceRequestHandler(socketserver.StreamRequestHandler):
+    """Serves requests on one web worker connection until it is closed"""
+
+    def handle(self):
+        while True:
+            try:
+                header, payload = read_message(self.rfile)
+            except (EOFError, ConnectionError):
+                return
+            response, result = self.server.dispatch(header, payload)
+            try:
+                write_message(self.wfile, response, result)
+            except (BrokenPipeError, ConnectionError):
+                # The client gave up (timed out) while we were working
+                return
+
+def serve_inference(socket_path, max_pending, batch_window_ms=None, batch_max_size=None, warm_up=True,
+                    model_names=None, runtime='tensorflow', onnx_dir=None, onnx_threads=0):
+    """Run the inference service in the current process until it is killed"""
+    if os.path.exists(socket_path):
+        os.remove(socket_path)
+    model_registry.configure(model_names or model_registry.model_names, runtime, onnx_dir, onnx_threads)
+    if batch_window_ms:
+        inference_batcher.configure(batch_window_ms, batch_max_size)
+
+    server = InferenceServer(socket_path, max_pending)
+    print(f"Inference service listening on {socket_path} (pid {os.getpid()})")
+
+    # Accept connections while the models load; early requests wait for the build
+    if warm_up:
+        threading.Thread(target=model_registry.warm_up, name='inference-warm-up', daemon=True).start()
+    server.serve_forever()
+
+def face_model_names(config):
+    """Recognition models in use: FACE_MODEL, plus the previous one while a migration is running"""
+    return [config['FACE_MODEL']] + ([config['FACE_MODEL_PREVIOUS']] if config['FACE_MODEL_PREVIOUS'] else [])
+
+def start_inference_service(config):
+    """
+    Start the inference service alongside the app unless one is already answering on the
+    socket. Every web worker calls this at startup, and again whenever the service stops
+    answering (see get_inference_client); a file lock makes sure only one starts it.
+
+    The service runs detached in its own session, as a fresh interpreter rather than a fork
+    (TensorFlow state does not survive one), so it outlives the worker that started it.
+    With INFERENCE_SERVICE_AUTOSTART off, run `flask inference-server` under a process
+    supervisor instead.
+
+    Returns:
+        subprocess.Popen or None: The started service, or None if one was already running
+    """
+    socket_path = config['INFERENCE_SOCKET_PATH']
+    with open(f"{socket_path}.lock", 'w') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        if _ping(socket_path):
+            return None
+        _stop_stale_service(f"{socket_path}.pid")
+
+        settings = {
+            'socket_path': socket_path,
+            'max_pending': config['INFERENCE_MAX_PENDING'],
+            'batch_window_ms': config['FACE_BATCH_WINDOW_MS'] if config['FACE_BATCHING_ENABLED'] else None,
+            'batch_max_size': config['FACE_BATCH_MAX_SIZE'],
+            'model_names': face_model_names(config),
+            'runtime': config['FACE_RUNTIME'],
+            'onnx_dir': config['FACE_ONNX_DIR'],
+            'onnx_threads': config['FACE_ONNX_THREADS']
+        }
+        process = subprocess.Popen(
+            [sys.executable, '-m', 'utils.inference_service', json.dumps(settings)],
+            cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+            start_new_session=True
+        )
+        with open(f"{socket_path}.pid", 'w') as pid_file:
+            pid_file.write(str(process.pid))
+
+        deadline = time.monotonic() + 30
+        while not _ping(socket_path) and time.monotonic() < deadline:
+            time.sleep(0.1)
+        return process
+
+def _stop_stale_service(pid_path):
+    """Terminate a service started earlier that is still running but no longer answers pings"""
+    try:
+        with open(pid_path) as pid_file:
+            pid = int(pid_file.read())
+        # The pid may have been reused by an unrelated process since
+        with open(f"/proc/{pid}/cmdline", 'rb') as cmdline:
+            if b'utils.inference_service' in cmdline.read():
+                os.kill(pid, signal.SIGTERM)
+    except (OSError, ValueError):
+        pass
+
+def _restart_inference_service(config):
+    """Start the service again after it stopped answering; True once one answers"""
+    start_inference_service(config)
+    return _ping(config['INFERENCE_SOCKET_PATH'])
+
+def _ping(socket_path):
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            sock.settimeout(1.0)
+            sock.connect(socket_path)
+            with sock.makefile('rwb') as stream:
+                write_message(stream, {'op': 'ping'})
+                header, _ = read_message(stream)
+                return header.get('status') == 'ok'
+    except (OSError, EOFError, ValueError):
+        return False
+
+### Client ###
+
+class InferenceClient:
+    """
+    Web worker side of the inference service. Each thread keeps its own connection,
+    and every request is bounded by the timeout.
+    """
+
+    def __init__(self, socket_path, timeout, restart=None):
+        self.socket_path = socket_path
+        self.timeout = timeout
+        self.restart = restart  # Called when the service can't be reached; True if it answers again
+        self._local = threading.local()
+
+    def _connect(self):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(self.timeout)
+        sock.connect(self.socket_path)
+        self._local.connection = (os.getpid(), sock, sock.makefile('rwb'))
+        return self._local.connection
+
+    def _close(self):
+        connection = getattr(self._local, 'connection', None)
+        self._local.connection = None
+        if connection:
+            _, sock, stream = connection
+            try:
+                stream.close()
+                sock.close()
+            except OSError:
+                pass
+
+    def request(self, header, payload=b''):
+        """
+        Send one request and wait for its answer. A kept connection that went stale is replaced
+        once, and a service that can't be reached is restarted once, before giving up.
+        """
+        connection = getattr(self._local, 'connection', None)
+        reused = connection is not None and connection[0] == os.getpid()
+        restarted = False
+
+        for attempt in range(3):
+            try:
+                if not reused or attempt:
+                    connection = self._connect()
+                _, _, stream = connection
+                write_message(stream, header, payload)
+                return read_message(stream)
+            except socket.timeout:
+                # A late answer would be read as the reply to the next request
+                self._close()
+                raise InferenceTimeoutError(f"Inference service did not answer within {self.timeout} s")
+            except (OSError, EOFError) as e:
+                self._close()
+                if reused and not attempt:
+                    continue
+                if not restarted and self.restart is not None and self.restart():
+                    restarted = True
+                    continue
+                raise InferenceServiceError(f"Inference service unavailable: {str(e)}")
+
+    def embed_image(self, image_bytes, model_name=None):
+        """
+        Embed the largest face in an encoded image, with the service's default model unless one is named
+
+        Returns:
+            numpy.ndarray or None: L2-normalized float32 embedding, or None if no face was found
+        """
+        header, payload = self.request({'op': 'embed', 'model': model_name}, image_bytes)
+        status = header['status']
+        if status == 'ok':
+            return np.frombuffer(payload, dtype=np.float32)
+        if status in ('no_face', 'invalid_image'):
+            return None
+        if status == 'busy':
+            raise InferenceBusyError("Inference service is at capacity")
+        raise InferenceServiceError(header.get('message', status))
+
+    def embed_face_crop(self, crop, model_name=None):
+        """
+        Embed a face crop located by the quality gate, sent as raw BGR pixels
+
+        Returns:
+            numpy.ndarray or None: L2-normalized float32 embedding, or None if no face was found
+        """
+        crop = np.ascontiguousarray(crop)
+        header, payload = self.request({'op': 'embed_crop', 'model': model_name, 'shape': list(crop.shape)}, crop.tobytes())
+        if header['status'] == 'ok':
+            return np.frombuffer(payload, dtype=np.float32)
+        if header['status'] == 'no_face':
+            return None
+        if header['status'] == 'busy':
+            raise InferenceBusyError("Inference service is at capacity")
+        raise InferenceServiceError(header.get('message', header['status']))
+
+    def embed_faces(self, images_bytes, model_name=None):
+        """
+        Every face in several encoded images
+
+        Returns:
+            list: Per image, a list of (box, embedding) pairs, or None if the image could not be decoded
+        """
+        header, payload = self.request(
+            {'op': 'embed_faces', 'model': model_name, 'sizes': [len(image_bytes) for image_bytes in images_bytes]},
+            b''.join(images_bytes)
+        )
+        if header['status'] == 'busy':
+            raise InferenceBusyError("Inference service is at capacity")
+        if header['status'] != 'ok':
+            raise InferenceServiceError(header.get('message', header['status']))
+
+        face_count = sum(len(boxes) for boxes in header['faces'] if boxes)
+        embeddings = np.frombuffer(payload, dtype=np.float32).reshape(face_count, -1) if face_count else []
+
+        results, position = [], 0
+        for boxes in header['faces']:
+            if boxes is None:
+                results.append(None)
+                continue
+            results.append([(box, embeddings[position + i]) for i, box in enumerate(boxes)])
+            position += len(boxes)
+        return results
+
+    def stats(self):
+        header, _ = self.request({'op': 'stats'})
+        return header['stats']
+
+_client = None
+
+def get_inference_client():
+    global _client
+    if _client is None:
+        config = current_app.config
+        restart = (lambda: _restart_inference_service(config)) if config['INFERENCE_SERVICE_AUTOSTART'] else None
+        _client = InferenceClient(config['INFERENCE_SOCKET_PATH'], config['INFERENCE_TIMEOUT_SECONDS'], restart)
+    return _client
+
+def compute_embedding(image_bytes, model_name=None):
+    """
+    Embedding of the largest face in an encoded image, from the inference service when it
+    is enabled and in-process otherwise. Service errors are raised, not swallowed, so the
+    caller can tell an overloaded service from a photo without a face.
+
+    Args:
+        model_name (str): DeepFace model name, defaults to FACE_MODEL
+
+    Returns:
+        numpy.ndarray or None: L2-normalized float32 embedding, or None if no face was found
+    """
+    if current_app.config['INFERENCE_SERVICE_ENABLED']:
+        return get_inference_client().embed_image(image_bytes, model_name)
+    return get_probe_embedding(image_bytes, model_name)
+
+def _embed_in_process(embed, *args):
+    """
+    Run face recognition in this process, failing the way the inference service does: a model
+    that won't load, a TensorFlow error or a failed batch raises InferenceServiceError, so
+    callers answer it as they answer the service (503) rather than with a 500
+    """
+    try:
+        return embed(*args)
+    except Exception as e:
+        current_app.logger.error(f"Face recognition failed: {str(e)}")
+        raise InferenceServiceError("Face recognition failed") from e
+
+def compute_probe_embedding(img, image_bytes, face_box=None, model_name=None):
+    """
+    Embedding of a decoded probe. With the face box found by the quality gate, only the face
+    crop is passed on (and sent to the inference service), so detection doesn't scan the whole
+    frame again; without one the probe goes through the full pipeline.
+
+    Returns:
+        numpy.ndarray or None: L2-normalized float32 embedding, or None if no face was found
+
+    Raises:
+        InferenceServiceError: Face recognition failed, in the service or in this process
+    """
+    if current_app.config['INFERENCE_SERVICE_ENABLED']:
+        if face_box is None:
+            return get_inference_client().embed_image(image_bytes, model_name)
+        return get_inference_client().embed_face_crop(crop_face(img, face_box), model_name)
+
+    if face_box is None:
+        return _embed_in_process(represent_image, img, model_name)
+    return _embed_in_process(represent_face_crop, crop_face(img, face_box), model_name)
+
+def compute_face_embeddings(images_bytes, model_name=None):
+    """
+    Every face in several encoded images, embedded in one batched pass, from the inference
+    service when it is enabled and in-process otherwise
+
+    Returns:
+        list: Per image, a list of (box, embedding) pairs, or None if the image could not be decoded
+    """
+    if current_app.config['INFERENCE_SERVICE_ENABLED']:
+        return get_inference_client().embed_faces(images_bytes, model_name)
+    return _embed_in_process(get_probe_faces, images_bytes, model_name)
+
+if __name__ == '__main__':
+    # Started detached by start_inference_service
+    serve_inference(**json.loads(sys.argv[1]))
@@ -0,0 +1,116 @@
+# utils/probe_cache.py - Short-lived cache of identification results keyed by perceptual hash
+
+import time
+import threading
+from collections import OrderedDict
+import numpy as np
+import cv2
+from flask import current_app
+from utils.biometric import crop_face
+from utils.gallery import on_gallery_change
+
+HASH_SIZE = 16  # 16 x 16 difference hash, 256 bits
+
+def probe_hash(img):
+    """
+    Perceptual (difference) hash of a decoded image: stable across re-encoding, resizing and
+    small exposure changes, so a retried photo or a near-identical frame hashes the same or
+    within a few bits.
+
+    Returns:
+        int: 256-bit hash
+    """
+    gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+    # Halve with a Gaussian pyramid first: far cheaper than one large area resize, and size independent
+    while min(gray.shape) >= HASH_SIZE * 8:
+        gray = cv2.pyrDown(gray)
+    small = cv2.resize(gray, (HASH_SIZE + 1, HASH_SIZE), interpolation=cv2.INTER_AREA)
+    bits = (small[:, 1:] > small[:, :-1]).ravel()
+    return int.from_bytes(np.packbits(bits).tobytes(), 'big')
+
+class ProbeCache:
+    """
+    LRU cache of (visitor id, distance) results per probe hash, with a short TTL. A lookup hits
+    on an exact hash or on any entry within max_distance bits. Entries for a visitor are
+    dropped as soon as this process applies a gallery change for them (new photo, ban, unban,
+    delete), and "no match" entries on any change, since a new visitor may now match.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # hash -> (visitor id or None, distance, stored at)
+        self._stats = {'hits': 0, 'near_hits': 0, 'misses': 0, 'invalidated': 0}
+
+    def get(self, phash, ttl, max_distance):
+        """
+        Returns:
+            tuple or None: (visitor id or None, distance) of a cached result, or None on a miss
+        """
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(phash)
+            key = phash
+            if entry is None and max_distance:
+                key, entry = next(
+                    ((k, e) for k, e in reversed(self._entries.items()) if (k ^ phash).bit_count() <= max_distance),
+                    (None, None)
+                )
+
+            if entry is None or now - entry[2] > ttl:
+                self._stats['misses'] += 1
+                return None
+
+            self._entries.move_to_end(key)
+            self._stats['hits' if key == phash else 'near_hits'] += 1
+            return entry[0], entry[1]
+
+    def put(self, phash, visitor_id, distance, max_size):
+        with self._lock:
+            self._entries[phash] = (visitor_id, distance, time.monotonic())
+            self._entries.move_to_end(phash)
+            while len(self._entries) > max_size:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, visitor_ids):
+        """Drop cached results for these visitors, and every cached "no match"."""
+        visitor_ids = set(visitor_ids)
+        with self._lock:
+            stale = [k for k, (visitor_id, _, _) in self._entries.items() if visitor_id is None or visitor_id in visitor_ids]
+            for key in stale:
+                del self._entries[key]
+            self._stats['invalidated'] += len(stale)
+
+    def stats(self):
+        config = current_app.config
+        return {
+            'enabled': config['PROBE_CACHE_ENABLED'],
+            'size': len(self._entries),
+            'max_size': config['PROBE_CACHE_SIZE'],
+            'ttl_seconds': config['PROBE_CACHE_TTL_SECONDS'],
+            'max_hamming_distance': config['PROBE_CACHE_MAX_HAMMING'],
+            **self._stats
+        }
+
+probe_cache = ProbeCache()
+on_gallery_change(probe_cache.invalidate)
+
+def cached_match(img, face_box):
+    """
+    Look a decoded probe up in the cache by the face the quality gate found in it. Hashing
+    the whole frame would let a different person in front of the same background and
+    camera hit another visitor's result. Without a face box nothing is cached.
+
+    Returns:
+        tuple: (hash, cached result) - the face's hash for a later store_match (None if
+               caching is off) and (visitor id, distance) or None
+    """
+    config = current_app.config
+    if not config['PROBE_CACHE_ENABLED'] or face_box is None:
+        return None, None
+
+    phash = probe_hash(crop_face(img, face_box, margin=0))
+    return phash, probe_cache.get(phash, config['PROBE_CACHE_TTL_SECONDS'], config['PROBE_CACHE_MAX_HAMMING'])
+
+def store_match(phash, visitor_id, distance):
+    if phash is not None:
+        probe_cache.put(phash, visitor_id, distance, current_app.config['PROBE_CACHE_SIZE'])
@@ -0,0 +1,51 @@
+# utils/schema.py - Upgrades to existing databases that db.create_all() cannot make
+
+from sqlalchemy import inspect, text
+from extensions import db
+from models.user import Visitor, EmbeddingStatus
+
+# Columns added to tables that existing deployments already have. create_all() only creates
+# missing tables, so these are added here, together with their indexes.
+ADDED_COLUMNS = [
+    (Visitor.__table__, 'embedding_status'),
+]
+
+def _add_column(table, column_name):
+    column = table.c[column_name]
+    engine = db.engine
+    column_type = column.type.compile(dialect=engine.dialect)
+    with engine.begin() as connection:
+        # Native enum types (PostgreSQL) must exist before a column can use them
+        if hasattr(column.type, 'create'):
+            column.type.create(connection, checkfirst=True)
+        connection.execute(text(f'ALTER TABLE {table.name} ADD COLUMN {column.name} {column_type}'))
+        for index in table.indexes:
+            if column_name in index.columns:
+                index.create(connection)
+
+def upgrade_schema():
+    """
+    Add the columns new code expects to tables created by an older version. Safe to run on
+    every start: columns that exist are left alone.
+
+    Returns:
+        list: "table.column" names that were added
+    """
+    inspector = inspect(db.engine)
+    added = []
+    for table, column_name in ADDED_COLUMNS:
+        if not inspector.has_table(table.name):
+            continue
+        existing = {column['name'] for column in inspector.get_columns(table.name)}
+        if column_name not in existing:
+            _add_column(table, column_name)
+            added.append(f"{table.name}.{column_name}")
+
+    if 'visitors.embedding_status' in added:
+        # Photos registered before embeddings were stored; `flask backfill-embeddings` picks them up
+        visitors = Visitor.__table__
+        db.session.execute(
+            visitors.update().where(visitors.c.image_path.isnot(None)).values(embedding_status=EmbeddingStatus.PENDING)
+        )
+        db.session.commit()
+    return added
@@ -0,0 +1,222 @@
+# utils/sharded_search.py - Exact gallery search split into shards scanned by a pool of worker processes
+
+import os
+import sys
+import fcntl
+import threading
+import multiprocessing
+from collections import OrderedDict
+from multiprocessing import shared_memory
+import numpy as np
+
+# Kept free of the model imports in utils.biometric: shard workers import this module and only need numpy
+
+MAX_ATTACHED_GALLERIES = 2  # A worker keeps the galleries of the old and new index mapped during a swap
+SERVER_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+def cosine_distances(probe_embedding, embeddings, scales=None, chunk_size=16384):
+    """
+    Cosine distance between one L2-normalized probe and every row of a gallery matrix.
+
+    float32 galleries are scored with one matrix-vector product. float16 and int8 galleries
+    (typically memory-mapped) are upcast a chunk at a time so no full float32 copy is made;
+    int8 rows are multiplied by their per-vector scales.
+    """
+    if embeddings.dtype == np.float32 and scales is None:
+        return 1.0 - embeddings @ probe_embedding
+
+    similarities = np.empty(len(embeddings), dtype=np.float32)
+    for start in range(0, len(embeddings), chunk_size):
+        chunk = np.asarray(embeddings[start:start + chunk_size], dtype=np.float32)
+        similarities[start:start + chunk_size] = chunk @ probe_embedding
+    if scales is not None:
+        similarities *= scales
+    return 1.0 - similarities
+
+def top_k(distances, k):
+    """Indices of the k smallest distances, sorted ascending"""
+    k = min(k, len(distances))
+    if k <= 0:
+        return np.empty(0, dtype=np.int64)
+    candidates = np.argpartition(distances, k - 1)[:k]
+    return candidates[np.argsort(distances[candidates])]
+
+def shard_bounds(size, shards):
+    """Split size rows into at most shards contiguous (start, stop) ranges of near-equal length"""
+    edges = np.linspace(0, size, min(shards, size) + 1, dtype=np.int64)
+    return [(int(start), int(stop)) for start, stop in zip(edges[:-1], edges[1:])]
+
+class SharedArray:
+    """
+    An array workers can map without a copy through the pipe: the .npy file itself when the
+    array is a whole memory-mapped snapshot file (the page cache is already shared), otherwise
+    a copy in a POSIX shared memory block, released with release().
+    """
+
+    def __init__(self, array):
+        self.shape, self.dtype = array.shape, array.dtype.str
+        self._shm = None
+        path = getattr(array, 'filename', None)
+        if path and np.load(path, mmap_mode='r').shape == array.shape:
+            self.source = ('file', path)
+            return
+
+        self._shm = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+        view = np.ndarray(array.shape, dtype=array.dtype, buffer=self._shm.buf)
+        view[:] = array
+        del view
+        # This process never reads the block again, only the workers do
+        self._shm.close()
+        self.source = ('shm', self._shm.name, self.shape, self.dtype)
+
+    def release(self):
+        """Free the shared memory block; workers still mapping it keep it until they detach"""
+        if self._shm is not None:
+            self._shm.unlink()
+            self._shm = None
+
+# Worker side: galleries mapped in this worker process, most recently used last
+_attached = OrderedDict()
+
+def _map_source(source):
+    if source[0] == 'file':
+        return np.load(source[1], mmap_mode='r'), None
+    _, name, shape, dtype = source
+    shm = shared_memory.SharedMemory(name=name)
+    return np.ndarray(shape, dtype=np.dtype(dtype), buffer=shm.buf), shm
+
+def _attach(sources):
+    """Map a gallery's embeddings (and int8 scales) in this worker, detaching the least recently used"""
+    if sources in _attached:
+        _attached.move_to_end(sources)
+        return _attached[sources][0]
+
+    mapped = [_map_source(source) if source else (None, None) for source in sources]
+    arrays = tuple(array for array, _ in mapped)
+    _attached[sources] = (arrays, [shm for _, shm in mapped if shm is not None])
+
+    while len(_attached) > MAX_ATTACHED_GALLERIES:
+        old_arrays, blocks = _attached.popitem(last=False)[1]
+        del old_arrays  # The views must go before their blocks can be closed
+        for shm in blocks:
+            shm.close()
+    return arrays
+
+def _search_shard(task):
+    """Worker: the k nearest rows of one shard, as gallery row indices and distances"""
+    sources, start, stop, probe_embedding, k = task
+    embeddings, scales = _attach(sources)
+    distances = cosine_distances(
+        probe_embedding, embeddings[start:stop], scales[start:stop] if scales is not None else None
+    )
+    best = top_k(distances, k)
+    return best + start, distances[best]
+
+def _main_is_app_script():
+    """
+    Whether this process was started as a script from the app directory (`python app.py`).
+    Spawned workers re-run the parent's __main__ script, which would then import the app and
+    with it DeepFace and TensorFlow in every shard worker.
+    """
+    main = sys.modules['__main__']
+    main_file = getattr(main, '__file__', None)
+    if main_file is None or getattr(main, '__spec__', None) is not None:
+        return False
+    return os.path.dirname(os.path.abspath(main_file)) == SERVER_DIR
+
+class ShardPool:
+    """
+    Worker processes shared by every sharded index in this process. Started on first use,
+    and again after a fork, since a pool's threads don't survive one.
+
+    Every web process would otherwise start a pool of its own. Once configured, only
+    max_pools processes per host may run one: each holds a lock file in lock_dir for as long
+    as it lives, and the others search exactly in the request thread.
+    """
+
+    def __init__(self):
+        self._pool = None
+        self._processes = 0
+        self._pid = None
+        self._lock = threading.Lock()
+        self._max_pools = None
+        self._lock_dir = None
+        self._slot = None
+        self._slot_pid = None
+        self._warned = False
+
+    def configure(self, max_pools, lock_dir):
+        """Limit the processes on this host that run a pool; unconfigured, every process may"""
+        self._max_pools, self._lock_dir = max_pools, lock_dir
+
+    def _claim_slot(self):
+        """Lock the first free slot file, or return None when every slot is held"""
+        os.makedirs(self._lock_dir, exist_ok=True)
+        for slot in range(self._max_pools):
+            lock_file = open(os.path.join(self._lock_dir, f'pool.{slot}.lock'), 'w')
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                lock_file.close()
+                continue
+            return lock_file
+        return None
+
+    def available(self):
+        """
+        Whether this process may run shard workers. The first time it may, a slot is claimed
+        and kept until the process exits.
+        """
+        with self._lock:
+            if _main_is_app_script():
+                script = os.path.basename(sys.modules['__main__'].__file__)
+                reason = f"started as `python {script}`; serve the app with `flask run` or gunicorn to use shard workers"
+            elif self._max_pools is None:
+                return True
+            else:
+                if self._slot is None or self._slot_pid != os.getpid():
+                    # A slot inherited through a fork stays the parent's
+                    self._slot, self._slot_pid = self._claim_slot(), os.getpid()
+                if self._slot is not None:
+                    return True
+                reason = f"all {self._max_pools} shard pool slots on this host are taken"
+
+            if not self._warned:
+                print(f"Process {os.getpid()} searches the gallery without shard workers: {reason}")
+                self._warned = True
+            return False
+
+    def get(self, processes):
+        """The running pool, restarted when a different number of processes is asked for"""
+        with self._lock:
+            if self._pool is None or self._pid != os.getpid() or self._processes != processes:
+                if self._pool is not None and self._pid == os.getpid():
+                    self._pool.terminate()
+                # Spawn rather than fork: TensorFlow state does not survive a fork
+                self._pool = multiprocessing.get_context('spawn').Pool(processes)
+                self._processes, self._pid = processes, os.getpid()
+            return self._pool
+
+    def close(self):
+        with self._lock:
+            if self._pool is not None and self._pid == os.getpid():
+                self._pool.terminate()
+            self._pool = None
+
+shard_pool = ShardPool()
+
+def search_shards(sources, bounds, probe_embedding, k, processes):
+    """
+    Scan every shard in the pool and merge the per-shard top-k
+
+    Returns:
+        tuple: (numpy.ndarray, numpy.ndarray) - gallery row indices and distances, nearest first
+    """
+    probe_embedding = np.asarray(probe_embedding, dtype=np.float32)
+    results = shard_pool.get(processes).map(
+        _search_shard, [(sources, start, stop, probe_embedding, k) for start, stop in bounds], chunksize=1
+    )
+    rows = np.concatenate([rows for rows, _ in results])
+    distances = np.concatenate([distances for _, distances in results])
+    best = top_k(distances, k)
+    return rows[best], distances[best]
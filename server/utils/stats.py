@@ -0,0 +1,36 @@
+# utils/stats.py - Percentile summaries of recorded latencies and sizes
+
+import numpy as np
+
+def percentiles(values, points=(50, 95), mean=False, digits=None):
+    """
+    Summarize recorded values for a stats endpoint or report.
+
+    Args:
+        values: Iterable of numbers, e.g. a deque of latencies in milliseconds
+        points: Percentiles to include, as 'p50', 'p95', ...
+        mean: Include the mean as well
+        digits: Round every figure to this many decimals
+
+    Returns:
+        dict: {'mean', 'p50', 'p95', ..., 'max'} as floats, or None when nothing was recorded
+    """
+    values = np.array(list(values), dtype=np.float64)
+    if not len(values):
+        return None
+
+    summary = {}
+    if mean:
+        summary['mean'] = float(values.mean())
+    for point in points:
+        summary[f'p{point}'] = float(np.percentile(values, point))
+    summary['max'] = float(values.max())
+
+    if digits is not None:
+        summary = {key: round(value, digits) for key, value in summary.items()}
+    return summary
+
+def latency_summary(values):
+    """Count, mean and p50/p95/p99/max of a list of milliseconds, as every benchmark command reports them"""
+    summary = percentiles(values, points=(50, 95, 99), mean=True, digits=3)
+    return dict(count=len(values), **summary) if summary else None
@@ -0,0 +1,439 @@
+# utils/stream_identify.py - Identification on a camera stream: frame sampling, face tracking and events
+
+import time
+import threading
+from collections import deque
+import cv2
+import numpy as np
+from flask import current_app
+from models.user import Visitor
+from models.ban import Ban
+from utils.biometric import PROBE_MAX_EDGE, find_matching_visitor
+from utils.gallery import get_face_index, get_face_model, check_watchlist
+from utils.inference_service import compute_probe_embedding, InferenceServiceError
+from utils.quality import detect_face_boxes
+from utils.stats import percentiles
+
+def box_iou(a, b):
+    """Intersection over union of two (x, y, w, h) boxes"""
+    x1, y1 = max(a[0], b[0]), max(a[1], b[1])
+    x2, y2 = min(a[0] + a[2], b[0] + b[2]), min(a[1] + a[3], b[1] + b[3])
+    intersection = max(0, x2 - x1) * max(0, y2 - y1)
+    union = a[2] * a[3] + b[2] * b[3] - intersection
+    return intersection / union if union else 0.0
+
+def face_appearance(frame, box):
+    """Hue/saturation histogram of a face box: cheap, and stable for one face between nearby frames"""
+    x, y, w, h = box
+    hsv = cv2.cvtColor(frame[y:y + h, x:x + w], cv2.COLOR_BGR2HSV)
+    hist = cv2.calcHist([hsv], [0, 1], None, [16, 16], [0, 180, 0, 256])
+    return cv2.normalize(hist, hist).flatten()
+
+class FaceTrack:
+    """One face followed across sampled frames, with the outcome of its identification"""
+
+    def __init__(self, track_id, box, appearance, seen_at):
+        self.track_id = track_id
+        self.box = box
+        self.appearance = appearance
+        self.first_seen_at = seen_at
+        self.missed = 0  # Sampled frames since the face was last found
+        self.attempts = 0
+        self.last_attempt_at = None
+        self.visitor_id = None
+        self.distance = None
+        self.reported = False
+        self.verified_at = None  # When the identified face last matched the visitor again
+        self.recheck = False  # Continued on a weak appearance match, so the face may have changed
+
+class FaceTracker:
+    """
+    Follows faces between sampled frames by greedily pairing each track with the detection it
+    overlaps most. At a few frames per second a person at a gate moves little between samples,
+    so overlap keeps the same face on the same track; the appearance check stops the next person
+    stepping into the same spot from inheriting the previous one's identity. A track continued on
+    an appearance match below recheck_similarity is flagged for its identity to be checked again.
+    """
+
+    def __init__(self, iou_threshold=0.3, max_missed=5, min_similarity=0.5, recheck_similarity=0.8):
+        self.iou_threshold = iou_threshold
+        self.max_missed = max_missed
+        self.min_similarity = min_similarity
+        self.recheck_similarity = recheck_similarity
+        self.tracks = {}
+        self.created = 0
+
+    def update(self, boxes, appearances, seen_at):
+        """
+        Match a frame's face boxes to the current tracks, starting tracks for new faces
+
+        Args:
+            boxes (list): (x, y, w, h) face boxes
+            appearances (list): face_appearance() of each box
+
+        Returns:
+            tuple: (list, list) - tracks seen in this frame, and tracks dropped after max_missed frames
+        """
+        pairs = sorted(
+            ((box_iou(track.box, box), track_id, i) for track_id, track in self.tracks.items() for i, box in enumerate(boxes)),
+            reverse=True
+        )
+        matched_tracks, matched_boxes = set(), set()
+        for iou, track_id, i in pairs:
+            if iou < self.iou_threshold:
+                break
+            if track_id in matched_tracks or i in matched_boxes:
+                continue
+            track = self.tracks[track_id]
+            similarity = cv2.compareHist(track.appearance, appearances[i], cv2.HISTCMP_CORREL)
+            if similarity < self.min_similarity:
+                continue
+            track.box, track.appearance, track.missed = boxes[i], appearances[i], 0
+            track.recheck = track.recheck or similarity < self.recheck_similarity
+            matched_tracks.add(track_id)
+            matched_boxes.add(i)
+
+        for i, box in enumerate(boxes):
+            if i not in matched_boxes:
+                self.created += 1
+                self.tracks[self.created] = FaceTrack(self.created, box, appearances[i], seen_at)
+                matched_tracks.add(self.created)
+
+        expired = []
+        for track_id, track in list(self.tracks.items()):
+            if track_id not in matched_tracks:
+                track.missed += 1
+                if track.missed > self.max_missed:
+                    expired.append(self.tracks.pop(track_id))
+        return [self.tracks[track_id] for track_id in matched_tracks], expired
+
+class StreamIdentifier:
+    """
+    Identifies the faces in a sequence of sampled frames. Faces are found with the quality gate's
+    Haar pass and tracked, so each person is embedded a few times rather than on every frame: an
+    unmatched track is retried a few times (the face is usually sharper or closer a moment later)
+    before it is reported as unknown, and a matched one is embedded again every
+    STREAM_REVERIFY_SECONDS, or as soon as its appearance drifts, in case someone else has taken
+    the track over. A track that no longer matches its visitor is identified afresh.
+
+    emit is called with one dict per event: 'identified', 'banned' or 'unknown'.
+    """
+
+    def __init__(self, camera_id, emit, app):
+        config = app.config
+        self.app = app
+        self.camera_id = camera_id
+        self.emit = emit
+        self.tracker = FaceTracker(
+            config['STREAM_TRACK_IOU'], config['STREAM_TRACK_MAX_MISSED'], config['STREAM_TRACK_MIN_SIMILARITY'],
+            config['STREAM_TRACK_RECHECK_SIMILARITY']
+        )
+        self.min_face = config['QUALITY_MIN_FACE_PIXELS']
+        self.retry_seconds = config['STREAM_RETRY_SECONDS']
+        self.max_attempts = config['STREAM_MAX_ATTEMPTS']
+        self.reverify_seconds = config['STREAM_REVERIFY_SECONDS']
+        self._counts = {
+            'frames': 0, 'faces': 0, 'embeddings': 0, 'identified': 0, 'banned': 0, 'unknown': 0,
+            'reverified': 0, 'reassigned': 0
+        }
+        self._latency_ms = {stage: deque(maxlen=10000) for stage in ('detect', 'embed', 'match', 'frame', 'event')}
+
+    def process_frame(self, frame, captured_at, stream_seconds):
+        """
+        Track and identify the faces in one sampled frame
+
+        Args:
+            frame (numpy.ndarray): BGR frame
+            captured_at (float): time.perf_counter() when the frame was read from the stream
+            stream_seconds (float): Position of the frame in the stream, the clock retries are timed on
+        """
+        scale = PROBE_MAX_EDGE / max(frame.shape[:2])
+        if scale < 1:
+            frame = cv2.resize(frame, None, fx=scale, fy=scale, interpolation=cv2.INTER_LINEAR)
+
+        started = time.perf_counter()
+        boxes = detect_face_boxes(frame)
+        self._record('detect', started)
+        self._counts['frames'] += 1
+        self._counts['faces'] += len(boxes)
+
+        tracks, expired = self.tracker.update(boxes, [face_appearance(frame, box) for box in boxes], stream_seconds)
+        for track in tracks:
+            if self._due(track, stream_seconds):
+                if track.reported:
+                    self._reverify(track, frame, captured_at, stream_seconds)
+                else:
+                    self._identify(track, frame, captured_at, stream_seconds)
+
+        # A face that left before it was matched is still worth reporting
+        for track in expired:
+            if track.attempts and not track.reported:
+                self._report(track, 'unknown', captured_at, stream_seconds)
+        self._record('frame', captured_at)
+
+    def finish(self, stream_seconds):
+        """Report the faces still in view, unmatched, when the stream ends"""
+        now = time.perf_counter()
+        for track in self.tracker.tracks.values():
+            if track.attempts and not track.reported:
+                self._report(track, 'unknown', now, stream_seconds)
+
+    def _due(self, track, stream_seconds):
+        """
+        Whether a track should be embedded now: large enough, its retry interval passed, and either
+        not matched yet or matched and due for re-verification. Unknown faces are not retried.
+        """
+        if track.box[2] < self.min_face:
+            return False
+        if track.last_attempt_at is not None and stream_seconds - track.last_attempt_at < self.retry_seconds:
+            return False
+        if not track.reported:
+            return True
+        if track.visitor_id is None:
+            return False
+        return track.recheck or stream_seconds - track.verified_at >= self.reverify_seconds
+
+    def _match(self, track, frame):
+        """
+        Embed a track's face and search the gallery
+
+        Returns:
+            tuple or None: (visitor id or None, distance), or None if no face could be embedded
+        """
+        model_name = get_face_model()
+        started = time.perf_counter()
+        try:
+            embedding = compute_probe_embedding(frame, None, track.box, model_name)
+        except InferenceServiceError as e:
+            self.app.logger.warning(f"Camera {self.camera_id}: could not embed track {track.track_id}: {str(e)}")
+            return None
+        self._record('embed', started)
+        self._counts['embeddings'] += 1
+        if embedding is None or model_name != get_face_model():
+            return None
+
+        started = time.perf_counter()
+        # Banned visitors are checked first against their own small index
+        visitor_id, distance = check_watchlist(embedding)
+        if visitor_id is None:
+            visitor_id, distance = find_matching_visitor(embedding, get_face_index())
+        self._record('match', started)
+        return visitor_id, distance
+
+    def _identify(self, track, frame, captured_at, stream_seconds):
+        track.attempts += 1
+        track.last_attempt_at = stream_seconds
+
+        match = self._match(track, frame)
+        if match is not None:
+            visitor_id, distance = match
+            if track.distance is None or distance < track.distance:
+                track.distance = distance
+            if visitor_id is not None:
+                self._report_visitor(track, visitor_id, captured_at, stream_seconds)
+                return
+
+        if track.attempts >= self.max_attempts:
+            self._report(track, 'unknown', captured_at, stream_seconds)
+
+    def _reverify(self, track, frame, captured_at, stream_seconds):
+        """Embed an identified track again, in case another person has stepped into it"""
+        track.last_attempt_at = stream_seconds
+        match = self._match(track, frame)
+        if match is None:
+            # No usable face this time; tried again after the retry interval
+            return
+
+        visitor_id, distance = match
+        track.recheck = False
+        self._counts['reverified'] += 1
+        if visitor_id == track.visitor_id:
+            track.verified_at = stream_seconds
+            return
+
+        self._counts['reassigned'] += 1
+        self.app.logger.warning(
+            f"Camera {self.camera_id}: track {track.track_id} no longer matches visitor {track.visitor_id}"
+        )
+        # The track is identified afresh; this embedding counts as its first attempt
+        track.visitor_id, track.reported, track.attempts, track.distance = None, False, 1, distance
+        if visitor_id is not None:
+            self._report_visitor(track, visitor_id, captured_at, stream_seconds)
+        elif track.attempts >= self.max_attempts:
+            self._report(track, 'unknown', captured_at, stream_seconds)
+
+    def _report_visitor(self, track, visitor_id, captured_at, stream_seconds):
+        track.visitor_id, track.verified_at = visitor_id, stream_seconds
+        visitor = Visitor.query.get(visitor_id)
+        self._report(track, 'banned' if visitor and visitor.is_banned else 'identified', captured_at, stream_seconds, visitor)
+
+    def _report(self, track, kind, captured_at, stream_seconds, visitor=None):
+        track.reported = True
+        self._counts[kind] += 1
+        event = {
+            'event': kind,
+            'camera': self.camera_id,
+            'track_id': track.track_id,
+            'stream_seconds': round(stream_seconds, 3),
+            'seen_seconds': round(stream_seconds - track.first_seen_at, 3),
+            'box': [int(v) for v in track.box],
+            'attempts': track.attempts,
+            'distance': None if track.distance is None or np.isinf(track.distance) else round(float(track.distance), 4),
+            'visitor': None
+        }
+        if visitor is not None:
+            event['visitor'] = {
+                'id': visitor.uuid,
+                'first_name': visitor.first_name,
+                'last_name': visitor.last_name,
+                'is_banned': visitor.is_banned
+            }
+            if visitor.is_banned:
+                last_ban = Ban.query.filter_by(visitor_id=visitor.id).order_by(Ban.issued_at.desc()).first()
+                event['visitor']['ban_reason'] = last_ban.reason if last_ban else None
+                self.app.logger.warning(f"Camera {self.camera_id}: banned visitor {visitor.uuid} on track {track.track_id}")
+
+        # From the moment the frame was read to the event leaving
+        event['latency_ms'] = round(self._record('event', captured_at), 2)
+        self.emit(event)
+
+    def _record(self, stage, started):
+        elapsed_ms = (time.perf_counter() - started) * 1000
+        self._latency_ms[stage].append(elapsed_ms)
+        return elapsed_ms
+
+    def stats(self):
+        """Frame, track and event counts, with latency percentiles per stage in milliseconds"""
+        latency_ms = {stage: percentiles(values, mean=True, digits=2) for stage, values in self._latency_ms.items()}
+        return dict(self._counts, tracks=self.tracker.created, latency_ms=latency_ms)
+
+def open_stream(source):
+    """
+    Open a camera index ("0"), a stream URL (rtsp://, http:// MJPEG, ...) or a video file
+
+    Returns:
+        tuple: (cv2.VideoCapture, bool) - the capture, and whether the source is live
+    """
+    live = source.isdigit() or '://' in source
+    capture = cv2.VideoCapture(int(source) if source.isdigit() else source)
+    if not capture.isOpened():
+        raise ValueError(f"Could not open video source {source}")
+    return capture, live
+
+class LatestFrameReader:
+    """
+    Reads a live stream on its own thread and keeps only the newest frame, so a slow
+    identification drops stale frames instead of falling further and further behind
+    """
+
+    def __init__(self, capture):
+        self.capture = capture
+        self.frames_read = 0
+        self.frames_dropped = 0
+        self._frame = None
+        self._condition = threading.Condition()
+        self.ended = False
+        self._stopped = False
+        self._thread = threading.Thread(target=self._run, name='stream-reader', daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while not self._stopped:
+            ok, frame = self.capture.read()
+            captured_at = time.perf_counter()
+            with self._condition:
+                if not ok:
+                    self.ended = self._stopped = True
+                else:
+                    self.frames_read += 1
+                    if self._frame is not None:
+                        self.frames_dropped += 1
+                    self._frame = (frame, captured_at)
+                self._condition.notify()
+
+    def next_frame(self, timeout=1.0):
+        """The newest unread frame and its capture time, or None if none arrived within the timeout"""
+        with self._condition:
+            self._condition.wait_for(lambda: self._frame is not None or self._stopped, timeout)
+            frame, self._frame = self._frame, None
+            return frame
+
+    def stop(self):
+        self._stopped = True
+        self._thread.join(timeout=2.0)
+
+def run_stream(source, camera_id, emit, sample_fps=None, max_seconds=None, stop_event=None):
+    """
+    Sample frames from a stream and identify the faces in them until it ends, max_seconds of
+    stream have been processed, or stop_event is set. Video files are read frame by frame and
+    sampled on their own timestamps, so a file replays exactly like the live camera it came from.
+
+    Returns:
+        dict: StreamIdentifier stats plus frames read, sampled and dropped, and processing rate
+    """
+    app = current_app._get_current_object()
+    sample_fps = sample_fps or app.config['STREAM_SAMPLE_FPS']
+    interval = 1.0 / sample_fps
+    capture, live = open_stream(source)
+    identifier = StreamIdentifier(camera_id, emit, app)
+    frames_read = frames_dropped = 0
+    stream_seconds = 0.0
+    started = time.perf_counter()
+
+    def stopping(stream_seconds):
+        return (stop_event is not None and stop_event.is_set()) or (max_seconds is not None and stream_seconds >= max_seconds)
+
+    reader = None
+    try:
+        if live:
+            reader = LatestFrameReader(capture)
+            next_sample = 0.0
+            while True:
+                # Sleep off the rest of the sampling interval rather than process every frame
+                wait = next_sample - (time.perf_counter() - started)
+                if wait > 0:
+                    time.sleep(wait)
+                item = reader.next_frame()
+                stream_seconds = time.perf_counter() - started
+                if stopping(stream_seconds) or (item is None and reader.ended):
+                    break
+                if item is None:
+                    continue
+                next_sample = stream_seconds + interval
+                identifier.process_frame(item[0], item[1], stream_seconds)
+        else:
+            fps = capture.get(cv2.CAP_PROP_FPS) or 25.0
+            next_sample = 0.0
+            # grab() skips a frame without decoding it; only sampled frames are retrieved
+            while capture.grab():
+                stream_seconds = frames_read / fps
+                frames_read += 1
+                if stopping(stream_seconds):
+                    break
+                if stream_seconds + 1e-6 < next_sample:
+                    continue
+                ok, frame = capture.retrieve()
+                if not ok:
+                    break
+                next_sample += interval
+                identifier.process_frame(frame, time.perf_counter(), stream_seconds)
+    finally:
+        # The reader thread must be done with the capture before it is released
+        if reader is not None:
+            reader.stop()
+            frames_read, frames_dropped = reader.frames_read, reader.frames_dropped
+        capture.release()
+    identifier.finish(stream_seconds)
+
+    elapsed = time.perf_counter() - started
+    stats = identifier.stats()
+    return dict(
+        stats,
+        source=source,
+        live=live,
+        frames_read=frames_read,
+        frames_sampled=stats['frames'],
+        frames_dropped=frames_dropped,
+        elapsed_seconds=round(elapsed, 2),
+        sampled_fps=round(stats['frames'] / elapsed, 2) if elapsed else None
+    )